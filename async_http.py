@@ -0,0 +1,379 @@
+import asyncio
+import ssl
+import time
+import urllib.parse
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Callable
+from uuid import uuid4
+
+from python_socks import ProxyType
+from python_socks.async_.asyncio import Proxy
+
+PROXY_TYPES = {
+    "socks5": ProxyType.SOCKS5,
+    "socks4": ProxyType.SOCKS4,
+    "http": ProxyType.HTTP,
+    "https": ProxyType.HTTP,
+}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+UPLOAD_CHUNK_SIZE = 256 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class HttpProtocolError(RuntimeError):
+    pass
+
+
+class StaleConnectionError(ConnectionResetError):
+    # The connection broke before any response byte arrived. request_sent tells
+    # whether the whole request had been handed to the socket by then, in which
+    # case the server may have received and processed it.
+    def __init__(self, message: str, *, request_sent: bool) -> None:
+        super().__init__(message)
+        self.request_sent = request_sent
+
+
+class ResponseTooLargeError(HttpProtocolError):
+    pass
+
+
+@dataclass(frozen=True)
+class StreamingBody:
+    # Request body sent chunk by chunk with a known Content-Length; chunks is a
+    # factory so the body can be replayed when a stale connection is retried.
+    length: int
+    chunks: Callable[[], AsyncIterator[bytes]]
+
+
+async def iter_file_chunks(path: Path, *, expected_size: int) -> AsyncIterator[bytes]:
+    # Never yields more than expected_size bytes, so a file that grows during the
+    # upload cannot write past the Content-Length announced for it.
+    sent = 0
+    with path.open("rb") as file:
+        while sent < expected_size:
+            chunk = await asyncio.to_thread(file.read, min(UPLOAD_CHUNK_SIZE, expected_size - sent))
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+        grown = sent == expected_size and await asyncio.to_thread(file.read, 1)
+    if sent != expected_size or grown:
+        actual_size = sent if not grown else path.stat().st_size
+        raise HttpProtocolError(f"{path} changed size during upload: {expected_size} -> {actual_size} bytes")
+
+
+def build_multipart_body(
+    fields: dict[str, str],
+    file_field: str,
+    file_path: Path,
+    filename: str | None = None,
+) -> tuple[StreamingBody, str]:
+    boundary = f"----CodexBoundary{uuid4().hex}"
+    file_name = filename or file_path.name
+    preamble = bytearray()
+
+    for key, value in fields.items():
+        preamble.extend(f"--{boundary}\r\n".encode("utf-8"))
+        preamble.extend(f'Content-Disposition: form-data; name="{key}"\r\n\r\n'.encode("utf-8"))
+        preamble.extend(str(value).encode("utf-8"))
+        preamble.extend(b"\r\n")
+
+    preamble.extend(f"--{boundary}\r\n".encode("utf-8"))
+    preamble.extend(
+        (
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{file_name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+    )
+    trailer = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    file_size = file_path.stat().st_size
+
+    async def chunks() -> AsyncIterator[bytes]:
+        yield bytes(preamble)
+        async for chunk in iter_file_chunks(file_path, expected_size=file_size):
+            yield chunk
+        yield trailer
+
+    body = StreamingBody(length=len(preamble) + file_size + len(trailer), chunks=chunks)
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+@dataclass
+class HttpResponse:
+    status: int
+    reason: str
+    headers: dict[str, str]
+    body: bytes
+
+    def text(self) -> str:
+        return self.body.decode("utf-8")
+
+
+@dataclass(eq=False)
+class HttpConnection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    requests: int = 0
+    idle_since: float = field(default_factory=time.monotonic)
+
+    def is_reusable(self, idle_timeout: float) -> bool:
+        if self.writer.is_closing() or self.reader.at_eof():
+            return False
+        return time.monotonic() - self.idle_since < idle_timeout
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def build_proxy(proxy: tuple[str, str, int]) -> Proxy:
+    proxy_type, proxy_host, proxy_port = proxy
+    resolved_type = PROXY_TYPES.get(proxy_type.lower())
+    if resolved_type is None:
+        raise RuntimeError(f"Unsupported PROXY_TYPE for Bot API requests: {proxy_type}")
+    return Proxy.create(proxy_type=resolved_type, host=proxy_host, port=proxy_port)
+
+
+async def read_headers(reader: asyncio.StreamReader) -> dict[str, str]:
+    headers: dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            return headers
+        if not line:
+            raise HttpProtocolError("Connection closed while reading response headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def iter_exact(reader: asyncio.StreamReader, size: int) -> AsyncIterator[bytes]:
+    remaining = size
+    while remaining > 0:
+        chunk = await reader.read(min(remaining, READ_CHUNK_SIZE))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b"", remaining)
+        remaining -= len(chunk)
+        yield chunk
+
+
+async def iter_response_body(reader: asyncio.StreamReader, headers: dict[str, str]) -> AsyncIterator[bytes]:
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                raise HttpProtocolError("Connection closed while reading chunked body")
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                await read_headers(reader)
+                return
+            async for chunk in iter_exact(reader, size):
+                yield chunk
+            await reader.readexactly(2)
+    elif "content-length" in headers:
+        async for chunk in iter_exact(reader, int(headers["content-length"])):
+            yield chunk
+    else:
+        while chunk := await reader.read(READ_CHUNK_SIZE):
+            yield chunk
+
+
+@dataclass
+class AsyncHttpClient:
+    # HTTP/1.1 client on top of asyncio streams with a keep-alive pool per host,
+    # so polling, status edits and uploads reuse one TLS (and proxy) handshake.
+    proxy: tuple[str, str, int] | None = None
+    connect_timeout: float = 15.0
+    request_timeout: float = 70.0
+    idle_timeout: float = 60.0
+    max_connections_per_host: int = 8
+    ssl_context: ssl.SSLContext = field(default_factory=ssl.create_default_context)
+    idle: dict[tuple[str, str, int], deque[HttpConnection]] = field(default_factory=dict)
+    limits: dict[tuple[str, str, int], asyncio.Semaphore] = field(default_factory=dict)
+
+    async def open_connection(self, scheme: str, host: str, port: int) -> HttpConnection:
+        ssl_context = self.ssl_context if scheme == "https" else None
+        server_hostname = host if ssl_context is not None else None
+        if self.proxy is None:
+            opening = asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=server_hostname)
+        else:
+            sock = await build_proxy(self.proxy).connect(host, port, timeout=self.connect_timeout)
+            opening = asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=server_hostname)
+        reader, writer = await asyncio.wait_for(opening, timeout=self.connect_timeout)
+        return HttpConnection(reader=reader, writer=writer)
+
+    def take_idle(self, key: tuple[str, str, int]) -> HttpConnection | None:
+        connections = self.idle.get(key)
+        while connections:
+            connection = connections.pop()
+            if connection.is_reusable(self.idle_timeout):
+                return connection
+            connection.close()
+        return None
+
+    def put_idle(self, key: tuple[str, str, int], connection: HttpConnection) -> None:
+        connection.idle_since = time.monotonic()
+        self.idle.setdefault(key, deque()).append(connection)
+
+    async def exchange(
+        self,
+        connection: HttpConnection,
+        method: str,
+        host_header: str,
+        target: str,
+        headers: dict[str, str],
+        body: bytes | StreamingBody,
+        on_body_chunk: Callable[[bytes], None] | None = None,
+    ) -> tuple[HttpResponse, bool]:
+        body_length = body.length if isinstance(body, StreamingBody) else len(body)
+        lines = [
+            f"{method} {target} HTTP/1.1",
+            f"Host: {host_header}",
+            "Connection: keep-alive",
+            "Accept-Encoding: identity",
+            f"Content-Length: {body_length}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        # A request cut short before its last byte cannot be processed by the server.
+        request_sent = False
+        try:
+            if isinstance(body, StreamingBody):
+                connection.writer.write(head)
+                async for chunk in body.chunks():
+                    connection.writer.write(chunk)
+                    await connection.writer.drain()
+                request_sent = True
+            else:
+                connection.writer.write(head + body)
+                request_sent = True
+            await connection.writer.drain()
+            connection.requests += 1
+            status_line = await connection.reader.readline()
+        except (ConnectionResetError, BrokenPipeError) as exc:
+            raise StaleConnectionError(str(exc), request_sent=request_sent) from exc
+        if not status_line:
+            raise StaleConnectionError("Connection closed before the response", request_sent=request_sent)
+
+        version, status, *reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        response_headers = await read_headers(connection.reader)
+
+        keep_alive = version == "HTTP/1.1" and response_headers.get("connection", "").lower() != "close"
+        body_parts: list[bytes] = []
+        if method != "HEAD" and int(status) not in (204, 304):
+            if "content-length" not in response_headers and "transfer-encoding" not in response_headers:
+                keep_alive = False
+            # Only successful bodies go to on_body_chunk; error bodies are kept for the caller.
+            sink = on_body_chunk if on_body_chunk is not None and 200 <= int(status) < 300 else body_parts.append
+            async for chunk in iter_response_body(connection.reader, response_headers):
+                sink(chunk)
+        response_body = b"".join(body_parts)
+
+        response = HttpResponse(
+            status=int(status),
+            reason=reason[0] if reason else "",
+            headers=response_headers,
+            body=response_body,
+        )
+        return response, keep_alive
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: dict[str, str] | None = None,
+        body: bytes | StreamingBody = b"",
+        timeout: float | None = None,
+        on_body_chunk: Callable[[bytes], None] | None = None,
+        idempotent: bool | None = None,
+    ) -> HttpResponse:
+        # idempotent defaults to what the HTTP method promises; APIs that change
+        # state over GET, like the Bot API, have to say so per call.
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname or ""
+        port = parts.port or DEFAULT_PORTS[scheme]
+        host_header = host if port == DEFAULT_PORTS[scheme] else f"{host}:{port}"
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+
+        key = (scheme, host, port)
+        limit = self.limits.setdefault(key, asyncio.Semaphore(self.max_connections_per_host))
+        async with limit:
+            while True:
+                connection = self.take_idle(key)
+                reused = connection is not None
+                if connection is None:
+                    connection = await self.open_connection(scheme, host, port)
+
+                try:
+                    response, keep_alive = await asyncio.wait_for(
+                        self.exchange(connection, method, host_header, target, headers or {}, body, on_body_chunk),
+                        timeout=timeout or self.request_timeout,
+                    )
+                except StaleConnectionError as exc:
+                    connection.close()
+                    # The server may drop an idle keep-alive connection right as we reuse it.
+                    # Retry on a fresh connection only if that cannot run the request twice:
+                    # it did not fully go out, or repeating it changes nothing.
+                    if reused and (not exc.request_sent or idempotent):
+                        continue
+                    raise
+                except BaseException:
+                    connection.close()
+                    raise
+
+                if keep_alive:
+                    self.put_idle(key, connection)
+                else:
+                    connection.close()
+                return response
+
+    async def download(
+        self,
+        url: str,
+        destination: Path,
+        *,
+        max_bytes: int | None = None,
+        progress: Callable[[int], None] | None = None,
+        timeout: float | None = None,
+    ) -> int:
+        # Streams the body into a temp file next to destination and renames it into
+        # place only when the whole file arrived, so a partial download never looks complete.
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = destination.with_name(f"{destination.name}.part")
+        received = 0
+
+        with temp_path.open("wb") as file:
+
+            def write_chunk(chunk: bytes) -> None:
+                nonlocal received
+                received += len(chunk)
+                if max_bytes is not None and received > max_bytes:
+                    raise ResponseTooLargeError(f"Response body exceeds {max_bytes} bytes")
+                file.write(chunk)
+                if progress is not None:
+                    progress(received)
+
+            try:
+                response = await self.request("GET", url, timeout=timeout, on_body_chunk=write_chunk)
+            except BaseException:
+                file.close()
+                temp_path.unlink(missing_ok=True)
+                raise
+
+        if response.status != 200:
+            temp_path.unlink(missing_ok=True)
+            raise HttpProtocolError(f"Download failed: HTTP {response.status} {response.reason}")
+        temp_path.replace(destination)
+        return received
+
+    async def close(self) -> None:
+        for connections in self.idle.values():
+            while connections:
+                connections.pop().close()
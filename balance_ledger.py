@@ -0,0 +1,241 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (
+    chat_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL,
+    synced_balance INTEGER NOT NULL,
+    pending_balance INTEGER,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    job_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_chat_id ON reservations (chat_id);
+CREATE TABLE IF NOT EXISTS settlements (
+    job_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    requests_charged INTEGER NOT NULL,
+    balance_before INTEGER NOT NULL,
+    balance_after INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+def now_timestamp() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+@dataclass(frozen=True)
+class Settlement:
+    requests_charged: int
+    balance_before: int
+    balance_after: int
+    # False when the job was already settled before, e.g. ahead of a restart.
+    created: bool = True
+
+
+@dataclass
+class BalanceLedger:
+    # The authoritative request balance per chat. Jobs reserve their worst-case
+    # charge up front and settle the real one at the end, each in one transaction,
+    # so concurrent files of a chat can never spend the same balance twice.
+    #
+    # The clients sheet is a projection: synced_balance is what the sheet showed
+    # last, and a different value read from it is a manual top-up or correction,
+    # applied here as a delta. pending_balance is a value being written to the
+    # sheet, so reading our own write back is not mistaken for a manual change.
+    path: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+
+    def observe_sheet_balances(self, sheet_balances: dict[str, int]) -> dict[str, int]:
+        balances: dict[str, int] = {}
+        with self.transaction():
+            for chat_id, sheet_balance in sheet_balances.items():
+                row = self.connection.execute(
+                    "SELECT balance, synced_balance, pending_balance FROM balances WHERE chat_id = ?",
+                    (chat_id,),
+                ).fetchone()
+                if row is None:
+                    self.connection.execute(
+                        """
+                        INSERT INTO balances (chat_id, balance, synced_balance, pending_balance, updated_at)
+                        VALUES (?, ?, ?, NULL, ?)
+                        """,
+                        (chat_id, sheet_balance, sheet_balance, now_timestamp()),
+                    )
+                    balances[chat_id] = sheet_balance
+                    continue
+
+                balance, synced_balance, pending_balance = row
+                if pending_balance is not None and sheet_balance == pending_balance:
+                    synced_balance = sheet_balance
+                    pending_balance = None
+                elif sheet_balance != synced_balance:
+                    # A manual change. A write still in flight keeps its
+                    # pending_balance: when it lands over this change, reading it
+                    # back must not be taken for another manual change that takes
+                    # the top-up away again.
+                    balance += sheet_balance - synced_balance
+                    synced_balance = sheet_balance
+                else:
+                    balances[chat_id] = balance
+                    continue
+                self.connection.execute(
+                    """
+                    UPDATE balances
+                    SET balance = ?, synced_balance = ?, pending_balance = ?, updated_at = ?
+                    WHERE chat_id = ?
+                    """,
+                    (balance, synced_balance, pending_balance, now_timestamp(), chat_id),
+                )
+                balances[chat_id] = balance
+        return balances
+
+    def get_available(self, chat_id: str) -> int | None:
+        with self.lock:
+            row = self.connection.execute(
+                """
+                SELECT balance - COALESCE(
+                    (SELECT SUM(amount) FROM reservations WHERE reservations.chat_id = balances.chat_id), 0
+                )
+                FROM balances
+                WHERE chat_id = ?
+                """,
+                (chat_id,),
+            ).fetchone()
+        return None if row is None else int(row[0])
+
+    def reserve(self, job_id: str, chat_id: str, amount: int, *, allow_negative: bool) -> bool:
+        # False if the amount does not fit into the balance left by other reservations.
+        # A job resumed after a restart finds its reservation already in place.
+        with self.transaction():
+            settled = self.connection.execute("SELECT 1 FROM settlements WHERE job_id = ?", (job_id,)).fetchone()
+            if settled is not None:
+                # Already charged before a restart; settle will return that result again.
+                return True
+            row = self.connection.execute("SELECT balance FROM balances WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                raise RuntimeError(f"No balance for chat {chat_id} in the ledger")
+            reserved = self.connection.execute(
+                "SELECT COALESCE(SUM(amount), 0) FROM reservations WHERE chat_id = ? AND job_id != ?",
+                (chat_id, job_id),
+            ).fetchone()[0]
+            available = int(row[0]) - int(reserved)
+            if not allow_negative and amount > available:
+                return False
+            self.connection.execute(
+                "INSERT OR IGNORE INTO reservations (job_id, chat_id, amount, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, chat_id, amount, now_timestamp()),
+            )
+            return True
+
+    def settle(self, job_id: str, chat_id: str, requests_charged: int) -> Settlement:
+        # Charges the real amount and drops the reservation. Settling a job twice,
+        # e.g. when the bot stopped right after billing, returns the first result.
+        with self.transaction():
+            settled = self.connection.execute(
+                "SELECT requests_charged, balance_before, balance_after FROM settlements WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+            created = settled is None
+            if created:
+                row = self.connection.execute(
+                    "SELECT balance FROM balances WHERE chat_id = ?",
+                    (chat_id,),
+                ).fetchone()
+                if row is None:
+                    raise RuntimeError(f"No balance for chat {chat_id} in the ledger")
+                settled = (requests_charged, int(row[0]), int(row[0]) - requests_charged)
+                now = now_timestamp()
+                self.connection.execute(
+                    "UPDATE balances SET balance = ?, updated_at = ? WHERE chat_id = ?",
+                    (settled[2], now, chat_id),
+                )
+                self.connection.execute(
+                    """
+                    INSERT INTO settlements (
+                        job_id, chat_id, requests_charged, balance_before, balance_after, created_at
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (job_id, chat_id, *settled, now),
+                )
+            self.connection.execute("DELETE FROM reservations WHERE job_id = ?", (job_id,))
+        return Settlement(
+            requests_charged=settled[0],
+            balance_before=settled[1],
+            balance_after=settled[2],
+            created=created,
+        )
+
+    def release(self, job_id: str) -> None:
+        with self.transaction():
+            self.connection.execute("DELETE FROM reservations WHERE job_id = ?", (job_id,))
+
+    def release_all_except(self, job_ids: set[str]) -> int:
+        # Reservations of jobs that will never run again, e.g. ones marked failed.
+        with self.transaction():
+            rows = self.connection.execute("SELECT job_id FROM reservations").fetchall()
+            stale = [(job_id,) for (job_id,) in rows if job_id not in job_ids]
+            self.connection.executemany("DELETE FROM reservations WHERE job_id = ?", stale)
+        return len(stale)
+
+    def begin_sync(self) -> dict[str, int]:
+        # Balances the sheet does not show yet; they are marked as being written.
+        with self.transaction():
+            rows = self.connection.execute(
+                "SELECT chat_id, balance FROM balances WHERE balance != synced_balance",
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE balances SET pending_balance = ? WHERE chat_id = ?",
+                [(balance, chat_id) for chat_id, balance in rows],
+            )
+        return {chat_id: int(balance) for chat_id, balance in rows}
+
+    def finish_sync(self, written: dict[str, int]) -> None:
+        with self.transaction():
+            self.connection.executemany(
+                """
+                UPDATE balances
+                SET synced_balance = ?, pending_balance = NULL
+                WHERE chat_id = ? AND pending_balance = ?
+                """,
+                [(balance, chat_id, balance) for chat_id, balance in written.items()],
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def open_balance_ledger(path: Path) -> BalanceLedger:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # isolation_level=None lets reserve and settle open BEGIN IMMEDIATE themselves;
+    # the lock keeps calls from the Sheets executor threads apart.
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return BalanceLedger(path=path, connection=connection)
@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+import row_trace
+
+
+@dataclass
+class BotConversationGate:
+    # Every query of one Telethon session listens to the same bot, so the
+    # "send -> replies -> clicks" dialog must run one query at a time.
+    min_send_interval_seconds: float = 0.0
+    # Called with how long a dialog held the gate, so estimates can tell the
+    # serialized part of a row from the part that runs in parallel.
+    on_release: Callable[[float], None] | None = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_send_at: float | None = None
+
+    async def wait_send_slot(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.last_send_at is not None:
+            delay = self.last_send_at + self.min_send_interval_seconds - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self.last_send_at = loop.time()
+
+
+@dataclass
+class GateWait:
+    seconds: float = 0.0
+
+
+# Every open measure_gate_wait block of the current row, innermost last.
+CURRENT_GATE_WAITS: contextvars.ContextVar[tuple[GateWait, ...]] = contextvars.ContextVar(
+    "current_gate_waits",
+    default=(),
+)
+
+
+@contextlib.contextmanager
+def measure_gate_wait() -> Iterator[GateWait]:
+    # Sums how long the block waited for dialogs of other rows to release the
+    # gate, so latency history can leave out what only depends on concurrency.
+    wait = GateWait()
+    token = CURRENT_GATE_WAITS.set((*CURRENT_GATE_WAITS.get(), wait))
+    try:
+        yield wait
+    finally:
+        CURRENT_GATE_WAITS.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def conversation(gate: BotConversationGate | None):
+    if gate is None:
+        yield
+        return
+
+    wait_started_at = time.monotonic()
+    with row_trace.span("gate_wait"):
+        await gate.lock.acquire()
+    acquired_at = time.monotonic()
+    for wait in CURRENT_GATE_WAITS.get():
+        wait.seconds += acquired_at - wait_started_at
+    try:
+        with row_trace.span("send_interval_wait"):
+            await gate.wait_send_slot()
+        yield
+    finally:
+        gate.lock.release()
+        if gate.on_release is not None:
+            gate.on_release(time.monotonic() - acquired_at)
+
+
+def bind_to_current_context(func: Callable) -> Callable:
+    # Telethon runs event handlers in its own task, not in the row task, so bind
+    # the echo output to the row context to keep it in that row's output buffer.
+    context = contextvars.copy_context()
+
+    def bound(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+
+    return bound
@@ -1,8 +1,16 @@
 from __future__ import annotations
 
+import os
+import threading
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 
+import balance_ledger
 import google_sheets_client
+import pipeline_metrics
+import registry_log_writer
+import sheets_circuit
 
 CLIENTS_HEADERS = [
     "chat_id",
@@ -13,6 +21,8 @@ CLIENTS_HEADERS = [
     "created_at",
     "updated_at",
     "notes",
+    "tier",
+    "max_concurrency",
 ]
 
 BILLING_LOG_HEADERS = [
@@ -43,6 +53,15 @@ AUDIT_LOG_HEADERS = [
     "details",
 ]
 
+# Share of the row slots a client gets while several clients have files in work.
+# A plain number in the tier column is used as the weight directly.
+TIER_WEIGHTS = {
+    "": 1.0,
+    "basic": 1.0,
+    "standard": 2.0,
+    "premium": 4.0,
+}
+
 INN_REQUEST_NON_BILLABLE_STATUSES = {
     "",
     "input_error",
@@ -64,29 +83,29 @@ def parse_int(value: str | int | None, default: int = 0) -> int:
 
 
 def ensure_registry_sheets(service, config: google_sheets_client.GoogleSheetsConfig) -> None:
-    google_sheets_client.ensure_worksheet_with_headers(
+    google_sheets_client.ensure_worksheets_with_headers(
         service,
         config.spreadsheet_id,
-        config.clients_sheet_name,
-        CLIENTS_HEADERS,
-        rows=200,
-        rewrite_on_mismatch=True,
-    )
-    google_sheets_client.ensure_worksheet_with_headers(
-        service,
-        config.spreadsheet_id,
-        config.billing_log_sheet_name,
-        BILLING_LOG_HEADERS,
-        rows=1000,
-        rewrite_on_mismatch=True,
-    )
-    google_sheets_client.ensure_worksheet_with_headers(
-        service,
-        config.spreadsheet_id,
-        config.audit_log_sheet_name,
-        AUDIT_LOG_HEADERS,
-        rows=1000,
-        rewrite_on_mismatch=True,
+        [
+            google_sheets_client.WorksheetSpec(
+                title=config.clients_sheet_name,
+                headers=tuple(CLIENTS_HEADERS),
+                rows=200,
+                rewrite_on_mismatch=True,
+            ),
+            google_sheets_client.WorksheetSpec(
+                title=config.billing_log_sheet_name,
+                headers=tuple(BILLING_LOG_HEADERS),
+                rows=1000,
+                rewrite_on_mismatch=True,
+            ),
+            google_sheets_client.WorksheetSpec(
+                title=config.audit_log_sheet_name,
+                headers=tuple(AUDIT_LOG_HEADERS),
+                rows=1000,
+                rewrite_on_mismatch=True,
+            ),
+        ],
     )
 
 
@@ -111,24 +130,156 @@ def build_client_record(row: google_sheets_client.WorksheetRow) -> dict[str, obj
         "created_at": str(values.get("created_at", "")).strip(),
         "updated_at": str(values.get("updated_at", "")).strip(),
         "notes": str(values.get("notes", "")).strip(),
+        "tier": str(values.get("tier", "")).strip().lower(),
+        "max_concurrency": parse_int(values.get("max_concurrency"), 0),
     }
 
 
-def get_client_by_chat_id(
+def get_client_weight(client: dict[str, object]) -> float:
+    tier = str(client.get("tier", "")).strip().lower()
+    if tier in TIER_WEIGHTS:
+        return TIER_WEIGHTS[tier]
+    try:
+        return max(0.01, float(tier.replace(",", ".")))
+    except ValueError:
+        return TIER_WEIGHTS[""]
+
+
+@dataclass
+class ClientRegistryCache:
+    # chat_id -> client record of the whole clients sheet. Lookups run in worker
+    # threads, hence the lock; a chat missing from a fresh index is simply unregistered.
+    ttl_seconds: float
+    clients: dict[str, dict[str, object]] = field(default_factory=dict)
+    loaded_at: float | None = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def is_fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl_seconds
+
+    def replace(self, clients: dict[str, dict[str, object]]) -> None:
+        with self.lock:
+            self.clients = clients
+            self.loaded_at = time.monotonic()
+
+    def store(self, client: dict[str, object]) -> None:
+        with self.lock:
+            self.clients[str(client["chat_id"])] = client
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded_at = None
+
+
+def get_cache_ttl_seconds() -> float:
+    return float(os.getenv("CLIENT_REGISTRY_CACHE_TTL_SECONDS", "60").strip() or "60")
+
+
+CLIENT_CACHE = ClientRegistryCache(ttl_seconds=get_cache_ttl_seconds())
+
+
+def load_clients(
     service,
     config: google_sheets_client.GoogleSheetsConfig,
-    chat_id: int | str,
-) -> dict[str, object] | None:
+) -> dict[str, dict[str, object]]:
     _, rows = google_sheets_client.read_table_rows(
         service,
         config.spreadsheet_id,
         config.clients_sheet_name,
     )
-    chat_id_str = str(chat_id)
+    clients: dict[str, dict[str, object]] = {}
     for row in rows:
-        if str(row.values.get("chat_id", "")).strip() == chat_id_str:
-            return build_client_record(row)
-    return None
+        chat_id = str(row.values.get("chat_id", "")).strip()
+        # The first row of a chat wins, as it did with the linear scan.
+        if chat_id and chat_id not in clients:
+            clients[chat_id] = build_client_record(row)
+    return clients
+
+
+def reload_clients(service, config: google_sheets_client.GoogleSheetsConfig) -> int:
+    clients = load_clients(service, config)
+    if LEDGER is not None:
+        # The sheet is only a projection of the ledger; what it shows is reconciled first.
+        balances = LEDGER.observe_sheet_balances(
+            {chat_id: int(client["request_balance"]) for chat_id, client in clients.items()}
+        )
+        for chat_id, client in clients.items():
+            client["request_balance"] = balances[chat_id]
+    CLIENT_CACHE.replace(clients)
+    return len(clients)
+
+
+LEDGER: balance_ledger.BalanceLedger | None = None
+
+
+def set_balance_ledger(ledger: balance_ledger.BalanceLedger | None) -> None:
+    global LEDGER
+    LEDGER = ledger
+
+
+def get_available_balance(client: dict[str, object]) -> int:
+    # Without a ledger the sheet value is all there is; with one, running jobs'
+    # reservations are already taken out of it.
+    if LEDGER is not None:
+        available = LEDGER.get_available(str(client["chat_id"]))
+        if available is not None:
+            return available
+    return int(client["request_balance"])
+
+
+def sync_balances(service, config: google_sheets_client.GoogleSheetsConfig) -> int:
+    # Re-reads the clients sheet, so manual changes reach the ledger first, then
+    # writes every balance the sheet does not show yet in one values.batchUpdate.
+    # A manual edit made between the two steps is still applied to the ledger when
+    # a reload sees it; the cell may show the older written value until the next
+    # sync, which then writes the balance including that edit.
+    if LEDGER is None:
+        return 0
+    reload_clients(service, config)
+    pending = LEDGER.begin_sync()
+    with CLIENT_CACHE.lock:
+        clients = {chat_id: CLIENT_CACHE.clients.get(chat_id) for chat_id in pending}
+    balance_column = google_sheets_client.column_number_to_letter(CLIENTS_HEADERS.index("request_balance") + 1)
+    updated_at_column = google_sheets_client.column_number_to_letter(CLIENTS_HEADERS.index("updated_at") + 1)
+    updated_at = now_timestamp()
+    data: list[tuple[str, list[list[str]]]] = []
+    written: dict[str, int] = {}
+    for chat_id, balance in pending.items():
+        client = clients[chat_id]
+        if client is None:
+            continue
+        row_number = int(client["row_number"])
+        data.append((f"'{config.clients_sheet_name}'!{balance_column}{row_number}", [[str(balance)]]))
+        data.append((f"'{config.clients_sheet_name}'!{updated_at_column}{row_number}", [[updated_at]]))
+        written[chat_id] = balance
+    if not data:
+        return 0
+    google_sheets_client.batch_update_values(service, config.spreadsheet_id, data)
+    LEDGER.finish_sync(written)
+    return len(written)
+
+
+def get_client_by_chat_id(
+    service,
+    config: google_sheets_client.GoogleSheetsConfig,
+    chat_id: int | str,
+) -> dict[str, object] | None:
+    # Billing needs no fresh read: the ledger charges, and manual balance changes
+    # reach it with the next reload or sync_balances.
+    hit = CLIENT_CACHE.is_fresh()
+    pipeline_metrics.record_cache_lookup("client_registry", hit=hit)
+    if not hit:
+        try:
+            reload_clients(service, config)
+        except sheets_circuit.SheetsCircuitOpenError:
+            # While Sheets is down, access decisions use the last loaded registry;
+            # balances still come from the local ledger.
+            if CLIENT_CACHE.loaded_at is None:
+                raise
+            pipeline_metrics.inc_counter("client_registry_stale_lookups_total")
+    with CLIENT_CACHE.lock:
+        client = CLIENT_CACHE.clients.get(str(chat_id))
+    return dict(client) if client is not None else None
 
 
 def validate_client_access(
@@ -153,7 +304,7 @@ def validate_client_access(
             "client": client,
         }
 
-    request_balance = int(client["request_balance"])
+    request_balance = get_available_balance(client)
     allow_negative = bool(client["allow_negative_balance"])
     if not allow_negative and request_balance < 1:
         return {
@@ -195,6 +346,10 @@ def is_successful_phone_request(row: dict[str, str | None]) -> bool:
     return (row.get("summary_status") or "").strip() == "found"
 
 
+def count_row_charge(row: dict[str, str | None]) -> int:
+    return int(is_successful_inn_request(row)) + int(is_successful_phone_request(row))
+
+
 def count_successful_telegram_requests(results: list[dict[str, str | None]]) -> dict[str, int]:
     successful_inn_requests = sum(1 for row in results if is_successful_inn_request(row))
     successful_phone_requests = sum(1 for row in results if is_successful_phone_request(row))
@@ -243,12 +398,34 @@ def build_client_sheet_row(client: dict[str, object], *, request_balance: int) -
     return {header: str(raw_values.get(header, "")) for header in CLIENTS_HEADERS}
 
 
+LOG_WRITER: registry_log_writer.RegistryLogWriter | None = None
+
+
+def set_log_writer(writer: registry_log_writer.RegistryLogWriter | None) -> None:
+    global LOG_WRITER
+    LOG_WRITER = writer
+
+
+def append_log_row(
+    service,
+    spreadsheet_id: str,
+    worksheet_title: str,
+    headers: list[str],
+    entry: dict[str, str | int | None],
+) -> None:
+    # With a background writer the row only goes to the local spool here.
+    if LOG_WRITER is not None:
+        LOG_WRITER.enqueue(worksheet_title, [entry.get(header) for header in headers])
+        return
+    google_sheets_client.append_dict_row(service, spreadsheet_id, worksheet_title, headers, entry)
+
+
 def append_billing_log(
     service,
     config: google_sheets_client.GoogleSheetsConfig,
     entry: dict[str, str | int | None],
 ) -> None:
-    google_sheets_client.append_dict_row(
+    append_log_row(
         service,
         config.spreadsheet_id,
         config.billing_log_sheet_name,
@@ -268,7 +445,7 @@ def append_audit_log(
     status: str,
     details: str,
 ) -> None:
-    google_sheets_client.append_dict_row(
+    append_log_row(
         service,
         config.spreadsheet_id,
         config.audit_log_sheet_name,
@@ -296,45 +473,59 @@ def apply_charge(
     result_worksheet_title: str | None,
     comment: str,
     status: str,
+    job_id: str | None = None,
 ) -> dict[str, object]:
-    request_balance_before = int(client["request_balance"])
     requests_charged = int(charge["requests_charged"])
-    request_balance_after = request_balance_before - requests_charged
-    updated_row = build_client_sheet_row(client, request_balance=request_balance_after)
-    google_sheets_client.update_dict_row(
-        service,
-        config.spreadsheet_id,
-        config.clients_sheet_name,
-        int(client["row_number"]),
-        CLIENTS_HEADERS,
-        updated_row,
-    )
-
-    append_billing_log(
-        service,
-        config,
-        {
-            "created_at": now_timestamp(),
-            "chat_id": str(client["chat_id"]),
-            "client_name": str(client["client_name"]),
-            "file_name": file_name,
-            "message_id": "" if message_id is None else str(message_id),
-            "rows_total": str(charge["rows_total"]),
-            "successful_telegram_requests": str(charge["successful_telegram_requests"]),
-            "successful_inn_requests": str(charge["successful_inn_requests"]),
-            "successful_phone_requests": str(charge["successful_phone_requests"]),
-            "requests_charged": str(requests_charged),
-            "request_balance_before": str(request_balance_before),
-            "request_balance_after": str(request_balance_after),
-            "status": status,
-            "result_worksheet_title": result_worksheet_title or "",
-            "comment": comment,
-        },
-    )
+    log_charge = True
+    if LEDGER is not None and job_id is not None:
+        # The ledger charges atomically; the clients sheet catches up with sync_balances.
+        settlement = LEDGER.settle(job_id, str(client["chat_id"]), requests_charged)
+        request_balance_before = settlement.balance_before
+        request_balance_after = settlement.balance_after
+        updated_at = now_timestamp()
+        # A job resumed after billing gets the earlier result back; its log row is already written.
+        log_charge = settlement.created
+    else:
+        request_balance_before = int(client["request_balance"])
+        request_balance_after = request_balance_before - requests_charged
+        updated_row = build_client_sheet_row(client, request_balance=request_balance_after)
+        google_sheets_client.update_dict_row(
+            service,
+            config.spreadsheet_id,
+            config.clients_sheet_name,
+            int(client["row_number"]),
+            CLIENTS_HEADERS,
+            updated_row,
+        )
+        updated_at = updated_row["updated_at"]
+
+    if log_charge:
+        append_billing_log(
+            service,
+            config,
+            {
+                "created_at": now_timestamp(),
+                "chat_id": str(client["chat_id"]),
+                "client_name": str(client["client_name"]),
+                "file_name": file_name,
+                "message_id": "" if message_id is None else str(message_id),
+                "rows_total": str(charge["rows_total"]),
+                "successful_telegram_requests": str(charge["successful_telegram_requests"]),
+                "successful_inn_requests": str(charge["successful_inn_requests"]),
+                "successful_phone_requests": str(charge["successful_phone_requests"]),
+                "requests_charged": str(requests_charged),
+                "request_balance_before": str(request_balance_before),
+                "request_balance_after": str(request_balance_after),
+                "status": status,
+                "result_worksheet_title": result_worksheet_title or "",
+                "comment": comment,
+            },
+        )
 
     updated_client = dict(client)
     updated_client["request_balance"] = request_balance_after
-    updated_client["updated_at"] = updated_row["updated_at"]
+    updated_client["updated_at"] = updated_at
+    CLIENT_CACHE.store(updated_client)
     return {
         "client": updated_client,
         "request_balance_before": request_balance_before,
@@ -0,0 +1,107 @@
+import asyncio
+import contextlib
+from collections import deque
+from dataclasses import dataclass, field
+
+
+@dataclass
+class FlowState:
+    weight: float = 1.0
+    max_concurrency: int = 0
+    running: int = 0
+    jobs: int = 0
+    last_finish_tag: float = 0.0
+    waiters: deque[tuple[float, asyncio.Future]] = field(default_factory=deque)
+
+    def can_start(self) -> bool:
+        return self.max_concurrency <= 0 or self.running < self.max_concurrency
+
+    def is_idle(self) -> bool:
+        return self.jobs <= 0 and self.running <= 0 and not self.waiters
+
+
+@dataclass
+class FairRowScheduler:
+    # Start-time fair queueing over row slots: every chat is a flow, a row gets
+    # start tag max(V, previous finish of its flow) and finish tag start + cost / weight,
+    # and a free slot goes to the waiting row with the smallest start tag.
+    capacity: int
+    flows: dict[str, FlowState] = field(default_factory=dict)
+    running: int = 0
+    virtual_time: float = 0.0
+
+    def open_flow(self, key: str, *, weight: float, max_concurrency: int = 0) -> None:
+        # A flow lives while its chat has jobs or rows in work; close_flow drops it
+        # afterwards, so chats seen once do not stay in the map for good. A flow
+        # that comes back starts at the current virtual time, like any idle one.
+        flow = self.flows.setdefault(key, FlowState())
+        flow.jobs += 1
+        flow.weight = max(0.01, weight)
+        flow.max_concurrency = max(0, max_concurrency)
+        self.dispatch()
+
+    def close_flow(self, key: str) -> None:
+        flow = self.flows.get(key)
+        if flow is None:
+            return
+        flow.jobs -= 1
+        self.drop_if_idle(key)
+
+    def drop_if_idle(self, key: str) -> None:
+        flow = self.flows.get(key)
+        if flow is not None and flow.is_idle():
+            del self.flows[key]
+
+    def active_flow_count(self, *, including: str) -> int:
+        # Flows that hold or wait for slots now, plus the given one.
+        return len({key for key, flow in self.flows.items() if flow.running or flow.waiters} | {including})
+
+    def dispatch(self) -> None:
+        while self.running < self.capacity:
+            candidates = [
+                (flow.waiters[0][0], key)
+                for key, flow in self.flows.items()
+                if flow.waiters and flow.can_start()
+            ]
+            if not candidates:
+                return
+
+            start_tag, key = min(candidates)
+            flow = self.flows[key]
+            _, future = flow.waiters.popleft()
+            self.virtual_time = max(self.virtual_time, start_tag)
+            flow.running += 1
+            self.running += 1
+            future.set_result(None)
+
+    def release(self, key: str) -> None:
+        flow = self.flows[key]
+        flow.running -= 1
+        self.running -= 1
+        self.drop_if_idle(key)
+        self.dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: str, *, cost: float = 1.0):
+        flow = self.flows.setdefault(key, FlowState())
+        start_tag = max(self.virtual_time, flow.last_finish_tag)
+        flow.last_finish_tag = start_tag + max(0.0, cost) / flow.weight
+        future = asyncio.get_running_loop().create_future()
+        entry = (start_tag, future)
+        flow.waiters.append(entry)
+        self.dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(key)
+            else:
+                flow.waiters.remove(entry)
+                self.drop_if_idle(key)
+            raise
+
+        try:
+            yield
+        finally:
+            self.release(key)
@@ -11,6 +11,8 @@ from dotenv import load_dotenv
 from openpyxl import Workbook, load_workbook
 from telethon import TelegramClient, events
 
+import pipeline_metrics
+from bot_conversation import BotConversationGate, bind_to_current_context, conversation
 from telethon_client_factory import build_telegram_client
 
 load_dotenv()
@@ -312,6 +314,7 @@ def drain_queue(state: QueryState) -> int:
             return dropped
 
 
+@pipeline_metrics.timed_stage("bot_wait", outcome_of=pipeline_metrics.response_outcome, source="director_phone")
 async def wait_for_next_useful_message(
     state: QueryState,
     log: logging.Logger,
@@ -425,7 +428,8 @@ async def explore_message(
         await asyncio.sleep(CLICK_DELAY_SECONDS)
 
         try:
-            await message.click(button.row_index, button.col_index)
+            with pipeline_metrics.stage_timer("bot_click", span_attrs={"button": button.text}, source="director_phone"):
+                await message.click(button.row_index, button.col_index)
         except Exception as exc:
             print(f"{indent}[warn] click failed: {button.text} ({exc})")
             log.exception("Click failed for button %s", button.text)
@@ -529,14 +533,16 @@ async def run_single_query(
     persist: bool = False,
     echo: bool = True,
     timeout_seconds: int = QUERY_TIMEOUT_SECONDS,
+    gate: BotConversationGate | None = None,
 ) -> QueryState:
     query_log = log or logging.getLogger("director_phone")
     state = QueryState(requested_inn=inn)
+    echo_incoming = bind_to_current_context(print_incoming)
 
     async def handle_bot_message(event, prefix: str) -> None:
         message = event.message
         if echo:
-            print_incoming(prefix, message)
+            echo_incoming(prefix, message)
         state.queue.put_nowait(message)
 
     async def on_new_message(event):
@@ -547,36 +553,39 @@ async def run_single_query(
 
     new_message_builder = events.NewMessage(from_users=bot_entity)
     edited_message_builder = events.MessageEdited(from_users=bot_entity)
-    client.add_event_handler(on_new_message, new_message_builder)
-    client.add_event_handler(on_edited_message, edited_message_builder)
-
-    try:
-        command = f"/inn {inn}"
-        if echo:
-            print(f"[you] {command}")
-        await client.send_message(bot_entity, command)
 
+    async with conversation(gate):
+        client.add_event_handler(on_new_message, new_message_builder)
+        client.add_event_handler(on_edited_message, edited_message_builder)
         try:
-            found = await asyncio.wait_for(resolve_query(state, query_log), timeout=timeout_seconds)
-        except asyncio.TimeoutError:
-            set_failure(
-                state,
-                status="timeout",
-                message=f"Превышено время ожидания результата ({timeout_seconds} сек)",
-            )
-        else:
-            if found and state.result_status == "pending":
-                state.result_status = "found"
-
-        if persist:
-            if results_csv is None or results_xlsx is None:
-                raise RuntimeError("results_csv/results_xlsx are required when persist=True")
-            append_result(results_csv, results_xlsx, state)
+            command = f"/inn {inn}"
+            if echo:
+                print(f"[you] {command}")
+            with pipeline_metrics.stage_timer("bot_send", source="director_phone"):
+                await client.send_message(bot_entity, command)
 
-        return state
-    finally:
-        client.remove_event_handler(on_new_message, new_message_builder)
-        client.remove_event_handler(on_edited_message, edited_message_builder)
+            try:
+                with pipeline_metrics.stage_timer("query", source="director_phone"):
+                    found = await asyncio.wait_for(resolve_query(state, query_log), timeout=timeout_seconds)
+            except asyncio.TimeoutError:
+                set_failure(
+                    state,
+                    status="timeout",
+                    message=f"Превышено время ожидания результата ({timeout_seconds} сек)",
+                )
+            else:
+                if found and state.result_status == "pending":
+                    state.result_status = "found"
+        finally:
+            client.remove_event_handler(on_new_message, new_message_builder)
+            client.remove_event_handler(on_edited_message, edited_message_builder)
+
+    if persist:
+        if results_csv is None or results_xlsx is None:
+            raise RuntimeError("results_csv/results_xlsx are required when persist=True")
+        append_result(results_csv, results_xlsx, state)
+
+    return state
 
 
 async def main() -> None:
@@ -14,6 +14,9 @@ from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 from playwright.async_api import async_playwright
 from telethon import TelegramClient, events
 
+import pipeline_metrics
+import row_trace
+from bot_conversation import BotConversationGate, bind_to_current_context, conversation
 from telethon_client_factory import build_telegram_client
 
 load_dotenv()
@@ -222,6 +225,7 @@ def extract_report_button(message) -> ReportLinkCandidate | None:
     return None
 
 
+@pipeline_metrics.timed_stage("bot_wait", outcome_of=pipeline_metrics.response_outcome, source="ip_phone")
 async def wait_for_report_message(state: QueryState, log: logging.Logger) -> tuple[str | None, Any | None]:
     loop = asyncio.get_running_loop()
     deadline = loop.time() + QUERY_TIMEOUT_SECONDS
@@ -395,6 +399,11 @@ def save_report_debug_artifacts(
     return body_path, html_path, fixed_body_path
 
 
+def report_page_outcome(result: tuple) -> str:
+    return "parsed" if result[0] is not None else "not_parsed"
+
+
+@pipeline_metrics.timed_stage("report_page", outcome_of=report_page_outcome, source="ip_phone")
 async def fetch_person_from_report(
     url: str,
     *,
@@ -431,7 +440,10 @@ async def fetch_person_from_report(
                 len(fixed_body_text),
             )
 
-            parsed = parse_report_text(body_text, report_url=page_url)
+            with row_trace.span("parse", source="ip_phone") as parse_span:
+                parsed = parse_report_text(body_text, report_url=page_url)
+                if parse_span is not None and parsed is None:
+                    parse_span.outcome = "not_parsed"
             if parsed:
                 log.info(
                     "Parsed report: fio=%r phone=%r email=%r inn=%r",
@@ -511,13 +523,7 @@ def append_result(results_csv: Path, results_xlsx: Path, state: QueryState) -> N
     append_result_xlsx(results_xlsx, row)
 
 
-async def resolve_query(
-    state: QueryState,
-    log: logging.Logger,
-    *,
-    headless: bool,
-    debug_dir: Path,
-) -> bool:
+async def resolve_report_link(state: QueryState, log: logging.Logger) -> ReportLinkCandidate | None:
     kind, payload = await wait_for_report_message(state, log)
     if kind is None:
         set_failure(
@@ -525,7 +531,7 @@ async def resolve_query(
             status="no_response",
             message="После /inn бот не вернул ссылку на web-отчёт",
         )
-        return False
+        return None
 
     if kind == "not_found":
         not_found_message = payload
@@ -536,7 +542,7 @@ async def resolve_query(
             message=not_found_message,
             error="По этому ИНН бот ничего не нашёл",
         )
-        return False
+        return None
 
     message = payload
     report_button = extract_report_button(message)
@@ -546,8 +552,19 @@ async def resolve_query(
             status="report_link_missing",
             message="Бот прислал сообщение про отчёт, но ссылка в кнопке не найдена",
         )
-        return False
+        return None
+    return report_button
 
+
+async def resolve_report_page(
+    state: QueryState,
+    report_button: ReportLinkCandidate,
+    log: logging.Logger,
+    *,
+    headless: bool,
+    debug_dir: Path,
+) -> bool:
+    assert report_button.url is not None
     print(f"[report] opening link: {report_button.url}")
     try:
         person, body_path, html_path, fixed_body_path = await fetch_person_from_report(
@@ -599,6 +616,19 @@ async def resolve_query(
     return True
 
 
+async def resolve_query(
+    state: QueryState,
+    log: logging.Logger,
+    *,
+    headless: bool,
+    debug_dir: Path,
+) -> bool:
+    report_button = await resolve_report_link(state, log)
+    if report_button is None:
+        return False
+    return await resolve_report_page(state, report_button, log, headless=headless, debug_dir=debug_dir)
+
+
 async def run_single_query(
     client: TelegramClient,
     bot_entity,
@@ -612,15 +642,18 @@ async def run_single_query(
     timeout_seconds: int = QUERY_TIMEOUT_SECONDS + 90,
     headless: bool = True,
     debug_dir: Path | None = None,
+    gate: BotConversationGate | None = None,
 ) -> QueryState:
     query_log = log or logging.getLogger("ip_phone")
     report_debug_dir = debug_dir or Path("report_debug")
     state = QueryState(requested_inn=inn)
+    echo_incoming = bind_to_current_context(print_incoming)
+    report_button: ReportLinkCandidate | None = None
 
     async def handle_bot_message(event, prefix: str) -> None:
         message = event.message
         if echo:
-            print_incoming(prefix, message)
+            echo_incoming(prefix, message)
         state.queue.put_nowait(message)
 
     async def on_new_message(event):
@@ -631,19 +664,48 @@ async def run_single_query(
 
     new_message_builder = events.NewMessage(from_users=bot_entity)
     edited_message_builder = events.MessageEdited(from_users=bot_entity)
-    client.add_event_handler(on_new_message, new_message_builder)
-    client.add_event_handler(on_edited_message, edited_message_builder)
 
-    try:
-        command = f"/inn {inn}"
-        if echo:
-            print(f"[you] {command}")
-        await client.send_message(bot_entity, command)
+    # Only the Telegram part of the query needs the bot conversation; the web report
+    # is opened after the gate is released so other queries can talk to the bot.
+    async with conversation(gate):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_seconds
+        client.add_event_handler(on_new_message, new_message_builder)
+        client.add_event_handler(on_edited_message, edited_message_builder)
+        try:
+            command = f"/inn {inn}"
+            if echo:
+                print(f"[you] {command}")
+            with pipeline_metrics.stage_timer("bot_send", source="ip_phone"):
+                await client.send_message(bot_entity, command)
 
+            try:
+                with pipeline_metrics.stage_timer("query", source="ip_phone"):
+                    report_button = await asyncio.wait_for(
+                        resolve_report_link(state, query_log),
+                        timeout=timeout_seconds,
+                    )
+            except asyncio.TimeoutError:
+                set_failure(
+                    state,
+                    status="timeout",
+                    message="Превышено время ожидания результата по ИП",
+                )
+        finally:
+            client.remove_event_handler(on_new_message, new_message_builder)
+            client.remove_event_handler(on_edited_message, edited_message_builder)
+
+    if report_button is not None:
         try:
             found = await asyncio.wait_for(
-                resolve_query(state, query_log, headless=headless, debug_dir=report_debug_dir),
-                timeout=timeout_seconds,
+                resolve_report_page(
+                    state,
+                    report_button,
+                    query_log,
+                    headless=headless,
+                    debug_dir=report_debug_dir,
+                ),
+                timeout=max(1.0, deadline - loop.time()),
             )
         except asyncio.TimeoutError:
             set_failure(
@@ -655,15 +717,12 @@ async def run_single_query(
             if found and state.result_status == "pending":
                 state.result_status = "found"
 
-        if persist:
-            if results_csv is None or results_xlsx is None:
-                raise RuntimeError("results_csv/results_xlsx are required when persist=True")
-            append_result(results_csv, results_xlsx, state)
+    if persist:
+        if results_csv is None or results_xlsx is None:
+            raise RuntimeError("results_csv/results_xlsx are required when persist=True")
+        append_result(results_csv, results_xlsx, state)
 
-        return state
-    finally:
-        client.remove_event_handler(on_new_message, new_message_builder)
-        client.remove_event_handler(on_edited_message, edited_message_builder)
+    return state
 
 
 async def main() -> None:
@@ -12,6 +12,8 @@ from openpyxl import Workbook, load_workbook
 from telethon import TelegramClient, events, helpers
 from telethon.tl import types
 
+import pipeline_metrics
+from bot_conversation import BotConversationGate, bind_to_current_context, conversation
 from telethon_client_factory import build_telegram_client
 
 load_dotenv()
@@ -403,6 +405,7 @@ def parse_phone_summary(message) -> PhoneSummary | None:
     return summary
 
 
+@pipeline_metrics.timed_stage("bot_wait", outcome_of=pipeline_metrics.response_outcome, source="phone_summary")
 async def wait_for_summary_message(state: QueryState, log: logging.Logger) -> tuple[str | None, Any | None]:
     loop = asyncio.get_running_loop()
     deadline = loop.time() + QUERY_TIMEOUT_SECONDS
@@ -549,14 +552,16 @@ async def run_single_query(
     persist: bool = False,
     echo: bool = True,
     timeout_seconds: int = QUERY_TIMEOUT_SECONDS + 30,
+    gate: BotConversationGate | None = None,
 ) -> QueryState:
     query_log = log or logging.getLogger("phone_summary")
     state = QueryState(requested_phone=phone)
+    echo_incoming = bind_to_current_context(print_incoming)
 
     async def handle_bot_message(event, prefix: str) -> None:
         message = event.message
         if echo:
-            print_incoming(prefix, message)
+            echo_incoming(prefix, message)
         state.queue.put_nowait(message)
 
     async def on_new_message(event):
@@ -567,35 +572,38 @@ async def run_single_query(
 
     new_message_builder = events.NewMessage(from_users=bot_entity)
     edited_message_builder = events.MessageEdited(from_users=bot_entity)
-    client.add_event_handler(on_new_message, new_message_builder)
-    client.add_event_handler(on_edited_message, edited_message_builder)
-
-    try:
-        if echo:
-            print(f"[you] {phone}")
-        await client.send_message(bot_entity, phone)
 
+    async with conversation(gate):
+        client.add_event_handler(on_new_message, new_message_builder)
+        client.add_event_handler(on_edited_message, edited_message_builder)
         try:
-            found = await asyncio.wait_for(resolve_query(state, query_log), timeout=timeout_seconds)
-        except asyncio.TimeoutError:
-            set_failure(
-                state,
-                status="timeout",
-                message="Превышено время ожидания результата по телефону",
-            )
-        else:
-            if found and state.result_status == "pending":
-                state.result_status = "found"
-
-        if persist:
-            if results_csv is None or results_xlsx is None:
-                raise RuntimeError("results_csv/results_xlsx are required when persist=True")
-            append_result(results_csv, results_xlsx, state)
+            if echo:
+                print(f"[you] {phone}")
+            with pipeline_metrics.stage_timer("bot_send", source="phone_summary"):
+                await client.send_message(bot_entity, phone)
 
-        return state
-    finally:
-        client.remove_event_handler(on_new_message, new_message_builder)
-        client.remove_event_handler(on_edited_message, edited_message_builder)
+            try:
+                with pipeline_metrics.stage_timer("query", source="phone_summary"):
+                    found = await asyncio.wait_for(resolve_query(state, query_log), timeout=timeout_seconds)
+            except asyncio.TimeoutError:
+                set_failure(
+                    state,
+                    status="timeout",
+                    message="Превышено время ожидания результата по телефону",
+                )
+            else:
+                if found and state.result_status == "pending":
+                    state.result_status = "found"
+        finally:
+            client.remove_event_handler(on_new_message, new_message_builder)
+            client.remove_event_handler(on_edited_message, edited_message_builder)
+
+    if persist:
+        if results_csv is None or results_xlsx is None:
+            raise RuntimeError("results_csv/results_xlsx are required when persist=True")
+        append_result(results_csv, results_xlsx, state)
+
+    return state
 
 
 async def main() -> None:
@@ -1,26 +1,40 @@
+import asyncio
+import contextvars
+import functools
 import logging
 import os
 import random
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, InvalidOperation
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import Iterable, Sequence
+from typing import Callable, Iterable, Sequence
 
 from dotenv import load_dotenv
+import httplib2
 from google.auth.exceptions import TransportError
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 from httplib2 import HttpLib2Error
 
+import pipeline_metrics
+import sheets_circuit
+import sheets_quota
+
 load_dotenv()
 
 GOOGLE_SHEETS_SCOPE = "https://www.googleapis.com/auth/spreadsheets"
 WORKSHEET_TITLE_MAX_LEN = 100
 INVALID_WORKSHEET_TITLE_RE = re.compile(r"[\[\]\:\*\?\/\\]")
 RETRYABLE_HTTP_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+SPREADSHEET_METADATA_FIELDS = "properties.title,sheets.properties(sheetId,title,gridProperties)"
+METADATA_MISMATCH_MARKERS = ("already exists", "unable to parse range", "no grid with id")
 
 
 @dataclass(frozen=True)
@@ -33,6 +47,21 @@ class GoogleSheetsConfig:
     retry_attempts: int
     retry_base_delay_seconds: float
     retry_max_delay_seconds: float
+    request_timeout_seconds: float
+    operation_timeout_seconds: float
+    export_chunk_rows: int
+    export_parallel_chunks: int
+    export_mode: str
+    stream_chunk_rows: int
+    stream_interval_seconds: float
+
+
+@dataclass(frozen=True)
+class WorksheetProperties:
+    sheet_id: int
+    title: str
+    row_count: int
+    column_count: int
 
 
 @dataclass(frozen=True)
@@ -40,6 +69,55 @@ class SpreadsheetInfo:
     spreadsheet_id: str
     title: str
     worksheet_titles: tuple[str, ...]
+    worksheets: tuple[WorksheetProperties, ...] = ()
+
+    def find_worksheet(self, title: str) -> WorksheetProperties | None:
+        return next((worksheet for worksheet in self.worksheets if worksheet.title == title), None)
+
+
+@dataclass
+class SpreadsheetMetadataCache:
+    # Worksheet titles, ids and grid sizes per spreadsheet. Our own addSheet and
+    # appendDimension calls update it in place; it is fetched again only when Sheets
+    # disagrees with it, e.g. after a worksheet was added or removed by hand.
+    spreadsheets: dict[str, SpreadsheetInfo] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, spreadsheet_id: str) -> SpreadsheetInfo | None:
+        with self.lock:
+            return self.spreadsheets.get(spreadsheet_id)
+
+    def store(self, info: SpreadsheetInfo) -> None:
+        with self.lock:
+            self.spreadsheets[info.spreadsheet_id] = info
+
+    def put_worksheet(self, spreadsheet_id: str, worksheet: WorksheetProperties) -> None:
+        with self.lock:
+            info = self.spreadsheets.get(spreadsheet_id)
+            if info is None:
+                return
+            worksheets = tuple(item for item in info.worksheets if item.sheet_id != worksheet.sheet_id) + (worksheet,)
+            self.spreadsheets[spreadsheet_id] = replace(
+                info,
+                worksheets=worksheets,
+                worksheet_titles=tuple(item.title for item in worksheets),
+            )
+
+    def invalidate(self, spreadsheet_id: str) -> None:
+        with self.lock:
+            self.spreadsheets.pop(spreadsheet_id, None)
+
+
+METADATA_CACHE = SpreadsheetMetadataCache()
+
+
+@dataclass(frozen=True)
+class WorksheetSpec:
+    title: str
+    headers: tuple[str, ...]
+    rows: int = 1000
+    cols: int | None = None
+    rewrite_on_mismatch: bool = False
 
 
 @dataclass(frozen=True)
@@ -94,6 +172,13 @@ def load_config() -> GoogleSheetsConfig:
         retry_attempts=get_int_env("GOOGLE_SHEETS_RETRY_ATTEMPTS", 5),
         retry_base_delay_seconds=get_float_env("GOOGLE_SHEETS_RETRY_BASE_DELAY_SECONDS", 1.0),
         retry_max_delay_seconds=get_float_env("GOOGLE_SHEETS_RETRY_MAX_DELAY_SECONDS", 20.0),
+        request_timeout_seconds=get_float_env("GOOGLE_SHEETS_REQUEST_TIMEOUT_SECONDS", 60.0),
+        operation_timeout_seconds=get_float_env("GOOGLE_SHEETS_OPERATION_TIMEOUT_SECONDS", 180.0),
+        export_chunk_rows=max(1, get_int_env("GOOGLE_SHEETS_EXPORT_CHUNK_ROWS", 2000)),
+        export_parallel_chunks=max(1, get_int_env("GOOGLE_SHEETS_EXPORT_PARALLEL_CHUNKS", 3)),
+        export_mode=os.getenv("GOOGLE_SHEETS_EXPORT_MODE", "final").strip().lower() or "final",
+        stream_chunk_rows=max(1, get_int_env("GOOGLE_SHEETS_STREAM_CHUNK_ROWS", 50)),
+        stream_interval_seconds=get_float_env("GOOGLE_SHEETS_STREAM_INTERVAL_SECONDS", 10.0),
     )
 
 
@@ -104,9 +189,124 @@ def build_credentials(config: GoogleSheetsConfig) -> Credentials:
     )
 
 
+class ThreadLocalHttpRequest(HttpRequest):
+    # httplib2.Http keeps one connection per host and is not thread-safe, while
+    # requests of one service run on several Sheets executor threads at once.
+    # Each request is therefore sent through the Http of the thread executing it.
+    def __init__(self, get_http: Callable[[], AuthorizedHttp], *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.get_http = get_http
+
+    def execute(self, http=None, num_retries=0):
+        return super().execute(http=http or self.get_http(), num_retries=num_retries)
+
+
 def build_sheets_service(config: GoogleSheetsConfig):
     credentials = build_credentials(config)
-    return build("sheets", "v4", credentials=credentials, cache_discovery=False)
+    local = threading.local()
+
+    def get_http() -> AuthorizedHttp:
+        http = getattr(local, "http", None)
+        if http is None:
+            # A socket timeout per HTTP request, so a hung call frees its worker thread.
+            http = local.http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=config.request_timeout_seconds))
+        return http
+
+    return build(
+        "sheets",
+        "v4",
+        http=get_http(),
+        requestBuilder=functools.partial(ThreadLocalHttpRequest, get_http),
+        cache_discovery=False,
+    )
+
+
+SHEETS_EXECUTOR: ThreadPoolExecutor | None = None
+
+
+def get_sheets_max_workers() -> int:
+    return max(1, get_int_env("GOOGLE_SHEETS_MAX_WORKERS", 4))
+
+
+def get_sheets_executor() -> ThreadPoolExecutor:
+    # googleapiclient is blocking; its calls get their own bounded pool so a slow
+    # or failing Sheets API cannot take over the default executor.
+    global SHEETS_EXECUTOR
+    if SHEETS_EXECUTOR is None:
+        SHEETS_EXECUTOR = ThreadPoolExecutor(
+            max_workers=get_sheets_max_workers(),
+            thread_name_prefix="google_sheets",
+        )
+    return SHEETS_EXECUTOR
+
+
+BILLING_EXECUTOR: ThreadPoolExecutor | None = None
+BILLING_EXECUTOR_WORKERS = 2
+
+
+def get_billing_executor() -> ThreadPoolExecutor:
+    # Blocking Sheets calls wait for quota and back off on their thread. Billing
+    # gets threads of its own, so it is never stuck behind lower-priority calls
+    # that hold every thread of the shared pool while they wait.
+    global BILLING_EXECUTOR
+    if BILLING_EXECUTOR is None:
+        BILLING_EXECUTOR = ThreadPoolExecutor(
+            max_workers=BILLING_EXECUTOR_WORKERS,
+            thread_name_prefix="google_sheets_billing",
+        )
+    return BILLING_EXECUTOR
+
+
+def close_sheets_executor() -> None:
+    global SHEETS_EXECUTOR, BILLING_EXECUTOR
+    for executor in (SHEETS_EXECUTOR, BILLING_EXECUTOR):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    SHEETS_EXECUTOR = None
+    BILLING_EXECUTOR = None
+
+
+QUOTA_SCHEDULER: sheets_quota.SheetsQuotaScheduler | None = None
+
+
+def get_quota_scheduler() -> sheets_quota.SheetsQuotaScheduler:
+    # One scheduler per process: the Sheets quota is per project and user, not per service object.
+    global QUOTA_SCHEDULER
+    if QUOTA_SCHEDULER is None:
+        QUOTA_SCHEDULER = sheets_quota.SheetsQuotaScheduler(
+            read_limit=get_int_env("GOOGLE_SHEETS_READ_REQUESTS_PER_MINUTE", 60),
+            write_limit=get_int_env("GOOGLE_SHEETS_WRITE_REQUESTS_PER_MINUTE", 60),
+        )
+    return QUOTA_SCHEDULER
+
+
+CIRCUIT_BREAKERS: dict[str, sheets_circuit.CircuitBreaker] = {}
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def get_circuit_breaker() -> sheets_circuit.CircuitBreaker:
+    # One circuit per priority class, so failing exports or log flushes do not
+    # cut off billing or access checks while those still get through.
+    name = sheets_quota.PRIORITY_NAMES.get(sheets_quota.CURRENT_PRIORITY.get(), "interactive")
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.get(name)
+        if breaker is None:
+            breaker = CIRCUIT_BREAKERS[name] = sheets_circuit.CircuitBreaker(
+                name=name,
+                failure_threshold=max(1, get_int_env("GOOGLE_SHEETS_CIRCUIT_FAILURE_THRESHOLD", 5)),
+                open_seconds=get_float_env("GOOGLE_SHEETS_CIRCUIT_OPEN_SECONDS", 30.0),
+            )
+    return breaker
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    if sheets_quota.CURRENT_PRIORITY.get() == sheets_quota.PRIORITY_BILLING:
+        executor = get_billing_executor()
+    else:
+        executor = get_sheets_executor()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
 
 
 def is_retryable_exception(exc: Exception) -> bool:
@@ -115,59 +315,249 @@ def is_retryable_exception(exc: Exception) -> bool:
     return isinstance(exc, (TransportError, HttpLib2Error, TimeoutError, OSError))
 
 
-def execute_with_retries(request, config: GoogleSheetsConfig, *, log: logging.Logger | None = None, operation: str) -> dict:
-    query_log = log or logging.getLogger("google_sheets")
-    last_error: Exception | None = None
+def get_retry_delay(config: GoogleSheetsConfig, attempt: int) -> float:
+    base_delay = config.retry_base_delay_seconds * (2 ** (attempt - 1))
+    capped_delay = min(base_delay, config.retry_max_delay_seconds)
+    return capped_delay + random.uniform(0, min(0.5, capped_delay / 2))
+
+
+def plan_retry(
+    exc: Exception,
+    config: GoogleSheetsConfig,
+    *,
+    log: logging.Logger | None,
+    operation: str,
+    attempt: int,
+    deadline: float,
+) -> float:
+    # Returns how long to wait before the next attempt, or re-raises exc when the
+    # attempts or the operation's time budget are used up.
+    if attempt >= config.retry_attempts or not is_retryable_exception(exc):
+        raise exc
+    sleep_seconds = get_retry_delay(config, attempt)
+    if time.monotonic() + sleep_seconds >= deadline:
+        raise exc
+
+    pipeline_metrics.inc_counter("google_sheets_retries_total", operation=operation)
+    (log or logging.getLogger("google_sheets")).warning(
+        "Google Sheets %s failed on attempt %s/%s: %s. Retry in %.2fs",
+        operation,
+        attempt,
+        config.retry_attempts,
+        exc,
+        sleep_seconds,
+    )
+    return sleep_seconds
+
+
+def get_request_kind(request) -> str:
+    # Sheets counts read and write requests against separate per-minute quotas.
+    return "read" if getattr(request, "method", "POST") == "GET" else "write"
+
+
+def note_quota_error(exc: Exception, kind: str, delay: float) -> None:
+    if isinstance(exc, HttpError) and exc.resp.status == 429:
+        get_quota_scheduler().note_throttled(kind, delay)
 
-    for attempt in range(1, config.retry_attempts + 1):
+
+def record_circuit_failure(breaker: sheets_circuit.CircuitBreaker, exc: Exception) -> None:
+    # Only failures that say Sheets is down count; any other error is an answer
+    # from a working API. A 429 is left to the quota scheduler (note_quota_error)
+    # and does not open the circuit. The call that opens the circuit stops
+    # retrying at once and fails like every call after it, so callers that fall
+    # back to local state see the same error.
+    if isinstance(exc, HttpError) and exc.resp.status == 429:
+        return
+    if not is_retryable_exception(exc):
+        breaker.record_success()
+        return
+    breaker.record_failure()
+    if breaker.is_open():
+        raise breaker.open_error() from exc
+
+
+def execute_with_retries(
+    request,
+    config: GoogleSheetsConfig,
+    *,
+    log: logging.Logger | None = None,
+    operation: str,
+    timeout: float | None = None,
+) -> dict:
+    if get_request_kind(request) == "read":
+        return get_quota_scheduler().coalesce(
+            (request.uri, getattr(request, "body", None)),
+            functools.partial(execute_attempts, request, config, log=log, operation=operation, timeout=timeout),
+            operation=operation,
+        )
+    return execute_attempts(request, config, log=log, operation=operation, timeout=timeout)
+
+
+def execute_attempts(
+    request,
+    config: GoogleSheetsConfig,
+    *,
+    log: logging.Logger | None,
+    operation: str,
+    timeout: float | None,
+) -> dict:
+    kind = get_request_kind(request)
+    breaker = get_circuit_breaker()
+    deadline = time.monotonic() + (timeout or config.operation_timeout_seconds)
+    attempt = 1
+    while True:
+        breaker.before_call()
+        # Time spent waiting for quota does not count against the operation's budget.
+        deadline += get_quota_scheduler().acquire(kind)
+        try:
+            with pipeline_metrics.stage_timer("sheets", source=operation):
+                response = request.execute()
+        except Exception as exc:
+            record_circuit_failure(breaker, exc)
+            delay = plan_retry(exc, config, log=log, operation=operation, attempt=attempt, deadline=deadline)
+            note_quota_error(exc, kind, delay)
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return response
+        attempt += 1
+
+
+async def execute_with_retries_async(
+    request,
+    config: GoogleSheetsConfig,
+    *,
+    log: logging.Logger | None = None,
+    operation: str,
+    timeout: float | None = None,
+) -> dict:
+    # Same retry policy as execute_with_retries, but the backoff and the quota wait
+    # happen on the event loop and only the HTTP call occupies an executor thread.
+    if get_request_kind(request) == "read":
+        return await get_quota_scheduler().coalesce_async(
+            (request.uri, getattr(request, "body", None)),
+            functools.partial(execute_attempts_async, request, config, log=log, operation=operation, timeout=timeout),
+            operation=operation,
+        )
+    return await execute_attempts_async(request, config, log=log, operation=operation, timeout=timeout)
+
+
+async def execute_attempts_async(
+    request,
+    config: GoogleSheetsConfig,
+    *,
+    log: logging.Logger | None,
+    operation: str,
+    timeout: float | None,
+) -> dict:
+    kind = get_request_kind(request)
+    breaker = get_circuit_breaker()
+    deadline = time.monotonic() + (timeout or config.operation_timeout_seconds)
+    attempt = 1
+    while True:
+        breaker.before_call()
+        deadline += await get_quota_scheduler().acquire_async(kind)
+        running = asyncio.ensure_future(run_blocking(request.execute))
+        running.add_done_callback(lambda future: future.cancelled() or future.exception())
         try:
-            return request.execute()
+            with pipeline_metrics.stage_timer("sheets", source=operation):
+                response = await asyncio.wait_for(
+                    asyncio.shield(running),
+                    timeout=max(0.0, deadline - time.monotonic()),
+                )
         except Exception as exc:
-            last_error = exc
-            if attempt >= config.retry_attempts or not is_retryable_exception(exc):
+            if not running.done():
+                # The timed-out call keeps running in its thread and may still reach
+                # Sheets, so it is never sent again next to it.
+                record_circuit_failure(breaker, exc)
                 raise
+            record_circuit_failure(breaker, exc)
+            delay = plan_retry(exc, config, log=log, operation=operation, attempt=attempt, deadline=deadline)
+            note_quota_error(exc, kind, delay)
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return response
+        attempt += 1
 
-            base_delay = config.retry_base_delay_seconds * (2 ** (attempt - 1))
-            capped_delay = min(base_delay, config.retry_max_delay_seconds)
-            sleep_seconds = capped_delay + random.uniform(0, min(0.5, capped_delay / 2))
-            query_log.warning(
-                "Google Sheets %s failed on attempt %s/%s: %s. Retry in %.2fs",
-                operation,
-                attempt,
-                config.retry_attempts,
-                exc,
-                sleep_seconds,
-            )
-            time.sleep(sleep_seconds)
 
-    assert last_error is not None
-    raise last_error
+def get_cached_spreadsheet_info(spreadsheet_id: str) -> SpreadsheetInfo | None:
+    cached = METADATA_CACHE.get(spreadsheet_id)
+    pipeline_metrics.record_cache_lookup("sheets_metadata", hit=cached is not None)
+    return cached
 
 
-def get_spreadsheet_info(service, spreadsheet_id: str) -> SpreadsheetInfo:
+def get_spreadsheet_info(service, spreadsheet_id: str, *, refresh: bool = False) -> SpreadsheetInfo:
+    if not refresh and (cached := get_cached_spreadsheet_info(spreadsheet_id)) is not None:
+        return cached
     config = load_config()
     response = execute_with_retries(
-        service.spreadsheets().get(spreadsheetId=spreadsheet_id),
+        service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields=SPREADSHEET_METADATA_FIELDS),
+        config,
+        operation="spreadsheets.get",
+    )
+    info = parse_spreadsheet_info(spreadsheet_id, response)
+    METADATA_CACHE.store(info)
+    return info
+
+
+async def get_spreadsheet_info_async(service, spreadsheet_id: str, *, refresh: bool = False) -> SpreadsheetInfo:
+    if not refresh and (cached := get_cached_spreadsheet_info(spreadsheet_id)) is not None:
+        return cached
+    config = load_config()
+    response = await execute_with_retries_async(
+        service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields=SPREADSHEET_METADATA_FIELDS),
         config,
         operation="spreadsheets.get",
     )
-    sheets = response.get("sheets", [])
-    worksheet_titles = tuple(
-        sheet.get("properties", {}).get("title", "Untitled")
-        for sheet in sheets
+    info = parse_spreadsheet_info(spreadsheet_id, response)
+    METADATA_CACHE.store(info)
+    return info
+
+
+def parse_worksheet_properties(properties: dict) -> WorksheetProperties:
+    grid = properties.get("gridProperties", {})
+    return WorksheetProperties(
+        sheet_id=int(properties.get("sheetId", 0)),
+        title=properties.get("title", "Untitled"),
+        row_count=int(grid.get("rowCount", 0)),
+        column_count=int(grid.get("columnCount", 0)),
+    )
+
+
+def parse_spreadsheet_info(spreadsheet_id: str, response: dict) -> SpreadsheetInfo:
+    worksheets = tuple(
+        parse_worksheet_properties(sheet.get("properties", {}))
+        for sheet in response.get("sheets", [])
     )
     return SpreadsheetInfo(
         spreadsheet_id=spreadsheet_id,
         title=response.get("properties", {}).get("title", "Untitled"),
-        worksheet_titles=worksheet_titles,
+        worksheet_titles=tuple(worksheet.title for worksheet in worksheets),
+        worksheets=worksheets,
     )
 
 
+def is_metadata_mismatch_error(exc: Exception) -> bool:
+    # Errors that mean the cached worksheet list no longer matches the spreadsheet.
+    if not isinstance(exc, HttpError) or exc.resp.status != 400:
+        return False
+    message = str(exc).lower()
+    return any(marker in message for marker in METADATA_MISMATCH_MARKERS)
+
+
+def remember_added_worksheet(spreadsheet_id: str, reply: dict) -> WorksheetProperties:
+    properties = reply["addSheet"]["properties"]
+    worksheet = parse_worksheet_properties(properties)
+    METADATA_CACHE.put_worksheet(spreadsheet_id, worksheet)
+    return worksheet
+
+
 def check_connection(log: logging.Logger | None = None) -> SpreadsheetInfo:
     query_log = log or logging.getLogger("google_sheets")
     config = load_config()
     service = build_sheets_service(config)
-    info = get_spreadsheet_info(service, config.spreadsheet_id)
+    info = get_spreadsheet_info(service, config.spreadsheet_id, refresh=True)
     query_log.info(
         "Connected to Google Sheets: title=%r worksheets=%s credentials=%s",
         info.title,
@@ -274,23 +664,49 @@ def read_table_rows(service, spreadsheet_id: str, worksheet_title: str) -> tuple
     return headers, rows
 
 
-def append_rows(service, spreadsheet_id: str, worksheet_title: str, rows: Iterable[Sequence[str | None]]) -> None:
-    config = load_config()
-    normalized_rows = [
+def normalize_rows(rows: Iterable[Sequence[str | int | float | Decimal | None]]) -> list[list[str]]:
+    return [
         ["" if value is None else str(value) for value in row]
         for row in rows
     ]
+
+
+def build_append_rows_request(service, spreadsheet_id: str, worksheet_title: str, rows: list[list[str]]):
+    return service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id,
+        range=f"'{worksheet_title}'!A1",
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body={"values": rows},
+    )
+
+
+def append_rows(service, spreadsheet_id: str, worksheet_title: str, rows: Iterable[Sequence[str | None]]) -> None:
+    config = load_config()
+    normalized_rows = normalize_rows(rows)
     if not normalized_rows:
         return
 
     execute_with_retries(
-        service.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id,
-            range=f"'{worksheet_title}'!A1",
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": normalized_rows},
-        ),
+        build_append_rows_request(service, spreadsheet_id, worksheet_title, normalized_rows),
+        config,
+        operation="spreadsheets.values.append",
+    )
+
+
+async def append_rows_async(
+    service,
+    spreadsheet_id: str,
+    worksheet_title: str,
+    rows: Iterable[Sequence[str | None]],
+) -> None:
+    config = load_config()
+    normalized_rows = normalize_rows(rows)
+    if not normalized_rows:
+        return
+
+    await execute_with_retries_async(
+        build_append_rows_request(service, spreadsheet_id, worksheet_title, normalized_rows),
         config,
         operation="spreadsheets.values.append",
     )
@@ -323,6 +739,28 @@ def update_row_values(
     )
 
 
+def batch_update_values(
+    service,
+    spreadsheet_id: str,
+    data: Sequence[tuple[str, Sequence[Sequence[str | None]]]],
+) -> None:
+    config = load_config()
+    if not data:
+        return
+
+    execute_with_retries(
+        service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": [{"range": cell_range, "values": normalize_rows(values)} for cell_range, values in data],
+            },
+        ),
+        config,
+        operation="spreadsheets.values.batchUpdate",
+    )
+
+
 def clear_worksheet(service, spreadsheet_id: str, worksheet_title: str) -> None:
     config = load_config()
     execute_with_retries(
@@ -336,6 +774,42 @@ def clear_worksheet(service, spreadsheet_id: str, worksheet_title: str) -> None:
     )
 
 
+def ensure_column_count(service, spreadsheet_id: str, worksheet_title: str, column_count: int) -> None:
+    config = load_config()
+    for refresh in (False, True):
+        worksheet = get_spreadsheet_info(service, spreadsheet_id, refresh=refresh).find_worksheet(worksheet_title)
+        if worksheet is None:
+            continue
+        if worksheet.column_count >= column_count:
+            return
+        try:
+            execute_with_retries(
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={
+                        "requests": [
+                            {
+                                "appendDimension": {
+                                    "sheetId": worksheet.sheet_id,
+                                    "dimension": "COLUMNS",
+                                    "length": column_count - worksheet.column_count,
+                                }
+                            }
+                        ]
+                    },
+                ),
+                config,
+                operation="spreadsheets.batchUpdate.appendDimension",
+            )
+        except HttpError as exc:
+            if refresh or not is_metadata_mismatch_error(exc):
+                raise
+            continue
+        METADATA_CACHE.put_worksheet(spreadsheet_id, replace(worksheet, column_count=column_count))
+        return
+    raise RuntimeError(f"Worksheet {worksheet_title!r} not found")
+
+
 def ensure_worksheet_with_headers(
     service,
     spreadsheet_id: str,
@@ -346,37 +820,134 @@ def ensure_worksheet_with_headers(
     cols: int | None = None,
     rewrite_on_mismatch: bool = False,
 ) -> str:
-    if not headers:
-        raise ValueError("Headers are required")
-
-    info = get_spreadsheet_info(service, spreadsheet_id)
-    normalized_title = sanitize_worksheet_title(worksheet_title)
-    if normalized_title not in info.worksheet_titles:
-        create_worksheet(
-            service,
-            spreadsheet_id,
-            normalized_title,
-            rows=rows,
-            cols=cols or len(headers),
-        )
+    spec = WorksheetSpec(
+        title=worksheet_title,
+        headers=tuple(headers),
+        rows=rows,
+        cols=cols,
+        rewrite_on_mismatch=rewrite_on_mismatch,
+    )
+    return ensure_worksheets_with_headers(service, spreadsheet_id, [spec])[0]
 
-    existing_values = get_sheet_values(service, spreadsheet_id, normalized_title)
-    expected_headers = [str(header) for header in headers]
-    if not existing_values:
-        write_rows(service, spreadsheet_id, normalized_title, [expected_headers])
-        return normalized_title
-
-    current_headers = [str(value).strip() for value in existing_values[0]]
-    if current_headers != expected_headers:
-        if rewrite_on_mismatch:
-            clear_worksheet(service, spreadsheet_id, normalized_title)
-            write_rows(service, spreadsheet_id, normalized_title, [expected_headers])
-            return normalized_title
-        raise RuntimeError(
-            f"Worksheet {normalized_title!r} has unexpected headers. "
-            f"Expected {expected_headers}, got {current_headers}"
-        )
-    return normalized_title
+
+def ensure_worksheets_with_headers(service, spreadsheet_id: str, specs: Sequence[WorksheetSpec]) -> list[str]:
+    # One metadata fetch, one values.batchGet over the header rows and at most one
+    # batchUpdate that creates the missing worksheets and fixes their header rows.
+    for spec in specs:
+        if not spec.headers:
+            raise ValueError("Headers are required")
+
+    config = load_config()
+    titles = [sanitize_worksheet_title(spec.title) for spec in specs]
+    for refresh_attempt in (False, True):
+        info = get_spreadsheet_info(service, spreadsheet_id, refresh=True)
+        existing_titles = [title for title in titles if title in info.worksheet_titles]
+        header_rows: dict[str, list[str]] = {}
+        if existing_titles:
+            response = execute_with_retries(
+                service.spreadsheets().values().batchGet(
+                    spreadsheetId=spreadsheet_id,
+                    ranges=[f"'{title}'!1:1" for title in existing_titles],
+                ),
+                config,
+                operation="spreadsheets.values.batchGet",
+            )
+            for title, value_range in zip(existing_titles, response.get("valueRanges", [])):
+                values = value_range.get("values", [])
+                header_rows[title] = [str(value).strip() for value in values[0]] if values else []
+
+        requests, resized = plan_header_requests(info, specs, titles, header_rows)
+        if not requests:
+            return titles
+        try:
+            response = execute_with_retries(
+                service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": requests}),
+                config,
+                operation="spreadsheets.batchUpdate.headers",
+            )
+        except HttpError as exc:
+            # Another process may have created one of the worksheets meanwhile; plan again.
+            if refresh_attempt or not is_metadata_mismatch_error(exc):
+                raise
+            continue
+
+        for reply in response.get("replies", []):
+            if "addSheet" in reply:
+                remember_added_worksheet(spreadsheet_id, reply)
+        for worksheet in resized:
+            METADATA_CACHE.put_worksheet(spreadsheet_id, worksheet)
+        return titles
+    raise AssertionError("unreachable")
+
+
+def plan_header_requests(
+    info: SpreadsheetInfo,
+    specs: Sequence[WorksheetSpec],
+    titles: Sequence[str],
+    header_rows: dict[str, list[str]],
+) -> tuple[list[dict], list[WorksheetProperties]]:
+    requests: list[dict] = []
+    resized: list[WorksheetProperties] = []
+    # New worksheets get their ids from us, so their header rows fit in the same batchUpdate.
+    next_sheet_id = max((worksheet.sheet_id for worksheet in info.worksheets), default=0) + 1
+    for spec, title in zip(specs, titles):
+        expected_headers = [str(header) for header in spec.headers]
+        worksheet = info.find_worksheet(title)
+        if worksheet is None:
+            requests.append(
+                {
+                    "addSheet": {
+                        "properties": {
+                            "sheetId": next_sheet_id,
+                            "title": title,
+                            "gridProperties": {
+                                "rowCount": spec.rows,
+                                "columnCount": max(spec.cols or 0, len(expected_headers)),
+                            },
+                        }
+                    }
+                }
+            )
+            requests.append(build_header_row_request(next_sheet_id, expected_headers))
+            next_sheet_id += 1
+            continue
+
+        current_headers = header_rows.get(title, [])
+        while current_headers and not current_headers[-1]:
+            current_headers.pop()
+        if current_headers == expected_headers:
+            continue
+        if current_headers != expected_headers[: len(current_headers)]:
+            if not spec.rewrite_on_mismatch:
+                raise RuntimeError(
+                    f"Worksheet {title!r} has unexpected headers. "
+                    f"Expected {expected_headers}, got {current_headers}"
+                )
+            requests.append({"updateCells": {"range": {"sheetId": worksheet.sheet_id}, "fields": "userEnteredValue"}})
+        # Otherwise new columns were added at the end: extend the header row and keep the data.
+        if worksheet.column_count < len(expected_headers):
+            requests.append(
+                {
+                    "appendDimension": {
+                        "sheetId": worksheet.sheet_id,
+                        "dimension": "COLUMNS",
+                        "length": len(expected_headers) - worksheet.column_count,
+                    }
+                }
+            )
+            resized.append(replace(worksheet, column_count=len(expected_headers)))
+        requests.append(build_header_row_request(worksheet.sheet_id, expected_headers))
+    return requests, resized
+
+
+def build_header_row_request(sheet_id: int, headers: Sequence[str]) -> dict:
+    return {
+        "updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": header}} for header in headers]}],
+            "fields": "userEnteredValue",
+        }
+    }
 
 
 def append_dict_row(
@@ -413,9 +984,58 @@ def update_dict_row(
 
 def create_worksheet(service, spreadsheet_id: str, title: str, *, rows: int = 1000, cols: int = 26) -> str:
     config = load_config()
-    info = get_spreadsheet_info(service, spreadsheet_id)
-    worksheet_title = make_unique_worksheet_title(info.worksheet_titles, title)
-    request_body = {
+    # The title is picked from the cached list; if someone took it meanwhile, refresh and pick again.
+    for refresh in (False, True):
+        info = get_spreadsheet_info(service, spreadsheet_id, refresh=refresh)
+        worksheet_title = make_unique_worksheet_title(info.worksheet_titles, title)
+        try:
+            response = execute_with_retries(
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body=build_add_sheet_body(worksheet_title, rows=rows, cols=cols),
+                ),
+                config,
+                operation="spreadsheets.batchUpdate.addSheet",
+            )
+        except HttpError as exc:
+            if refresh or not is_metadata_mismatch_error(exc):
+                raise
+            continue
+        return remember_added_worksheet(spreadsheet_id, response["replies"][0]).title
+    raise AssertionError("unreachable")
+
+
+async def create_worksheet_async(
+    service,
+    spreadsheet_id: str,
+    title: str,
+    *,
+    rows: int = 1000,
+    cols: int = 26,
+) -> str:
+    config = load_config()
+    for refresh in (False, True):
+        info = await get_spreadsheet_info_async(service, spreadsheet_id, refresh=refresh)
+        worksheet_title = make_unique_worksheet_title(info.worksheet_titles, title)
+        try:
+            response = await execute_with_retries_async(
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body=build_add_sheet_body(worksheet_title, rows=rows, cols=cols),
+                ),
+                config,
+                operation="spreadsheets.batchUpdate.addSheet",
+            )
+        except HttpError as exc:
+            if refresh or not is_metadata_mismatch_error(exc):
+                raise
+            continue
+        return remember_added_worksheet(spreadsheet_id, response["replies"][0]).title
+    raise AssertionError("unreachable")
+
+
+def build_add_sheet_body(worksheet_title: str, *, rows: int, cols: int) -> dict:
+    return {
         "requests": [
             {
                 "addSheet": {
@@ -430,38 +1050,97 @@ def create_worksheet(service, spreadsheet_id: str, title: str, *, rows: int = 10
             }
         ]
     }
-    execute_with_retries(
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body=request_body,
-        ),
-        config,
-        operation="spreadsheets.batchUpdate.addSheet",
+
+
+def build_write_rows_request(
+    service,
+    spreadsheet_id: str,
+    worksheet_title: str,
+    rows: list[list[str]],
+    *,
+    start_row: int = 1,
+):
+    return service.spreadsheets().values().update(
+        spreadsheetId=spreadsheet_id,
+        range=f"'{worksheet_title}'!A{start_row}",
+        valueInputOption="RAW",
+        body={"values": rows},
     )
-    return worksheet_title
 
 
 def write_rows(service, spreadsheet_id: str, worksheet_title: str, rows: Iterable[Sequence[str | None]]) -> None:
     config = load_config()
-    normalized_rows = [
-        ["" if value is None else str(value) for value in row]
-        for row in rows
-    ]
+    normalized_rows = normalize_rows(rows)
     if not normalized_rows:
         return
 
     execute_with_retries(
-        service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f"'{worksheet_title}'!A1",
-            valueInputOption="RAW",
-            body={"values": normalized_rows},
-        ),
+        build_write_rows_request(service, spreadsheet_id, worksheet_title, normalized_rows),
         config,
         operation="spreadsheets.values.update",
     )
 
 
+async def write_rows_in_chunks_async(
+    service,
+    spreadsheet_id: str,
+    worksheet_title: str,
+    rows: Sequence[Sequence[str | None]],
+    *,
+    chunk_rows: int,
+    parallel: int,
+    skip_chunks: Iterable[int] = (),
+    on_chunk_written: Callable[[int], None] | None = None,
+    max_request_rows: int | None = None,
+) -> int:
+    # Every chunk goes to its own fixed range, so chunks can be written in parallel
+    # and in any order, and an interrupted export only repeats the missing chunks.
+    # Consecutive missing chunks are merged into requests of up to max_request_rows,
+    # so small chunks left over from a streaming export do not cost a request each.
+    config = load_config()
+    chunk_rows = max(1, chunk_rows)
+    chunk_count = (len(rows) + chunk_rows - 1) // chunk_rows
+    max_chunks = max(1, (max_request_rows or chunk_rows) // chunk_rows)
+    # Each chunk is sent through the HTTP connection of the executor thread that
+    # runs it (see ThreadLocalHttpRequest), so parallel chunks never share a
+    # socket; more chunks than executor threads would only queue behind each other.
+    limit = asyncio.Semaphore(max(1, min(parallel, get_sheets_max_workers())))
+    written = set(skip_chunks)
+    runs: list[list[int]] = []
+    for index in range(chunk_count):
+        if index in written:
+            continue
+        if runs and runs[-1][-1] == index - 1 and len(runs[-1]) < max_chunks:
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+
+    async def write_run(run: list[int]) -> None:
+        start = run[0] * chunk_rows
+        async with limit:
+            await execute_with_retries_async(
+                build_write_rows_request(
+                    service,
+                    spreadsheet_id,
+                    worksheet_title,
+                    normalize_rows(rows[start:(run[-1] + 1) * chunk_rows]),
+                    start_row=start + 1,
+                ),
+                config,
+                operation="spreadsheets.values.update.chunk",
+            )
+        if on_chunk_written is not None:
+            for index in run:
+                on_chunk_written(index)
+
+    results = await asyncio.gather(*(write_run(run) for run in runs), return_exceptions=True)
+    # Let every chunk finish first, so the ones that did get written are remembered.
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return chunk_count
+
+
 def append_table(
     service,
     spreadsheet_id: str,
@@ -0,0 +1,202 @@
+import math
+from dataclasses import dataclass
+from typing import Sequence
+
+import latency_history
+
+MIN_ROW_SAMPLES = 3
+P90_Z_SCORE = 1.2816
+PROGRESS_BAR_WIDTH = 16
+
+# Telegram requests a row can be charged for: phone summary only, or INN lookup + phone summary.
+MAX_ROW_CHARGE = {
+    "phone": 1,
+    "company": 2,
+    "ip": 2,
+}
+
+# Pipeline stages each row type goes through, used when a row type has no own history yet.
+ROW_STAGES = {
+    "phone": ("phone_summary",),
+    "company": ("company_flow", "phone_summary"),
+    "ip": ("ip_web_flow", "phone_summary"),
+}
+
+
+@dataclass(frozen=True)
+class JobEstimate:
+    rows_total: int
+    rows_done: int
+    p50_seconds: float
+    p90_seconds: float
+    expected_charge: int
+    max_charge: int
+    # Bot dialog time the remaining rows still need; the gate runs one dialog at a time.
+    gate_seconds: float = 0.0
+
+
+def sample_stats(samples: list[float]) -> tuple[float, float]:
+    mean = sum(samples) / len(samples)
+    variance = sum((value - mean) ** 2 for value in samples) / len(samples)
+    return mean, variance
+
+
+def row_seconds_stats(
+    history: latency_history.LatencyHistory,
+    entity_type: str,
+    *,
+    step_delay_seconds: int,
+) -> tuple[float, float]:
+    samples = history.get_samples(latency_history.row_key(entity_type))
+    if len(samples) >= MIN_ROW_SAMPLES:
+        return sample_stats(samples)
+
+    stages = ROW_STAGES.get(entity_type, ROW_STAGES["company"])
+    stage_samples = [history.get_samples(latency_history.stage_key(stage)) for stage in stages]
+    if all(len(values) >= MIN_ROW_SAMPLES for values in stage_samples):
+        stage_stats = [sample_stats(values) for values in stage_samples]
+        mean = sum(item[0] for item in stage_stats) + step_delay_seconds * len(stages)
+        variance = sum(item[1] for item in stage_stats)
+        return mean, variance
+
+    mean = latency_history.expected_row_seconds(history, entity_type)
+    return mean, (mean / 2) ** 2
+
+
+def gate_seconds_stats(history: latency_history.LatencyHistory, entity_types: list[str]) -> tuple[float, float]:
+    # Every stage of a row is one bot dialog, and dialogs of all rows and jobs
+    # share one gate, so this part of the work does not shrink with more workers.
+    samples = history.get_samples(latency_history.gate_key())
+    if len(samples) < MIN_ROW_SAMPLES:
+        return 0.0, 0.0
+    mean, variance = sample_stats(samples)
+    dialogs = sum(len(ROW_STAGES.get(entity_type, ROW_STAGES["company"])) for entity_type in entity_types)
+    return mean * dialogs, variance * dialogs
+
+
+def expected_row_charge(history: latency_history.LatencyHistory, entity_type: str) -> float:
+    max_charge = MAX_ROW_CHARGE.get(entity_type, MAX_ROW_CHARGE["company"])
+    return history.mean(latency_history.charge_key(entity_type), float(max_charge))
+
+
+def estimate_rows_seconds(
+    history: latency_history.LatencyHistory,
+    entity_types: list[str],
+    *,
+    concurrency: int,
+    row_delay_seconds: int,
+    step_delay_seconds: int,
+    other_jobs_gate_seconds: Sequence[float] = (),
+) -> tuple[float, float, float]:
+    if not entity_types:
+        return 0.0, 0.0, 0.0
+
+    total_mean = 0.0
+    total_variance = 0.0
+    for entity_type in entity_types:
+        mean, variance = row_seconds_stats(history, entity_type, step_delay_seconds=step_delay_seconds)
+        total_mean += mean + row_delay_seconds
+        total_variance += variance
+
+    # Rows of one job are spread across the workers, so wall-clock time is roughly
+    # the total work divided by the number of workers.
+    workers = max(1, min(concurrency, len(entity_types)))
+    p50 = total_mean / workers
+    p90 = (total_mean + P90_Z_SCORE * math.sqrt(total_variance)) / workers
+
+    # The gate is shared like a processor: while another job still has dialogs
+    # left, every one of ours waits for one of its, so each other job adds at most
+    # as much gate time as this job needs itself.
+    gate_mean, gate_variance = gate_seconds_stats(history, entity_types)
+    shared_gate = sum(min(other, gate_mean) for other in other_jobs_gate_seconds)
+    p50 = max(p50, gate_mean + shared_gate)
+    p90 = max(p90, gate_mean + shared_gate + P90_Z_SCORE * math.sqrt(gate_variance))
+    return p50, p90, gate_mean
+
+
+def estimate_job(
+    history: latency_history.LatencyHistory,
+    remaining_entity_types: list[str],
+    *,
+    rows_total: int,
+    concurrency: int,
+    row_delay_seconds: int,
+    step_delay_seconds: int,
+    charged_so_far: int = 0,
+    max_charge: int | None = None,
+    other_jobs_gate_seconds: Sequence[float] = (),
+) -> JobEstimate:
+    p50, p90, gate_seconds = estimate_rows_seconds(
+        history,
+        remaining_entity_types,
+        concurrency=concurrency,
+        row_delay_seconds=row_delay_seconds,
+        step_delay_seconds=step_delay_seconds,
+        other_jobs_gate_seconds=other_jobs_gate_seconds,
+    )
+    expected_charge = charged_so_far + sum(
+        expected_row_charge(history, entity_type)
+        for entity_type in remaining_entity_types
+    )
+    if max_charge is None:
+        max_charge = charged_so_far + sum(
+            MAX_ROW_CHARGE.get(entity_type, MAX_ROW_CHARGE["company"])
+            for entity_type in remaining_entity_types
+        )
+    return JobEstimate(
+        rows_total=rows_total,
+        rows_done=rows_total - len(remaining_entity_types),
+        p50_seconds=p50,
+        p90_seconds=p90,
+        expected_charge=min(max_charge, round(expected_charge)),
+        max_charge=max_charge,
+        gate_seconds=gate_seconds,
+    )
+
+
+def format_duration(seconds: float) -> str:
+    total_seconds = max(0, int(round(seconds)))
+    if total_seconds < 60:
+        return f"{total_seconds} сек"
+    total_minutes = math.ceil(total_seconds / 60)
+    if total_minutes < 60:
+        return f"{total_minutes} мин"
+    hours, minutes = divmod(total_minutes, 60)
+    return f"{hours} ч {minutes:02d} мин"
+
+
+def format_estimate(estimate: JobEstimate) -> str:
+    if estimate.rows_done >= estimate.rows_total:
+        time_line = "Осталось: почти готово"
+    elif estimate.rows_done == 0:
+        time_line = (
+            f"Ожидаемое время: ~{format_duration(estimate.p50_seconds)} "
+            f"(p90 до {format_duration(estimate.p90_seconds)})"
+        )
+    else:
+        time_line = (
+            f"Осталось: ~{format_duration(estimate.p50_seconds)} "
+            f"(p90 до {format_duration(estimate.p90_seconds)})"
+        )
+    charge_line = (
+        f"Ожидаемое списание: ~{estimate.expected_charge} запросов "
+        f"(максимум {estimate.max_charge})"
+    )
+    return f"{time_line}\n{charge_line}"
+
+
+def format_progress_bar(rows_done: int, rows_total: int, *, width: int = PROGRESS_BAR_WIDTH) -> str:
+    share = rows_done / rows_total if rows_total > 0 else 1.0
+    filled = min(width, int(share * width))
+    return f"[{'█' * filled}{'░' * (width - filled)}] {rows_done}/{rows_total} ({int(share * 100)}%)"
+
+
+def format_throughput(rows_done: int, elapsed_seconds: float, rows_left: int) -> str | None:
+    # Observed speed of this run; resumed rows are not counted since they took no time now.
+    if rows_done <= 0 or elapsed_seconds <= 0:
+        return None
+    rows_per_second = rows_done / elapsed_seconds
+    line = f"Скорость: {rows_per_second * 60:.1f} строк/мин"
+    if rows_left > 0:
+        line = f"{line}, в этом темпе осталось ~{format_duration(rows_left / rows_per_second)}"
+    return line
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+
+@dataclass(eq=False)
+class QueuedJob:
+    job_id: str
+    chat_id: int
+    message: dict
+    file_name: str
+    client_config: dict
+    status_message_id: int | None = None
+    # Status from the job store; anything but "queued" means the job is resumed after a restart.
+    stored_status: str = "queued"
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    # Latest estimate of the running job, read by the queue to predict waits.
+    remaining_seconds: float | None = None
+    remaining_gate_seconds: float = 0.0
+    # Set once the admission reply is sent. A worker that takes the job earlier
+    # waits for it, so that reply becomes the job's status message.
+    acknowledged: asyncio.Event | None = None
+
+    @property
+    def queue_wait_seconds(self) -> float:
+        if self.started_at is None:
+            return time.monotonic() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+
+@dataclass
+class JobQueue:
+    workers: int
+    items: asyncio.Queue = field(default_factory=asyncio.Queue)
+    pending: deque[QueuedJob] = field(default_factory=deque)
+    active: list[QueuedJob] = field(default_factory=list)
+
+    @property
+    def running(self) -> int:
+        return len(self.active)
+
+    def submit(self, job: QueuedJob) -> int:
+        # Returns the queue position; 0 means a worker is free and the job starts
+        # right away. Counted together with the append, so two jobs admitted at
+        # the same time never get the same position.
+        self.pending.append(job)
+        self.items.put_nowait(job)
+        free_workers = max(0, self.workers - self.running)
+        return max(0, len(self.pending) - free_workers)
+
+    def estimate_start_seconds(self, position: int) -> float | None:
+        # A job at position N starts roughly when the N-th running job finishes.
+        # None while too few running jobs have an estimate to tell.
+        if position <= 0:
+            return 0.0
+        remaining = sorted(job.remaining_seconds for job in self.active if job.remaining_seconds is not None)
+        if position > len(remaining):
+            return None
+        return remaining[position - 1]
+
+    def other_jobs_gate_seconds(self, job: QueuedJob) -> list[float]:
+        return [other.remaining_gate_seconds for other in self.active if other is not job]
+
+    async def get(self) -> QueuedJob:
+        job = await self.items.get()
+        self.pending.remove(job)
+        self.active.append(job)
+        job.started_at = time.monotonic()
+        return job
+
+    def done(self, job: QueuedJob) -> None:
+        self.active.remove(job)
+        self.items.task_done()
+
+
+async def job_worker(
+    queue: JobQueue,
+    handle: Callable[[QueuedJob], Awaitable[None]],
+    log: logging.Logger,
+) -> None:
+    while True:
+        job = await queue.get()
+        try:
+            if job.acknowledged is not None:
+                await job.acknowledged.wait()
+            log.info(
+                "Starting job for chat %s: %s (waited %.1fs in queue)",
+                job.chat_id,
+                job.file_name,
+                job.queue_wait_seconds,
+            )
+            await handle(job)
+        except Exception:
+            log.exception("Job failed for chat %s: %s", job.chat_id, job.file_name)
+        finally:
+            queue.done(job)
+
+
+def start_job_workers(
+    queue: JobQueue,
+    handle: Callable[[QueuedJob], Awaitable[None]],
+    log: logging.Logger,
+) -> list[asyncio.Task]:
+    return [asyncio.create_task(job_worker(queue, handle, log)) for _ in range(max(1, queue.workers))]
@@ -0,0 +1,292 @@
+import json
+import os
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+
+import client_registry
+
+# queued -> running -> billed -> completed, or failed at any point.
+UNFINISHED_STATUSES = ("queued", "running", "billed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    file_name TEXT NOT NULL,
+    message_json TEXT NOT NULL,
+    client_json TEXT NOT NULL,
+    status TEXT NOT NULL,
+    status_message_id INTEGER,
+    input_path TEXT,
+    rows_total INTEGER,
+    rows_done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS job_rows (
+    job_id TEXT NOT NULL,
+    row_index INTEGER NOT NULL,
+    row_json TEXT NOT NULL,
+    PRIMARY KEY (job_id, row_index)
+);
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seen_messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS seen_messages_seen_at ON seen_messages (seen_at);
+CREATE TABLE IF NOT EXISTS job_exports (
+    job_id TEXT PRIMARY KEY,
+    worksheet_title TEXT NOT NULL,
+    chunk_rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_export_chunks (
+    job_id TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    PRIMARY KEY (job_id, chunk_index)
+);
+CREATE TABLE IF NOT EXISTS pending_admissions (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    message_json TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (job_id, event)
+);
+"""
+
+
+@dataclass(frozen=True)
+class StoredJob:
+    job_id: str
+    chat_id: int
+    file_name: str
+    message: dict
+    client: dict
+    status: str
+    status_message_id: int | None
+    created_at: str
+
+
+@dataclass(frozen=True)
+class StoredExport:
+    worksheet_title: str
+    chunk_rows: int
+    chunks_done: frozenset[int]
+
+
+@dataclass
+class JobStore:
+    path: Path
+    connection: sqlite3.Connection
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self.connection:
+            return self.connection.execute(sql, params)
+
+    def create_job(
+        self,
+        job_id: str,
+        *,
+        chat_id: int,
+        message: dict,
+        file_name: str,
+        client: dict,
+    ) -> None:
+        now = client_registry.now_timestamp()
+        # The job replaces the pending admission of its message in one transaction.
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO jobs (
+                    job_id, chat_id, message_id, file_name, message_json, client_json,
+                    status, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+                """,
+                (
+                    job_id,
+                    chat_id,
+                    message.get("message_id"),
+                    file_name,
+                    json.dumps(message, ensure_ascii=False),
+                    json.dumps(client, ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            )
+            self.connection.execute(
+                "DELETE FROM pending_admissions WHERE chat_id = ? AND message_id = ?",
+                (chat_id, message.get("message_id")),
+            )
+
+    def update_job(self, job_id: str, **values: object) -> None:
+        if not values:
+            return
+        values["updated_at"] = client_registry.now_timestamp()
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        self.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*values.values(), job_id))
+
+    def save_row(self, job_id: str, row_index: int, row: dict[str, str | None]) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO job_rows (job_id, row_index, row_json) VALUES (?, ?, ?)",
+                (job_id, row_index, json.dumps(row, ensure_ascii=False)),
+            )
+            self.connection.execute(
+                """
+                UPDATE jobs
+                SET rows_done = (SELECT COUNT(*) FROM job_rows WHERE job_id = ?), updated_at = ?
+                WHERE job_id = ?
+                """,
+                (job_id, client_registry.now_timestamp(), job_id),
+            )
+
+    def load_rows(self, job_id: str) -> dict[int, dict[str, str | None]]:
+        cursor = self.execute("SELECT row_index, row_json FROM job_rows WHERE job_id = ?", (job_id,))
+        return {row_index: json.loads(row_json) for row_index, row_json in cursor.fetchall()}
+
+    def start_export(self, job_id: str, worksheet_title: str, chunk_rows: int) -> None:
+        self.execute(
+            "INSERT OR REPLACE INTO job_exports (job_id, worksheet_title, chunk_rows) VALUES (?, ?, ?)",
+            (job_id, worksheet_title, chunk_rows),
+        )
+
+    def mark_export_chunk(self, job_id: str, chunk_index: int) -> None:
+        self.execute(
+            "INSERT OR IGNORE INTO job_export_chunks (job_id, chunk_index) VALUES (?, ?)",
+            (job_id, chunk_index),
+        )
+
+    def get_export(self, job_id: str) -> StoredExport | None:
+        row = self.execute(
+            "SELECT worksheet_title, chunk_rows FROM job_exports WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        cursor = self.execute("SELECT chunk_index FROM job_export_chunks WHERE job_id = ?", (job_id,))
+        return StoredExport(
+            worksheet_title=row[0],
+            chunk_rows=row[1],
+            chunks_done=frozenset(chunk_index for (chunk_index,) in cursor.fetchall()),
+        )
+
+    def has_event(self, job_id: str, event: str) -> bool:
+        row = self.execute("SELECT 1 FROM job_events WHERE job_id = ? AND event = ?", (job_id, event)).fetchone()
+        return row is not None
+
+    def record_event(self, job_id: str, event: str) -> None:
+        self.execute("INSERT OR IGNORE INTO job_events (job_id, event) VALUES (?, ?)", (job_id, event))
+
+    def list_unfinished(self) -> list[StoredJob]:
+        placeholders = ", ".join("?" for _ in UNFINISHED_STATUSES)
+        cursor = self.execute(
+            f"""
+            SELECT job_id, chat_id, file_name, message_json, client_json, status, status_message_id, created_at
+            FROM jobs
+            WHERE status IN ({placeholders})
+            ORDER BY created_at, job_id
+            """,
+            UNFINISHED_STATUSES,
+        )
+        return [
+            StoredJob(
+                job_id=job_id,
+                chat_id=chat_id,
+                file_name=file_name,
+                message=json.loads(message_json),
+                client=json.loads(client_json),
+                status=status,
+                status_message_id=status_message_id,
+                created_at=created_at,
+            )
+            for job_id, chat_id, file_name, message_json, client_json, status, status_message_id, created_at
+            in cursor.fetchall()
+        ]
+
+    def get_update_offset(self) -> int | None:
+        row = self.execute("SELECT value FROM bot_state WHERE key = 'update_offset'").fetchone()
+        return int(row[0]) if row else None
+
+    def record_update(
+        self,
+        offset: int,
+        message_key: tuple[int, int] | None,
+        *,
+        seen_at: float,
+        keep_since: float,
+        pending_message: dict | None = None,
+    ) -> None:
+        # Offset and dedupe entry are written in one transaction, so after a restart
+        # the bot resumes right after the last handled update and still knows it.
+        # A document is recorded as a pending admission in the same transaction:
+        # the update is never read again, so the admission must survive a crash.
+        with self.connection:
+            if pending_message is not None:
+                self.connection.execute(
+                    """
+                    INSERT OR REPLACE INTO pending_admissions (chat_id, message_id, message_json, created_at)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (
+                        pending_message["chat"]["id"],
+                        pending_message["message_id"],
+                        json.dumps(pending_message, ensure_ascii=False),
+                        client_registry.now_timestamp(),
+                    ),
+                )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO bot_state (key, value) VALUES ('update_offset', ?)",
+                (str(offset),),
+            )
+            if message_key is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO seen_messages (chat_id, message_id, seen_at) VALUES (?, ?, ?)",
+                    (*message_key, seen_at),
+                )
+            self.connection.execute("DELETE FROM seen_messages WHERE seen_at < ?", (keep_since,))
+
+    def finish_admission(self, chat_id: int, message_id: int) -> None:
+        self.execute("DELETE FROM pending_admissions WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+    def list_pending_admissions(self) -> list[dict]:
+        cursor = self.execute("SELECT message_json FROM pending_admissions ORDER BY created_at")
+        return [json.loads(message_json) for (message_json,) in cursor.fetchall()]
+
+    def load_seen_messages(self, since: float) -> list[tuple[tuple[int, int], float]]:
+        cursor = self.execute(
+            "SELECT chat_id, message_id, seen_at FROM seen_messages WHERE seen_at >= ?",
+            (since,),
+        )
+        return [((chat_id, message_id), seen_at) for chat_id, message_id, seen_at in cursor.fetchall()]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def get_job_store_path() -> Path:
+    raw = os.getenv("TG_BOT_STATE_DB", "tg_bot_state.sqlite3").strip()
+    return Path(raw or "tg_bot_state.sqlite3")
+
+
+def open_job_store(path: Path | None = None) -> JobStore:
+    store_path = path or get_job_store_path()
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(store_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return JobStore(path=store_path, connection=connection)
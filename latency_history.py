@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+MAX_SAMPLES_PER_KEY = 200
+
+# Rough per-row costs used until enough real history is collected.
+DEFAULT_ROW_SECONDS = {
+    "phone": 20.0,
+    "company": 60.0,
+    "ip": 45.0,
+}
+
+
+@dataclass
+class LatencyHistory:
+    path: Path
+    samples: dict[str, list[float]] = field(default_factory=dict)
+
+    def record(self, key: str, seconds: float) -> None:
+        values = self.samples.setdefault(key, [])
+        values.append(round(max(0.0, seconds), 3))
+        if len(values) > MAX_SAMPLES_PER_KEY:
+            del values[: len(values) - MAX_SAMPLES_PER_KEY]
+
+    def get_samples(self, key: str) -> list[float]:
+        return list(self.samples.get(key, []))
+
+    def mean(self, key: str, default: float) -> float:
+        values = self.samples.get(key)
+        if not values:
+            return default
+        return sum(values) / len(values)
+
+    def quantile(self, key: str, q: float, default: float) -> float:
+        values = self.samples.get(key)
+        if not values:
+            return default
+        ordered = sorted(values)
+        position = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+        return ordered[position]
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps({"samples": self.samples}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+
+def row_key(entity_type: str) -> str:
+    return f"row:{entity_type}"
+
+
+def stage_key(stage: str) -> str:
+    return f"stage:{stage}"
+
+
+def charge_key(entity_type: str) -> str:
+    return f"charge:{entity_type}"
+
+
+def gate_key() -> str:
+    # One bot dialog holding the conversation gate; only one runs at a time.
+    return "gate:hold"
+
+
+def expected_row_seconds(history: LatencyHistory, entity_type: str) -> float:
+    return history.mean(row_key(entity_type), DEFAULT_ROW_SECONDS.get(entity_type, DEFAULT_ROW_SECONDS["company"]))
+
+
+def get_history_path() -> Path:
+    raw = os.getenv("PIPELINE_LATENCY_HISTORY_FILE", "pipeline_latency_history.json").strip()
+    return Path(raw or "pipeline_latency_history.json")
+
+
+def load_history(path: Path | None = None, *, log: logging.Logger | None = None) -> LatencyHistory:
+    history_path = path or get_history_path()
+    if not history_path.exists():
+        return LatencyHistory(path=history_path)
+
+    try:
+        data = json.loads(history_path.read_text(encoding="utf-8"))
+        samples = {
+            str(key): [float(value) for value in values][-MAX_SAMPLES_PER_KEY:]
+            for key, values in (data.get("samples") or {}).items()
+        }
+    except (OSError, ValueError, TypeError, AttributeError) as exc:
+        (log or logging.getLogger("latency_history")).warning(
+            "Failed to read latency history %s: %s. Starting with empty history",
+            history_path,
+            exc,
+        )
+        return LatencyHistory(path=history_path)
+    return LatencyHistory(path=history_path, samples=samples)
+
+
+def save_history(history: LatencyHistory, *, log: logging.Logger | None = None) -> None:
+    try:
+        history.save()
+    except OSError as exc:
+        (log or logging.getLogger("latency_history")).warning("Failed to save latency history %s: %s", history.path, exc)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import run_pipeline
+
+
+@dataclass
+class PartialResults:
+    # Collects rows as they finish, in completion order, and turns every batch
+    # into a small xlsx of its own, so a part never re-reads the rows sent before
+    # it and slow early rows do not hold back the fast ones. Parts are uploaded by
+    # a background task, so finished rows never wait for the Bot API.
+    output_xlsx: Path
+    rows_total: int
+    every_rows: int
+    every_seconds: float
+    deliver: Callable[[Path, str], Awaitable[None]]
+    log: logging.Logger
+    # Rows done so far, including the ones finished before a restart.
+    rows_done: int = 0
+    pending: list[tuple[int, dict[str, str | None]]] = field(default_factory=list)
+    parts: list[int] = field(default_factory=list)
+    last_delivery_at: float = field(default_factory=time.monotonic)
+    task: asyncio.Task | None = None
+    timer: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.every_rows > 0 or self.every_seconds > 0
+
+    def add(self, index: int, row: dict[str, str | None]) -> None:
+        self.pending.append((index, row))
+        self.rows_done += 1
+
+    def is_due(self, now: float) -> bool:
+        if not self.pending or self.rows_done >= self.rows_total:
+            # The last rows go out with the full result file instead.
+            return False
+        if self.every_rows > 0 and len(self.pending) >= self.every_rows:
+            return True
+        return self.every_seconds > 0 and now - self.last_delivery_at >= self.every_seconds
+
+    def poke(self) -> None:
+        # Called after every finished row; one upload runs at a time.
+        if self.task is not None and not self.task.done():
+            return
+        if self.is_due(time.monotonic()):
+            self.task = asyncio.create_task(self.deliver_due())
+
+    def start(self) -> None:
+        # Rows finishing are not the only trigger: with slow rows or a long
+        # FloodWait the every-M-minutes part must still go out on time.
+        if self.every_seconds > 0 and self.timer is None:
+            self.timer = asyncio.create_task(self.run_timer())
+
+    async def run_timer(self) -> None:
+        while True:
+            wait = self.last_delivery_at + self.every_seconds - time.monotonic()
+            await asyncio.sleep(max(1.0, wait))
+            self.poke()
+
+    async def deliver_due(self) -> None:
+        now = time.monotonic()
+        if not self.is_due(now):
+            return
+
+        batch, self.pending = self.pending, []
+        self.last_delivery_at = now
+        batch.sort(key=lambda item: item[0])
+        part_number = len(self.parts) + 1
+        part_path = self.output_xlsx.with_name(f"{self.output_xlsx.stem}_part{part_number:02d}.xlsx")
+        try:
+            await asyncio.to_thread(run_pipeline.write_pipeline_results_xlsx, part_path, [row for _, row in batch])
+            await self.deliver(
+                part_path,
+                f"Промежуточный результат, часть {part_number}: {len(batch)} новых строк, "
+                f"готово {self.rows_done} из {self.rows_total}",
+            )
+        except Exception:
+            self.log.exception("Failed to deliver partial result %s", part_path)
+            # Keep the rows for the next part, so no finished row is skipped.
+            self.pending = batch + self.pending
+            return
+        self.parts.append(len(batch))
+
+    async def close(self) -> None:
+        # Lets an upload in progress finish before the full result file is sent.
+        if self.timer is not None:
+            self.timer.cancel()
+            await asyncio.gather(self.timer, return_exceptions=True)
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def describe(self) -> str | None:
+        if not self.parts:
+            return None
+        return (
+            f"Промежуточных файлов отправлено: {len(self.parts)} "
+            f"(строк в них: {sum(self.parts)}); этот файл содержит все строки."
+        )
@@ -0,0 +1,253 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+from telethon.errors import FloodWaitError
+
+import row_trace
+
+METRIC_HELP = {
+    "pipeline_stage_duration_seconds": ("histogram", "Duration of pipeline stages in seconds"),
+    "pipeline_stage_requests_total": ("counter", "Pipeline stage calls by outcome"),
+    "pipeline_stage_timeouts_total": ("counter", "Pipeline stage calls that ended with a timeout"),
+    "telegram_flood_waits_total": ("counter", "FloodWait errors returned by Telegram"),
+    "google_sheets_retries_total": ("counter", "Retried Google Sheets API calls"),
+    "google_sheets_quota_delayed_total": ("counter", "Google Sheets calls held back by the quota scheduler"),
+    "google_sheets_quota_wait_seconds": ("histogram", "Time Google Sheets calls waited for quota"),
+    "google_sheets_coalesced_total": ("counter", "Google Sheets reads served by an identical read in flight"),
+    "google_sheets_circuit_transitions_total": ("counter", "Google Sheets circuit breaker state changes"),
+    "client_registry_stale_lookups_total": ("counter", "Access checks served from the cached registry during an outage"),
+    "cache_hits_total": ("counter", "Cache lookups served from memory"),
+    "cache_misses_total": ("counter", "Cache lookups that needed a refresh"),
+}
+
+
+def build_log_linear_buckets(lowest: float, highest: float, *, sub_buckets: int) -> tuple[float, ...]:
+    # HDR-style layout: power-of-two ranges, each split into equal linear steps,
+    # which keeps the relative error of every bucket roughly constant.
+    bounds: list[float] = []
+    range_start = lowest
+    while range_start < highest:
+        step = range_start / sub_buckets
+        for position in range(1, sub_buckets + 1):
+            bounds.append(round(range_start + step * position, 6))
+        range_start *= 2
+    return tuple(bounds)
+
+
+DURATION_BUCKETS = build_log_linear_buckets(0.005, 1200.0, sub_buckets=4)
+
+
+@dataclass
+class Histogram:
+    bounds: tuple[float, ...]
+    counts: list[int] = field(default_factory=list)
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        if not self.counts:
+            self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+@dataclass
+class StageObservation:
+    outcome: str = "ok"
+
+
+_lock = threading.Lock()
+_counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+_histograms: dict[str, dict[tuple[tuple[str, str], ...], Histogram]] = {}
+
+
+def label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def inc_counter(name: str, amount: float = 1.0, **labels: str) -> None:
+    key = label_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0.0) + amount
+
+
+def observe_histogram(name: str, value: float, **labels: str) -> None:
+    key = label_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = Histogram(bounds=DURATION_BUCKETS)
+            series[key] = histogram
+        histogram.observe(value)
+
+
+def record_cache_lookup(cache: str, *, hit: bool) -> None:
+    inc_counter("cache_hits_total" if hit else "cache_misses_total", cache=cache)
+
+
+def record_stage(stage: str, seconds: float, outcome: str, **labels: str) -> None:
+    observe_histogram("pipeline_stage_duration_seconds", seconds, stage=stage, **labels)
+    inc_counter("pipeline_stage_requests_total", stage=stage, outcome=outcome, **labels)
+    if outcome == "timeout":
+        inc_counter("pipeline_stage_timeouts_total", stage=stage, **labels)
+    elif outcome == "flood_wait":
+        inc_counter("telegram_flood_waits_total", stage=stage, **labels)
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str, *, span_attrs: dict | None = None, **labels: str):
+    # Every timed stage is also a span of the current row trace; span_attrs go
+    # only to the trace, since values like button labels would blow up label sets.
+    observation = StageObservation()
+    started_at = time.perf_counter()
+    with row_trace.span(stage, **labels, **(span_attrs or {})) as trace_span:
+        try:
+            yield observation
+        except FloodWaitError:
+            observation.outcome = "flood_wait"
+            raise
+        except (asyncio.TimeoutError, TimeoutError):
+            observation.outcome = "timeout"
+            raise
+        except asyncio.CancelledError:
+            observation.outcome = "cancelled"
+            raise
+        except Exception:
+            observation.outcome = "error"
+            raise
+        finally:
+            record_stage(stage, time.perf_counter() - started_at, observation.outcome, **labels)
+            if trace_span is not None:
+                trace_span.outcome = observation.outcome
+
+
+def timed_stage(stage: str, *, outcome_of: Callable | None = None, **labels: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage_timer(stage, **labels) as observation:
+                result = await func(*args, **kwargs)
+                if outcome_of is not None:
+                    observation.outcome = outcome_of(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def response_outcome(result: tuple) -> str:
+    # wait_for_* helpers return (kind, payload), and (None, None) when the bot stayed silent.
+    kind = result[0] if result else None
+    return kind or "timeout"
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key: tuple[tuple[str, str], ...], extra: tuple[tuple[str, str], ...] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def format_number(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render_prometheus() -> str:
+    lines: list[str] = []
+    with _lock:
+        counters = {name: dict(series) for name, series in _counters.items()}
+        histograms = {
+            name: {key: (list(item.counts), item.total, item.count, item.bounds) for key, item in series.items()}
+            for name, series in _histograms.items()
+        }
+
+    for name in sorted(set(counters) | set(histograms)):
+        metric_type, help_text = METRIC_HELP.get(name, ("counter" if name in counters else "histogram", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for key, value in sorted(counters.get(name, {}).items()):
+            lines.append(f"{name}{format_labels(key)} {format_number(value)}")
+        for key, (counts, total, count, bounds) in sorted(histograms.get(name, {}).items()):
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(key, (('le', format_number(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(key)} {format_number(round(total, 6))}")
+            lines.append(f"{name}_count{format_labels(key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def get_metrics_server_config() -> tuple[str, int]:
+    host = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    port = int(os.getenv("METRICS_PORT", "9108").strip() or "9108")
+    return host, port
+
+
+async def handle_metrics_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        while True:
+            header_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            if header_line in (b"\r\n", b"\n", b""):
+                break
+
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+        if len(parts) >= 2 and parts[0] == "GET" and path == "/metrics":
+            status = "200 OK"
+            body = render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+            content_type = "text/plain; charset=utf-8"
+
+        writer.write(
+            (
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(log: logging.Logger) -> asyncio.AbstractServer | None:
+    host, port = get_metrics_server_config()
+    if port <= 0:
+        log.info("Metrics endpoint disabled")
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_connection, host, port)
+    except OSError as exc:
+        log.warning("Failed to start metrics endpoint on %s:%s: %s", host, port, exc)
+        return None
+    log.info("Metrics endpoint: http://%s:%s/metrics", host, port)
+    return server
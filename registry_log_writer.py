@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Sequence
+
+
+@dataclass
+class RegistryLogWriter:
+    # Audit and billing log rows are first appended to a local spool file and then
+    # flushed in the background with one values.append per sheet. A row leaves the
+    # spool only after Sheets accepted it, so a crash or a Sheets outage can repeat
+    # a row but never lose one.
+    spool_path: Path
+    append_rows: Callable[[str, list[list[str]]], Awaitable[None]]
+    log: logging.Logger
+    flush_interval_seconds: float = 5.0
+    # A backlog left by an outage goes out in appends of at most this many rows.
+    max_rows_per_append: int = 2000
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def enqueue(self, worksheet_title: str, values: Sequence[object]) -> None:
+        line = json.dumps(
+            {"sheet": worksheet_title, "values": ["" if value is None else str(value) for value in values]},
+            ensure_ascii=False,
+        )
+        with self.lock:
+            self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.spool_path.open("a", encoding="utf-8") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read_batch(self) -> tuple[int, dict[str, list[list[str]]]]:
+        with self.lock:
+            if not self.spool_path.exists():
+                return 0, {}
+            data = self.spool_path.read_bytes()
+
+        # A line without its newline is still being written; leave it for next time.
+        size = data.rfind(b"\n") + 1
+        batch: dict[str, list[list[str]]] = {}
+        bad_lines: list[bytes] = []
+        for line in data[:size].splitlines():
+            if not line.strip():
+                continue
+            entry = parse_line(line)
+            if entry is None:
+                bad_lines.append(line)
+            else:
+                batch.setdefault(entry[0], []).append(entry[1])
+        if bad_lines:
+            # One damaged line, e.g. from a crash during a write, must not block
+            # every row behind it; it is moved aside for a manual look.
+            self.log.error("Moving %s unreadable registry log lines to %s", len(bad_lines), self.quarantine_path)
+            size = self.commit(size, lambda line: parse_line(line) is None, quarantine=True)
+        return size, batch
+
+    @property
+    def quarantine_path(self) -> Path:
+        return self.spool_path.with_name(f"{self.spool_path.name}.bad")
+
+    def commit(self, size: int, drop: Callable[[bytes], bool], *, quarantine: bool = False) -> int:
+        # Removes the lines matching drop from the first size bytes of the spool
+        # and returns the new size of that part.
+        with self.lock:
+            data = self.spool_path.read_bytes()
+            kept: list[bytes] = []
+            dropped: list[bytes] = []
+            for line in data[:size].splitlines(keepends=True):
+                (dropped if line.strip() and drop(line) else kept).append(line)
+            if quarantine and dropped:
+                with self.quarantine_path.open("ab") as file:
+                    file.write(b"".join(dropped))
+                    file.flush()
+                    os.fsync(file.fileno())
+            head = b"".join(kept)
+            tmp_path = self.spool_path.with_name(f"{self.spool_path.name}.tmp")
+            tmp_path.write_bytes(head + data[size:])
+            os.replace(tmp_path, self.spool_path)
+            return len(head)
+
+    async def flush_once(self) -> int:
+        size, batch = await asyncio.to_thread(self.read_batch)
+        flushed = 0
+        error: Exception | None = None
+        step = max(1, self.max_rows_per_append)
+        for worksheet_title, rows in batch.items():
+            for start in range(0, len(rows), step):
+                chunk = rows[start:start + step]
+                try:
+                    await self.append_rows(worksheet_title, chunk)
+                except Exception as exc:
+                    # Other sheets still go out; the rest of this one stays in the spool.
+                    error = error or exc
+                    break
+                # Committed right away, so a later failure does not send these rows again.
+                size = await asyncio.to_thread(self.commit, size, first_lines_of(worksheet_title, len(chunk)))
+                flushed += len(chunk)
+        if error is not None:
+            raise error
+        return flushed
+
+    async def flush(self) -> None:
+        try:
+            flushed = await self.flush_once()
+        except Exception as exc:
+            self.log.warning("Failed to flush registry logs, keeping them in %s: %s", self.spool_path, exc)
+        else:
+            if flushed:
+                self.log.debug("Flushed %s registry log rows", flushed)
+
+    async def run(self) -> None:
+        while True:
+            await self.flush()
+            await asyncio.sleep(self.flush_interval_seconds)
+
+
+def first_lines_of(worksheet_title: str, count: int) -> Callable[[bytes], bool]:
+    # Matches the first count spool lines of the sheet, i.e. the rows just appended.
+    left = count
+
+    def drop(line: bytes) -> bool:
+        nonlocal left
+        entry = parse_line(line)
+        if left <= 0 or entry is None or entry[0] != worksheet_title:
+            return False
+        left -= 1
+        return True
+
+    return drop
+
+
+def parse_line(line: bytes) -> tuple[str, list[str]] | None:
+    try:
+        entry = json.loads(line)
+        return str(entry["sheet"]), [str(value) for value in entry["values"]]
+    except (ValueError, KeyError, TypeError):
+        return None
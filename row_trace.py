@@ -0,0 +1,215 @@
+import argparse
+import contextlib
+import contextvars
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+TRACE_FILENAME = "traces.jsonl"
+
+
+@dataclass
+class Span:
+    span_id: int
+    parent_id: int | None
+    kind: str
+    started_at: float
+    ended_at: float | None = None
+    outcome: str = "ok"
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict[str, Any]:
+        ended_at = self.ended_at if self.ended_at is not None else time.time()
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start": round(self.started_at, 3),
+            "end": round(ended_at, 3),
+            "duration": round(ended_at - self.started_at, 3),
+            "outcome": self.outcome,
+            "attrs": self.attrs,
+        }
+
+
+@dataclass
+class RowTrace:
+    row_index: int
+    attrs: dict[str, Any]
+    spans: list[Span] = field(default_factory=list)
+
+    def open_span(self, kind: str, parent: Span | None, attrs: dict[str, Any]) -> Span:
+        span = Span(
+            span_id=len(self.spans) + 1,
+            parent_id=parent.span_id if parent is not None else None,
+            kind=kind,
+            started_at=time.time(),
+            attrs=attrs,
+        )
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "row": self.row_index,
+            **self.attrs,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+@dataclass
+class TraceWriter:
+    path: Path
+
+    def write(self, trace: RowTrace) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as file:
+            file.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+
+
+CURRENT_TRACE: contextvars.ContextVar[RowTrace | None] = contextvars.ContextVar("current_trace", default=None)
+CURRENT_SPAN: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+
+@contextlib.contextmanager
+def row_trace(writer: TraceWriter | None, row_index: int, **attrs: Any):
+    if writer is None:
+        yield None
+        return
+
+    trace = RowTrace(row_index=row_index, attrs=attrs)
+    trace_token = CURRENT_TRACE.set(trace)
+    span_token = CURRENT_SPAN.set(None)
+    try:
+        yield trace
+    finally:
+        CURRENT_SPAN.reset(span_token)
+        CURRENT_TRACE.reset(trace_token)
+        writer.write(trace)
+
+
+@contextlib.contextmanager
+def span(kind: str, **attrs: Any):
+    # Outside of a traced row this is a no-op, so the instrumented helpers can be
+    # used from the manual scripts and the Sheets code as well.
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        yield None
+        return
+
+    current = trace.open_span(kind, CURRENT_SPAN.get(), attrs)
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield current
+    except BaseException:
+        if current.outcome == "ok":
+            current.outcome = "error"
+        raise
+    finally:
+        current.ended_at = time.time()
+        CURRENT_SPAN.reset(token)
+
+
+def load_traces(path: Path) -> list[dict[str, Any]]:
+    traces: list[dict[str, Any]] = []
+    with path.open("r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                traces.append(json.loads(line))
+    return traces
+
+
+def critical_path(trace: dict[str, Any]) -> list[dict[str, Any]]:
+    # Spans of one row run one after another, so the chain of the longest child
+    # at every level is where the row spent its time.
+    children: dict[int | None, list[dict[str, Any]]] = {}
+    for item in trace["spans"]:
+        children.setdefault(item["parent_id"], []).append(item)
+
+    path: list[dict[str, Any]] = []
+    level = children.get(None, [])
+    while level:
+        longest = max(level, key=lambda item: item["duration"])
+        path.append(longest)
+        level = children.get(longest["span_id"], [])
+    return path
+
+
+def self_seconds(trace: dict[str, Any]) -> dict[int, float]:
+    result = {item["span_id"]: item["duration"] for item in trace["spans"]}
+    for item in trace["spans"]:
+        if item["parent_id"] in result:
+            result[item["parent_id"]] -= item["duration"]
+    return {span_id: max(0.0, seconds) for span_id, seconds in result.items()}
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))]
+
+
+def format_span(item: dict[str, Any]) -> str:
+    attrs = " ".join(f"{key}={value}" for key, value in item["attrs"].items())
+    suffix = f" [{attrs}]" if attrs else ""
+    return f"{item['kind']} {item['duration']:.1f}s {item['outcome']}{suffix}"
+
+
+def build_report(traces: list[dict[str, Any]], *, top: int) -> str:
+    traces = [trace for trace in traces if trace["spans"]]
+    if not traces:
+        return "No traces found"
+
+    job_started_at = min(item["start"] for trace in traces for item in trace["spans"])
+    last_trace = max(traces, key=lambda trace: max(item["end"] for item in trace["spans"]))
+    last_end = max(item["end"] for item in last_trace["spans"])
+    lines: list[str] = []
+    lines.append(f"Rows: {len(traces)}, job wall time: {last_end - job_started_at:.1f}s")
+    lines.append(f"Critical path (row {last_trace['row']}, {last_trace.get('source_name', '')}):")
+    for depth, item in enumerate(critical_path(last_trace)):
+        lines.append(f"{'  ' * (depth + 1)}{format_span(item)}")
+
+    durations: dict[str, list[float]] = {}
+    self_totals: dict[str, float] = {}
+    leaves: list[tuple[dict[str, Any], dict[str, Any]]] = []
+    for trace in traces:
+        own_seconds = self_seconds(trace)
+        parent_ids = {item["parent_id"] for item in trace["spans"]}
+        for item in trace["spans"]:
+            durations.setdefault(item["kind"], []).append(item["duration"])
+            self_totals[item["kind"]] = self_totals.get(item["kind"], 0.0) + own_seconds[item["span_id"]]
+            if item["span_id"] not in parent_ids:
+                leaves.append((trace, item))
+
+    lines.append("")
+    lines.append("Span kinds (count / p50 / p90 / max / self total):")
+    for kind, values in sorted(durations.items(), key=lambda entry: self_totals[entry[0]], reverse=True):
+        lines.append(
+            f"  {kind}: {len(values)} / {percentile(values, 0.5):.1f}s / {percentile(values, 0.9):.1f}s / "
+            f"{max(values):.1f}s / {self_totals[kind]:.1f}s"
+        )
+
+    lines.append("")
+    lines.append(f"Top {top} slow spans:")
+    for trace, item in sorted(leaves, key=lambda entry: entry[1]["duration"], reverse=True)[:top]:
+        lines.append(f"  row {trace['row']}: {format_span(item)}")
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Critical path and slow span report for pipeline row traces")
+    parser.add_argument("trace_file", type=Path, help=f"Path to {TRACE_FILENAME} or a job directory")
+    parser.add_argument("--top", type=int, default=10, help="How many slowest spans to show")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    trace_file = args.trace_file / TRACE_FILENAME if args.trace_file.is_dir() else args.trace_file
+    print(build_report(load_traces(trace_file), top=args.top))
+
+
+if __name__ == "__main__":
+    main()
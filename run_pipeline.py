@@ -1,12 +1,17 @@
 import argparse
 import asyncio
+import contextlib
+import contextvars
 import csv
+import io
 import logging
 import os
 import re
-from dataclasses import dataclass
+import sys
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable
+from typing import Awaitable, Callable, Iterable
 
 from dotenv import load_dotenv
 from openpyxl import Workbook, load_workbook
@@ -15,6 +20,10 @@ from telethon import TelegramClient
 import get_director_phone
 import get_ip_phone
 import get_phone_summary
+import latency_history
+import pipeline_metrics
+import row_trace
+from bot_conversation import BotConversationGate, measure_gate_wait
 from telethon_client_factory import build_telegram_client
 
 load_dotenv()
@@ -72,6 +81,9 @@ PIPELINE_COLUMN_LABELS = {
 IP_MARKERS_RE = re.compile(r"\bИП\b|индивидуальн\w+\s+предпринимател\w+", re.IGNORECASE)
 HEADER_NAME_MARKERS = ("название", "контрагент", "наименование", "company", "name")
 HEADER_INN_MARKERS = ("инн", "inn")
+ROW_PRIORITY_POLICIES = ("input", "shortest_first", "interleave")
+
+ROW_OUTPUT: contextvars.ContextVar[io.StringIO | None] = contextvars.ContextVar("row_output", default=None)
 
 
 @dataclass
@@ -81,6 +93,39 @@ class InputRow:
     source_inn: str | None
 
 
+@dataclass
+class OrderedResultSink:
+    output_csv: Path
+    next_index: int = 1
+    pending: dict[int, dict[str, str | None]] = field(default_factory=dict)
+
+    def add(self, index: int, row: dict[str, str | None]) -> None:
+        # Rows finish out of order when several workers run, but the CSV must keep
+        # the input order, so a row waits here until all rows before it are written.
+        self.pending[index] = row
+        while self.next_index in self.pending:
+            append_pipeline_result(self.output_csv, self.pending.pop(self.next_index))
+            self.next_index += 1
+
+
+class RowOutputRouter(io.TextIOBase):
+    def __init__(self, target) -> None:
+        self.target = target
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        buffer = ROW_OUTPUT.get()
+        if buffer is not None:
+            return buffer.write(text)
+        return self.target.write(text)
+
+    def flush(self) -> None:
+        if ROW_OUTPUT.get() is None:
+            self.target.flush()
+
+
 def setup_logging() -> logging.Logger:
     level_name = os.getenv("LOG_LEVEL", "INFO").strip().upper()
     level = getattr(logging, level_name, logging.INFO)
@@ -119,6 +164,21 @@ def load_runtime_config() -> tuple[int, str, str, str, bool, Path, int, int, boo
     return api_id, api_hash, session_name, bot_username, headless, debug_dir, step_delay_seconds, row_delay_seconds, bot_message_echo
 
 
+def load_concurrency_config() -> tuple[int, float]:
+    concurrency = int(os.getenv("PIPELINE_CONCURRENCY", "1").strip() or "1")
+    min_send_interval_seconds = float(os.getenv("PIPELINE_MIN_SEND_INTERVAL_SECONDS", "1").strip() or "1")
+    return max(1, concurrency), max(0.0, min_send_interval_seconds)
+
+
+def get_row_priority_policy() -> str:
+    policy = os.getenv("PIPELINE_ROW_PRIORITY", "shortest_first").strip().lower() or "shortest_first"
+    if policy not in ROW_PRIORITY_POLICIES:
+        raise RuntimeError(
+            f"Unsupported PIPELINE_ROW_PRIORITY: {policy}. Expected one of: {', '.join(ROW_PRIORITY_POLICIES)}"
+        )
+    return policy
+
+
 def normalize_inn(value: str | None) -> str | None:
     if not value:
         return None
@@ -470,6 +530,25 @@ def build_direct_phone_summary_row(
     }
 
 
+def record_stage(history: latency_history.LatencyHistory | None, stage: str, seconds: float) -> None:
+    if history is not None:
+        history.record(latency_history.stage_key(stage), seconds)
+
+
+@contextlib.contextmanager
+def row_stage(history: latency_history.LatencyHistory | None, stage: str):
+    started_at = time.perf_counter()
+    with row_trace.span(stage), measure_gate_wait() as gate_wait:
+        yield
+    record_stage(history, stage, time.perf_counter() - started_at - gate_wait.seconds)
+
+
+async def step_pause(step_delay_seconds: int) -> None:
+    if step_delay_seconds > 0:
+        with row_trace.span("step_delay"):
+            await asyncio.sleep(step_delay_seconds)
+
+
 async def resolve_row(
     client: TelegramClient,
     bot_entity,
@@ -480,19 +559,22 @@ async def resolve_row(
     debug_dir: Path,
     step_delay_seconds: int,
     bot_message_echo: bool,
+    gate: BotConversationGate | None = None,
+    history: latency_history.LatencyHistory | None = None,
 ) -> dict[str, str | None]:
     direct_phone = normalize_direct_phone(item.source_name)
     if direct_phone:
-        summary_state = await get_phone_summary.run_single_query(
-            client,
-            bot_entity,
-            direct_phone,
-            log=log,
-            persist=False,
-            echo=bot_message_echo,
-        )
-        if step_delay_seconds > 0:
-            await asyncio.sleep(step_delay_seconds)
+        with row_stage(history, "phone_summary"):
+            summary_state = await get_phone_summary.run_single_query(
+                client,
+                bot_entity,
+                direct_phone,
+                log=log,
+                persist=False,
+                echo=bot_message_echo,
+                gate=gate,
+            )
+        await step_pause(step_delay_seconds)
         return build_direct_phone_summary_row(
             item,
             direct_phone=direct_phone,
@@ -502,33 +584,34 @@ async def resolve_row(
         return build_input_error_row(item, "Во втором столбце не удалось распознать ИНН")
 
     entity_type = detect_entity_type(item.source_name)
-    if entity_type == "ip":
-        phone_source = "ip_web_flow"
-        phone_state = await get_ip_phone.run_single_query(
-            client,
-            bot_entity,
-            item.source_inn,
-            log=log,
-            persist=False,
-            echo=bot_message_echo,
-            headless=headless,
-            debug_dir=debug_dir,
-        )
-    else:
-        phone_source = "company_flow"
-        phone_state = await get_director_phone.run_single_query(
-            client,
-            bot_entity,
-            item.source_inn,
-            log=log,
-            persist=False,
-            echo=bot_message_echo,
-        )
+    phone_source = "ip_web_flow" if entity_type == "ip" else "company_flow"
+    with row_stage(history, phone_source):
+        if entity_type == "ip":
+            phone_state = await get_ip_phone.run_single_query(
+                client,
+                bot_entity,
+                item.source_inn,
+                log=log,
+                persist=False,
+                echo=bot_message_echo,
+                headless=headless,
+                debug_dir=debug_dir,
+                gate=gate,
+            )
+        else:
+            phone_state = await get_director_phone.run_single_query(
+                client,
+                bot_entity,
+                item.source_inn,
+                log=log,
+                persist=False,
+                echo=bot_message_echo,
+                gate=gate,
+            )
 
     found_phone = getattr(getattr(phone_state, "person", None), "phone", None)
     if not found_phone:
-        if step_delay_seconds > 0:
-            await asyncio.sleep(step_delay_seconds)
+        await step_pause(step_delay_seconds)
         return build_pipeline_row(
             item,
             entity_type=entity_type,
@@ -536,20 +619,20 @@ async def resolve_row(
             phone_state=phone_state,
         )
 
-    if step_delay_seconds > 0:
-        await asyncio.sleep(step_delay_seconds)
-
-    summary_state = await get_phone_summary.run_single_query(
-        client,
-        bot_entity,
-        found_phone,
-        log=log,
-        persist=False,
-        echo=bot_message_echo,
-    )
+    await step_pause(step_delay_seconds)
 
-    if step_delay_seconds > 0:
-        await asyncio.sleep(step_delay_seconds)
+    with row_stage(history, "phone_summary"):
+        summary_state = await get_phone_summary.run_single_query(
+            client,
+            bot_entity,
+            found_phone,
+            log=log,
+            persist=False,
+            echo=bot_message_echo,
+            gate=gate,
+        )
+
+    await step_pause(step_delay_seconds)
 
     return build_pipeline_row(
         item,
@@ -560,11 +643,167 @@ async def resolve_row(
     )
 
 
+def interleave_evenly(primary: list[int], secondary: list[int]) -> list[int]:
+    merged: list[int] = []
+    primary_pos = 0
+    secondary_pos = 0
+    while primary_pos < len(primary) or secondary_pos < len(secondary):
+        take_primary = secondary_pos >= len(secondary) or (
+            primary_pos < len(primary) and primary_pos * len(secondary) <= secondary_pos * len(primary)
+        )
+        if take_primary:
+            merged.append(primary[primary_pos])
+            primary_pos += 1
+        else:
+            merged.append(secondary[secondary_pos])
+            secondary_pos += 1
+    return merged
+
+
+def plan_row_order(
+    rows: list[InputRow],
+    history: latency_history.LatencyHistory,
+    policy: str,
+) -> list[int]:
+    indexes = list(range(1, len(rows) + 1))
+    if policy == "input":
+        return indexes
+
+    entity_types = {index: detect_entity_type(rows[index - 1].source_name) for index in indexes}
+    expected_seconds = {
+        index: latency_history.expected_row_seconds(history, entity_types[index])
+        for index in indexes
+    }
+    by_cost = sorted(indexes, key=lambda index: expected_seconds[index])
+    if policy == "shortest_first":
+        return by_cost
+
+    # IP rows need the Telegram bot and then a browser page; spreading them evenly
+    # between Telegram-only rows keeps both the bot dialog and the browser busy.
+    browser_rows = [index for index in by_cost if entity_types[index] == "ip"]
+    telegram_rows = [index for index in by_cost if entity_types[index] != "ip"]
+    return interleave_evenly(telegram_rows, browser_rows)
+
+
+async def run_rows_concurrently(
+    rows: list[InputRow],
+    resolve: Callable[[int, InputRow], Awaitable[dict[str, str | None]]],
+    *,
+    concurrency: int,
+    row_delay_seconds: int,
+    on_row_done: Callable[[int, InputRow, dict[str, str | None]], Awaitable[None]] | None = None,
+    order: list[int] | None = None,
+    history: latency_history.LatencyHistory | None = None,
+    trace_writer: row_trace.TraceWriter | None = None,
+    row_slot: Callable[[InputRow], contextlib.AbstractAsyncContextManager] | None = None,
+) -> list[dict[str, str | None]]:
+    queue: asyncio.Queue[tuple[int, InputRow]] = asyncio.Queue()
+    for index in order if order is not None else range(1, len(rows) + 1):
+        queue.put_nowait((index, rows[index - 1]))
+    results: dict[int, dict[str, str | None]] = {}
+    loop = asyncio.get_running_loop()
+
+    async def worker() -> None:
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            entity_type = detect_entity_type(item.source_name)
+            with row_trace.row_trace(trace_writer, index, source_name=item.source_name, entity_type=entity_type):
+                async with contextlib.AsyncExitStack() as stack:
+                    if row_slot is not None:
+                        with row_trace.span("row_slot_wait"):
+                            await stack.enter_async_context(row_slot(item))
+                    # Row latency history must not include the time spent waiting for a
+                    # slot or for other rows' dialogs on the shared gate; both grow with
+                    # concurrency and would skew the row order.
+                    started_at = loop.time()
+                    with (
+                        pipeline_metrics.stage_timer("row", source=entity_type) as observation,
+                        measure_gate_wait() as gate_wait,
+                    ):
+                        row = await resolve(index, item)
+                        observation.outcome = "found" if row.get("found_phone") else "not_found"
+            results[index] = row
+            if history is not None:
+                history.record(latency_history.row_key(entity_type), loop.time() - started_at - gate_wait.seconds)
+            if on_row_done is not None:
+                await on_row_done(index, item, row)
+
+            if not queue.empty() and row_delay_seconds > 0:
+                await asyncio.sleep(row_delay_seconds)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(rows))))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    return [results[index] for index in sorted(results)]
+
+
+@contextlib.contextmanager
+def routed_stdout(enabled: bool):
+    original_stdout = sys.stdout
+    if enabled:
+        sys.stdout = RowOutputRouter(original_stdout)
+    try:
+        yield
+    finally:
+        sys.stdout = original_stdout
+
+
+@contextlib.contextmanager
+def row_output_block(enabled: bool):
+    buffer = io.StringIO() if enabled else None
+    token = ROW_OUTPUT.set(buffer)
+    try:
+        yield
+    finally:
+        ROW_OUTPUT.reset(token)
+        if buffer is not None:
+            # Print the whole row block at once so parallel rows do not interleave.
+            sys.stdout.write(buffer.getvalue())
+            sys.stdout.flush()
+
+
+def print_row_header(index: int, total: int, item: InputRow) -> None:
+    entity_type = detect_entity_type(item.source_name)
+    if entity_type == "phone":
+        print(f"[{index}/{total}] row={item.source_row} type={entity_type} phone={item.source_name}")
+    else:
+        print(f"[{index}/{total}] row={item.source_row} type={entity_type} inn={item.source_inn or 'missing'}")
+    if item.source_name:
+        print(f"    name: {item.source_name}")
+
+
+def print_row_result(row: dict[str, str | None]) -> None:
+    print(f"    phone_lookup_status: {row['phone_lookup_status']}")
+    print(f"    found_phone: {row['found_phone'] or 'not found'}")
+    print(f"    summary_status: {row['summary_status'] or 'not run'}")
+    print(f"    pipeline_status: {row['pipeline_status']}")
+    print()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run combined INN -> phone -> phone summary pipeline.")
     parser.add_argument("input_path", nargs="?", help="Path to input CSV/XLSX with name in column 1 and INN in column 2")
     parser.add_argument("--output-csv", dest="output_csv", default=os.getenv("PIPELINE_RESULTS_CSV", "pipeline_results.csv"))
     parser.add_argument("--output-xlsx", dest="output_xlsx", default=os.getenv("PIPELINE_RESULTS_XLSX", "pipeline_results.xlsx"))
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Number of rows processed in parallel (default: PIPELINE_CONCURRENCY or 1)",
+    )
+    parser.add_argument(
+        "--trace-jsonl",
+        dest="trace_jsonl",
+        default=os.getenv("PIPELINE_TRACE_JSONL", "").strip() or None,
+        help="Write per-row trace spans to this JSONL file (default: PIPELINE_TRACE_JSONL, disabled if empty)",
+    )
     return parser.parse_args()
 
 
@@ -576,6 +815,11 @@ async def main() -> None:
     args = parse_args()
     log = setup_logging()
     api_id, api_hash, session_name, bot_username, headless, debug_dir, step_delay_seconds, row_delay_seconds, bot_message_echo = load_runtime_config()
+    concurrency, min_send_interval_seconds = load_concurrency_config()
+    if args.concurrency is not None:
+        concurrency = max(1, args.concurrency)
+    row_priority_policy = get_row_priority_policy()
+    history = latency_history.load_history(log=log)
 
     input_path_raw = args.input_path
     if not input_path_raw:
@@ -605,39 +849,47 @@ async def main() -> None:
         bot_entity = await client.get_entity(bot_username)
         log.info("Connected to bot %s", bot_username)
         print(f"Loaded {len(rows)} rows from {input_path}")
-        print(f"Results -> {output_csv} and {output_xlsx}\n")
-        result_rows: list[dict[str, str | None]] = []
-
-        for index, item in enumerate(rows, start=1):
-            entity_type = detect_entity_type(item.source_name)
-            if entity_type == "phone":
-                print(f"[{index}/{len(rows)}] row={item.source_row} type={entity_type} phone={item.source_name}")
-            else:
-                print(f"[{index}/{len(rows)}] row={item.source_row} type={entity_type} inn={item.source_inn or 'missing'}")
-            if item.source_name:
-                print(f"    name: {item.source_name}")
-
-            row = await resolve_row(
-                client,
-                bot_entity,
-                item,
-                log=log,
-                headless=headless,
-                debug_dir=debug_dir,
-                step_delay_seconds=step_delay_seconds,
-                bot_message_echo=bot_message_echo,
-            )
-            append_pipeline_result(output_csv, row)
-            result_rows.append(row)
-
-            print(f"    phone_lookup_status: {row['phone_lookup_status']}")
-            print(f"    found_phone: {row['found_phone'] or 'not found'}")
-            print(f"    summary_status: {row['summary_status'] or 'not run'}")
-            print(f"    pipeline_status: {row['pipeline_status']}")
-            print()
-
-            if index < len(rows) and row_delay_seconds > 0:
-                await asyncio.sleep(row_delay_seconds)
+        print(f"Results -> {output_csv} and {output_xlsx}")
+        print(f"Concurrency: {concurrency}, row priority: {row_priority_policy}\n")
+        gate = BotConversationGate(min_send_interval_seconds=min_send_interval_seconds)
+        sink = OrderedResultSink(output_csv)
+        capture_output = concurrency > 1
+
+        async def resolve(index: int, item: InputRow) -> dict[str, str | None]:
+            with row_output_block(capture_output):
+                print_row_header(index, len(rows), item)
+                row = await resolve_row(
+                    client,
+                    bot_entity,
+                    item,
+                    log=log,
+                    headless=headless,
+                    debug_dir=debug_dir,
+                    step_delay_seconds=step_delay_seconds,
+                    bot_message_echo=bot_message_echo,
+                    gate=gate,
+                    history=history,
+                )
+                print_row_result(row)
+            return row
+
+        async def on_row_done(index: int, item: InputRow, row: dict[str, str | None]) -> None:
+            sink.add(index, row)
+
+        try:
+            with routed_stdout(capture_output):
+                result_rows = await run_rows_concurrently(
+                    rows,
+                    resolve,
+                    concurrency=concurrency,
+                    row_delay_seconds=row_delay_seconds,
+                    on_row_done=on_row_done,
+                    order=plan_row_order(rows, history, row_priority_policy),
+                    history=history,
+                    trace_writer=row_trace.TraceWriter(Path(args.trace_jsonl)) if args.trace_jsonl else None,
+                )
+        finally:
+            latency_history.save_history(history, log=log)
 
         write_pipeline_results_xlsx(output_xlsx, result_rows)
     finally:
@@ -0,0 +1,72 @@
+import threading
+import time
+from dataclasses import dataclass, field
+
+import pipeline_metrics
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class SheetsCircuitOpenError(RuntimeError):
+    pass
+
+
+@dataclass
+class CircuitBreaker:
+    # Consecutive retryable failures of one class of Sheets calls open the circuit:
+    # calls then fail at once instead of sitting through retries, and callers fall
+    # back to local state. After open_seconds one call is let through as a probe;
+    # its success closes the circuit, its failure keeps it open for another period.
+    name: str
+    failure_threshold: int
+    open_seconds: float
+    state: str = STATE_CLOSED
+    failures: int = 0
+    opened_at: float = 0.0
+    probe_started_at: float | None = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def before_call(self) -> None:
+        with self.lock:
+            if self.state == STATE_CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == STATE_OPEN and now - self.opened_at >= self.open_seconds:
+                self.set_state(STATE_HALF_OPEN)
+            # A probe that never reported back, e.g. a cancelled call, does not
+            # keep the circuit half-open forever.
+            if self.state == STATE_HALF_OPEN and (
+                self.probe_started_at is None or now - self.probe_started_at >= self.open_seconds
+            ):
+                self.probe_started_at = now
+                return
+            raise self.open_error()
+
+    def open_error(self) -> SheetsCircuitOpenError:
+        return SheetsCircuitOpenError(f"Google Sheets is unavailable ({self.name} calls paused)")
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probe_started_at = None
+            if self.state != STATE_CLOSED:
+                self.set_state(STATE_CLOSED)
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probe_started_at = None
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != STATE_OPEN:
+                    self.set_state(STATE_OPEN)
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.state != STATE_CLOSED
+
+    def set_state(self, state: str) -> None:
+        self.state = state
+        pipeline_metrics.inc_counter("google_sheets_circuit_transitions_total", circuit=self.name, state=state)
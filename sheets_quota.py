@@ -0,0 +1,214 @@
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+import pipeline_metrics
+
+T = TypeVar("T")
+
+WINDOW_SECONDS = 60.0
+# A waiting call re-checks the quota at least this often, so a newly arrived
+# higher-priority call or a freed slot is noticed without a long sleep.
+MAX_WAIT_STEP_SECONDS = 1.0
+
+PRIORITY_BILLING = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_EXPORT = 2
+PRIORITY_AUDIT = 3
+PRIORITY_NAMES = {
+    PRIORITY_BILLING: "billing",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_EXPORT: "export",
+    PRIORITY_AUDIT: "audit",
+}
+# The share of the per-minute quota a priority may use. Low-priority work starts
+# waiting while there is still quota left, and that rest stays free for billing.
+PRIORITY_QUOTA_SHARE = {
+    PRIORITY_BILLING: 1.0,
+    PRIORITY_INTERACTIVE: 0.9,
+    PRIORITY_EXPORT: 0.75,
+    PRIORITY_AUDIT: 0.5,
+}
+
+CURRENT_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "google_sheets_priority",
+    default=PRIORITY_INTERACTIVE,
+)
+
+
+@contextlib.contextmanager
+def priority(value: int) -> Iterator[None]:
+    # Sheets calls made inside the block, including ones handed to the Sheets
+    # executor with run_blocking, are scheduled with this priority.
+    token = CURRENT_PRIORITY.set(value)
+    try:
+        yield
+    finally:
+        CURRENT_PRIORITY.reset(token)
+
+
+@dataclass
+class QuotaWindow:
+    limit: int
+    used: deque[float] = field(default_factory=deque)
+    waiting: dict[int, int] = field(default_factory=dict)
+    throttled_until: float = 0.0
+
+    def prune(self, now: float) -> None:
+        while self.used and self.used[0] <= now - WINDOW_SECONDS:
+            self.used.popleft()
+
+    def has_waiting_above(self, call_priority: int) -> bool:
+        return any(count > 0 for waiting_priority, count in self.waiting.items() if waiting_priority < call_priority)
+
+
+@dataclass
+class InFlightRead:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: object = None
+    error: BaseException | None = None
+
+
+@dataclass
+class SheetsQuotaScheduler:
+    # All Sheets requests of the process take a slot of a sliding one-minute window
+    # per quota kind (read or write) before they are sent. A call waits while its
+    # priority has used up its share of the window or a more important call of the
+    # same kind is waiting, so audit logs and exports back off before billing or
+    # access checks could hit a 429. Identical reads of the same priority running
+    # at the same time are sent once and share the response.
+    read_limit: int
+    write_limit: int
+    windows: dict[str, QuotaWindow] = field(default_factory=dict)
+    in_flight: dict[tuple, InFlightRead] = field(default_factory=dict)
+    in_flight_async: dict[tuple, asyncio.Future] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self.windows = {
+            "read": QuotaWindow(limit=max(1, self.read_limit)),
+            "write": QuotaWindow(limit=max(1, self.write_limit)),
+        }
+
+    def try_acquire(self, kind: str, call_priority: int, now: float) -> float:
+        # Takes a slot and returns 0, or returns how long to wait before trying again.
+        window = self.windows[kind]
+        with self.lock:
+            window.prune(now)
+            if now < window.throttled_until:
+                return window.throttled_until - now
+            allowed = max(1, int(window.limit * PRIORITY_QUOTA_SHARE.get(call_priority, 1.0)))
+            if len(window.used) < allowed and not window.has_waiting_above(call_priority):
+                window.used.append(now)
+                return 0.0
+            if len(window.used) >= allowed:
+                # The slot frees once enough of the oldest requests leave the window.
+                return window.used[len(window.used) - allowed] + WINDOW_SECONDS - now
+            return MAX_WAIT_STEP_SECONDS
+
+    def set_waiting(self, kind: str, call_priority: int, delta: int) -> None:
+        window = self.windows[kind]
+        with self.lock:
+            window.waiting[call_priority] = window.waiting.get(call_priority, 0) + delta
+
+    def record_wait(self, kind: str, call_priority: int, waited: float) -> None:
+        labels = {"kind": kind, "priority": PRIORITY_NAMES.get(call_priority, str(call_priority))}
+        pipeline_metrics.inc_counter("google_sheets_quota_delayed_total", **labels)
+        pipeline_metrics.observe_histogram("google_sheets_quota_wait_seconds", waited, **labels)
+
+    def acquire(self, kind: str) -> float:
+        # Blocking variant for calls that already run on a Sheets executor thread.
+        call_priority = CURRENT_PRIORITY.get()
+        started = time.monotonic()
+        delay = self.try_acquire(kind, call_priority, started)
+        if not delay:
+            return 0.0
+        self.set_waiting(kind, call_priority, 1)
+        try:
+            while delay:
+                time.sleep(min(delay, MAX_WAIT_STEP_SECONDS))
+                delay = self.try_acquire(kind, call_priority, time.monotonic())
+        finally:
+            self.set_waiting(kind, call_priority, -1)
+        waited = time.monotonic() - started
+        self.record_wait(kind, call_priority, waited)
+        return waited
+
+    async def acquire_async(self, kind: str) -> float:
+        call_priority = CURRENT_PRIORITY.get()
+        started = time.monotonic()
+        delay = self.try_acquire(kind, call_priority, started)
+        if not delay:
+            return 0.0
+        self.set_waiting(kind, call_priority, 1)
+        try:
+            while delay:
+                await asyncio.sleep(min(delay, MAX_WAIT_STEP_SECONDS))
+                delay = self.try_acquire(kind, call_priority, time.monotonic())
+        finally:
+            self.set_waiting(kind, call_priority, -1)
+        waited = time.monotonic() - started
+        self.record_wait(kind, call_priority, waited)
+        return waited
+
+    def note_throttled(self, kind: str, seconds: float) -> None:
+        # Sheets answered 429 anyway, e.g. because another process shares the
+        # quota; nothing of that kind is sent until the retry is due.
+        window = self.windows[kind]
+        with self.lock:
+            window.throttled_until = max(window.throttled_until, time.monotonic() + seconds)
+
+    def coalesce(self, key: tuple, func: Callable[[], T], *, operation: str) -> T:
+        # The first caller sends the read; callers with the same key that arrive
+        # while it runs wait for its response instead of spending quota. Only calls
+        # of the same priority share a read: a billing call must not wait out an
+        # export's quota share or fail with the export's open circuit.
+        key = (CURRENT_PRIORITY.get(), *key)
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = InFlightRead()
+        if not leader:
+            pipeline_metrics.inc_counter("google_sheets_coalesced_total", operation=operation)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.done.set()
+
+    async def coalesce_async(self, key: tuple, func: Callable[[], Awaitable[T]], *, operation: str) -> T:
+        # The same for reads sent from the event loop. The shared read is shielded,
+        # so a caller that gives up does not cancel it for the others.
+        key = (CURRENT_PRIORITY.get(), *key)
+        flight = self.in_flight_async.get(key)
+        if flight is not None:
+            pipeline_metrics.inc_counter("google_sheets_coalesced_total", operation=operation)
+            return await asyncio.shield(flight)
+
+        flight = self.in_flight_async[key] = asyncio.ensure_future(func())
+
+        def forget(done: asyncio.Future) -> None:
+            if self.in_flight_async.get(key) is done:
+                del self.in_flight_async[key]
+            if not done.cancelled():
+                # Retrieved here, so an error nobody waits for any more is not logged as lost.
+                done.exception()
+
+        flight.add_done_callback(forget)
+        return await asyncio.shield(flight)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import google_sheets_client
+import run_pipeline
+import sheets_quota
+
+
+@dataclass
+class StreamingSheetsExport:
+    # Writes finished rows to the result worksheet while the job still runs. Rows
+    # arrive in completion order and fill the same fixed chunks the final export
+    # uses; any complete chunk is written, so the final pass only writes what is missing.
+    service: object
+    config: google_sheets_client.GoogleSheetsConfig
+    worksheet_title: str
+    chunk_rows: int
+    rows_total: int
+    mark_chunk: Callable[[int], None]
+    log: logging.Logger
+    chunks_done: set[int] = field(default_factory=set)
+    # Table row -> values; table row 0 is the header, row N is input row N.
+    pending: dict[int, list[str | None]] = field(default_factory=dict)
+    rows_written: int = 0
+    last_write_at: float = 0.0
+    task: asyncio.Task | None = None
+
+    def add(self, index: int, row: dict[str, str | None]) -> None:
+        if index // self.chunk_rows not in self.chunks_done:
+            self.pending[index] = [row.get(name) for name in run_pipeline.PIPELINE_FIELDNAMES]
+
+    def chunk_range(self, chunk_index: int) -> range:
+        start = chunk_index * self.chunk_rows
+        return range(start, min(start + self.chunk_rows, self.rows_total + 1))
+
+    def is_chunk_ready(self, chunk_index: int) -> bool:
+        return all(table_row == 0 or table_row in self.pending for table_row in self.chunk_range(chunk_index))
+
+    def next_ready_run(self) -> list[int]:
+        # The first run of consecutive complete chunks that are not written yet,
+        # wherever it is; capped so one request stays small.
+        max_chunks = max(1, self.config.export_chunk_rows // self.chunk_rows)
+        chunk_count = self.rows_total // self.chunk_rows + 1
+        run: list[int] = []
+        for chunk_index in range(chunk_count):
+            if chunk_index in self.chunks_done or not self.is_chunk_ready(chunk_index):
+                if run:
+                    break
+                continue
+            run.append(chunk_index)
+            if len(run) >= max_chunks:
+                break
+        return run
+
+    def poke(self) -> None:
+        # Called after every finished row; writes happen in the background, at most
+        # once per stream_interval_seconds, so rows never wait for Sheets.
+        if self.task is not None and not self.task.done():
+            return
+        if time.monotonic() - self.last_write_at < self.config.stream_interval_seconds:
+            return
+        self.task = asyncio.create_task(self.write_ready())
+
+    async def write_ready(self) -> None:
+        run = self.next_ready_run()
+        if not run:
+            return
+        self.last_write_at = time.monotonic()
+        table_rows = [table_row for chunk_index in run for table_row in self.chunk_range(chunk_index)]
+        headers = [run_pipeline.PIPELINE_COLUMN_LABELS.get(name, name) for name in run_pipeline.PIPELINE_FIELDNAMES]
+        values = [headers if table_row == 0 else self.pending[table_row] for table_row in table_rows]
+        try:
+            with sheets_quota.priority(sheets_quota.PRIORITY_EXPORT):
+                await google_sheets_client.execute_with_retries_async(
+                    google_sheets_client.build_write_rows_request(
+                        self.service,
+                        self.config.spreadsheet_id,
+                        self.worksheet_title,
+                        google_sheets_client.normalize_rows(values),
+                        start_row=table_rows[0] + 1,
+                    ),
+                    self.config,
+                    log=self.log,
+                    operation="spreadsheets.values.update.stream",
+                )
+        except Exception as exc:
+            # The rows stay pending; the next write or the final pass sends them.
+            self.log.warning("Streaming Google Sheets export of %s failed: %s", self.worksheet_title, exc)
+            return
+        for chunk_index in run:
+            self.mark_chunk(chunk_index)
+            self.chunks_done.add(chunk_index)
+        for table_row in table_rows:
+            self.pending.pop(table_row, None)
+        self.rows_written += len([table_row for table_row in table_rows if table_row > 0])
+
+    async def close(self) -> None:
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def describe(self) -> str:
+        return f"Google Sheets: лист {self.worksheet_title}, выгружено строк: {self.rows_written}"
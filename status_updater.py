@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+
+@dataclass(eq=False)
+class StatusUpdater:
+    # Keeps only the latest text of one status message and edits it at most once
+    # per min_interval_seconds. An edit error with a retry_after attribute (Bot API 429)
+    # postpones the next edit instead of dropping the text.
+    edit: Callable[[str], Awaitable[object]]
+    log: logging.Logger
+    min_interval_seconds: float = 3.0
+    desired: str | None = None
+    sent: str | None = None
+    next_edit_at: float = 0.0
+    flusher: asyncio.Task | None = None
+
+    def set(self, text: str) -> None:
+        self.desired = text
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.run_flusher())
+
+    def is_pending(self) -> bool:
+        return self.desired is not None and self.desired != self.sent
+
+    async def run_flusher(self) -> None:
+        while self.is_pending():
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.edit_latest()
+
+    async def edit_latest(self) -> None:
+        text = self.desired
+        if text is None or text == self.sent:
+            return
+
+        try:
+            await self.edit(text)
+        except Exception as exc:
+            retry_after = getattr(exc, "retry_after", None)
+            if retry_after:
+                self.log.warning("Status message edits are rate limited, retrying in %ss", retry_after)
+                self.next_edit_at = time.monotonic() + retry_after
+                return
+            self.log.warning("Failed to edit status message: %s", exc)
+        self.sent = text
+        self.next_edit_at = time.monotonic() + self.min_interval_seconds
+
+    async def flush(self) -> None:
+        # Waits until the latest text is on screen; used before a job finishes.
+        if self.is_pending() and (self.flusher is None or self.flusher.done()):
+            self.flusher = asyncio.create_task(self.run_flusher())
+        if self.flusher is not None:
+            await self.flusher
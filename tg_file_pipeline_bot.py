@@ -3,25 +3,44 @@ import json
 import logging
 import os
 import re
+import sys
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
 from pathlib import Path
+from typing import Callable
 from uuid import uuid4
 
 from dotenv import load_dotenv
 from telethon import TelegramClient
 
+import async_http
+import balance_ledger
 import client_registry
+import fair_scheduler
 import google_sheets_client
+import job_estimator
+import job_queue
+import job_store
+import latency_history
+import partial_results
+import pipeline_metrics
+import registry_log_writer
+import row_trace
 import run_pipeline
-from telethon_client_factory import build_telegram_client, open_url
+import sheets_quota
+import sheets_stream_export
+import status_updater
+import update_dedupe
+import webhook_server
+from bot_conversation import BotConversationGate
+from telethon_client_factory import build_telegram_client, get_proxy_settings
 
 load_dotenv()
 
 SUPPORTED_EXTENSIONS = {".xlsx", ".xlsm", ".csv"}
+ALLOWED_UPDATES = ["message", "edited_message"]
 TEMPLATE_FILENAME_PREFIXES = ("шаблон", "template")
+UPDATE_MODES = ("polling", "webhook")
 
 
 def setup_logging() -> logging.Logger:
@@ -42,6 +61,13 @@ def get_required_env(name: str) -> str:
     return value
 
 
+def get_int_env(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    return int(raw)
+
+
 def get_bool_env(name: str, default: bool) -> bool:
     raw = os.getenv(name)
     if raw is None:
@@ -49,66 +75,51 @@ def get_bool_env(name: str, default: bool) -> bool:
     return raw.strip().lower() not in {"0", "false", "no", "off"}
 
 
-def telegram_api_request(token: str, method: str, params: dict | None = None) -> dict:
-    query = urllib.parse.urlencode(params or {})
-    url = f"https://api.telegram.org/bot{token}/{method}"
-    if query:
-        url = f"{url}?{query}"
+BOT_API_HTTP: async_http.AsyncHttpClient | None = None
 
-    with open_url(url, timeout=70) as response:
-        payload = response.read().decode("utf-8")
-    data = json.loads(payload)
-    if not data.get("ok"):
-        raise RuntimeError(f"Telegram Bot API error: {data}")
-    return data
 
+def get_bot_api_base_url() -> str:
+    # Overridable for a self-hosted Bot API server or a local fake in tests.
+    return (os.getenv("TG_BOT_API_BASE_URL", "").strip() or "https://api.telegram.org").rstrip("/")
 
-def telegram_api_post_multipart(
-    token: str,
-    method: str,
-    fields: dict[str, str],
-    file_field: str,
-    file_path: Path,
-    filename: str | None = None,
-) -> dict:
-    boundary = f"----CodexBoundary{uuid4().hex}"
-    file_name = filename or file_path.name
-    body = bytearray()
-
-    for key, value in fields.items():
-        body.extend(f"--{boundary}\r\n".encode("utf-8"))
-        body.extend(f'Content-Disposition: form-data; name="{key}"\r\n\r\n'.encode("utf-8"))
-        body.extend(str(value).encode("utf-8"))
-        body.extend(b"\r\n")
-
-    body.extend(f"--{boundary}\r\n".encode("utf-8"))
-    body.extend(
-        (
-            f'Content-Disposition: form-data; name="{file_field}"; filename="{file_name}"\r\n'
-            "Content-Type: application/octet-stream\r\n\r\n"
-        ).encode("utf-8")
-    )
-    body.extend(file_path.read_bytes())
-    body.extend(b"\r\n")
-    body.extend(f"--{boundary}--\r\n".encode("utf-8"))
-
-    request = urllib.request.Request(
-        f"https://api.telegram.org/bot{token}/{method}",
-        data=bytes(body),
-        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
-        method="POST",
-    )
 
-    with open_url(request, timeout=120) as response:
-        payload = response.read().decode("utf-8")
-    data = json.loads(payload)
+def get_bot_api_http() -> async_http.AsyncHttpClient:
+    # One keep-alive pool for the whole bot; created lazily inside the running loop.
+    global BOT_API_HTTP
+    if BOT_API_HTTP is None:
+        BOT_API_HTTP = async_http.AsyncHttpClient(
+            proxy=get_proxy_settings(),
+            connect_timeout=get_int_env("TG_BOT_HTTP_CONNECT_TIMEOUT_SECONDS", 15),
+            request_timeout=get_int_env("TG_BOT_HTTP_TIMEOUT_SECONDS", 70),
+            max_connections_per_host=get_int_env("TG_BOT_HTTP_POOL_SIZE", 8),
+        )
+    return BOT_API_HTTP
+
+
+class BotApiError(RuntimeError):
+    def __init__(self, data: dict) -> None:
+        super().__init__(f"Telegram Bot API error: {data}")
+        self.error_code = data.get("error_code")
+        self.retry_after = (data.get("parameters") or {}).get("retry_after")
+
+
+def parse_bot_api_response(response: async_http.HttpResponse) -> dict:
+    data = json.loads(response.text())
     if not data.get("ok"):
-        raise RuntimeError(f"Telegram Bot API error: {data}")
+        raise BotApiError(data)
     return data
 
 
 async def bot_api_request(token: str, method: str, params: dict | None = None) -> dict:
-    return await asyncio.to_thread(telegram_api_request, token, method, params)
+    query = urllib.parse.urlencode(params or {})
+    url = f"{get_bot_api_base_url()}/bot{token}/{method}"
+    if query:
+        url = f"{url}?{query}"
+
+    with pipeline_metrics.stage_timer("bot_api", source=method):
+        # Every Bot API call goes over GET; only the get* methods are safe to send twice.
+        response = await get_bot_api_http().request("GET", url, idempotent=method.startswith("get"))
+    return parse_bot_api_response(response)
 
 
 async def bot_api_post_multipart(
@@ -119,15 +130,16 @@ async def bot_api_post_multipart(
     file_path: Path,
     filename: str | None = None,
 ) -> dict:
-    return await asyncio.to_thread(
-        telegram_api_post_multipart,
-        token,
-        method,
-        fields,
-        file_field,
-        file_path,
-        filename,
-    )
+    body, content_type = async_http.build_multipart_body(fields, file_field, file_path, filename)
+    with pipeline_metrics.stage_timer("bot_api", source=method):
+        response = await get_bot_api_http().request(
+            "POST",
+            f"{get_bot_api_base_url()}/bot{token}/{method}",
+            headers={"Content-Type": content_type},
+            body=body,
+            timeout=120,
+        )
+    return parse_bot_api_response(response)
 
 
 def extract_message(update: dict) -> dict | None:
@@ -162,12 +174,34 @@ async def safe_registry_side_effect(
     **kwargs,
 ):
     try:
-        return await asyncio.to_thread(func, *args, **kwargs)
+        return await google_sheets_client.run_blocking(func, *args, **kwargs)
     except Exception:
         log.exception("Registry operation failed: %s", operation)
         return None
 
 
+async def safe_job_side_effect(
+    store: job_store.JobStore,
+    job_id: str,
+    func,
+    log: logging.Logger,
+    *args,
+    operation: str,
+    **kwargs,
+) -> None:
+    # Registry rows of a job are written once: a job resumed after a restart skips
+    # the ones recorded before it. A crash between the two steps repeats a row
+    # rather than losing it, like the log spool itself.
+    if store.has_event(job_id, operation):
+        return
+    try:
+        await google_sheets_client.run_blocking(func, *args, **kwargs)
+    except Exception:
+        log.exception("Registry operation failed: %s", operation)
+        return
+    store.record_event(job_id, operation)
+
+
 async def send_message(token: str, chat_id: int, text: str, reply_to_message_id: int | None = None) -> dict:
     params: dict[str, str | int] = {"chat_id": chat_id, "text": text}
     if reply_to_message_id:
@@ -184,13 +218,6 @@ async def edit_message(token: str, chat_id: int, message_id: int, text: str) ->
     return await bot_api_request(token, "editMessageText", params)
 
 
-async def safe_edit_message(token: str, chat_id: int, message_id: int, text: str, log: logging.Logger) -> None:
-    try:
-        await edit_message(token, chat_id, message_id, text)
-    except Exception as exc:
-        log.warning("Failed to edit status message: %s", exc)
-
-
 async def send_document(
     token: str,
     chat_id: int,
@@ -207,13 +234,48 @@ async def send_document(
     return await bot_api_post_multipart(token, "sendDocument", fields, "document", file_path)
 
 
-async def download_file(token: str, file_id: str, destination: Path) -> Path:
+def get_max_input_file_bytes() -> int:
+    # Bot API getFile only serves files up to 20 MB anyway.
+    return get_int_env("TG_BOT_MAX_INPUT_FILE_MB", 20) * 1024 * 1024
+
+
+def format_megabytes(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} МБ"
+
+
+def build_file_too_large_text(file_size: int, max_bytes: int) -> str:
+    return (
+        f"Файл слишком большой: {format_megabytes(file_size)}, "
+        f"максимум {format_megabytes(max_bytes)}. Разделите его на несколько файлов."
+    )
+
+
+async def download_file(
+    token: str,
+    file_id: str,
+    destination: Path,
+    *,
+    progress: Callable[[int, int | None], None] | None = None,
+) -> Path:
+    max_bytes = get_max_input_file_bytes()
     file_info = await bot_api_request(token, "getFile", {"file_id": file_id})
     file_path = file_info["result"]["file_path"]
-    download_url = f"https://api.telegram.org/file/bot{token}/{file_path}"
-    data = await asyncio.to_thread(lambda: open_url(download_url, timeout=120).read())
-    destination.parent.mkdir(parents=True, exist_ok=True)
-    destination.write_bytes(data)
+    file_size = file_info["result"].get("file_size")
+    if file_size is not None and file_size > max_bytes:
+        raise RuntimeError(build_file_too_large_text(file_size, max_bytes))
+
+    download_url = f"{get_bot_api_base_url()}/file/bot{token}/{file_path}"
+    with pipeline_metrics.stage_timer("bot_api", source="downloadFile"):
+        received = await get_bot_api_http().download(
+            download_url,
+            destination,
+            max_bytes=file_size if file_size is not None else max_bytes,
+            progress=(lambda done: progress(done, file_size)) if progress is not None else None,
+            timeout=120,
+        )
+    if file_size is not None and received != file_size:
+        destination.unlink(missing_ok=True)
+        raise RuntimeError(f"Файл скачан не полностью: {received} из {file_size} байт")
     return destination
 
 
@@ -336,28 +398,113 @@ def build_billing_report(
     return detailed, short
 
 
-def export_results_to_google_sheets(file_name: str, rows: list[dict[str, str | None]], log: logging.Logger) -> str:
+async def prepare_results_export(
+    file_name: str,
+    rows_total: int,
+    *,
+    store: job_store.JobStore,
+    job_id: str,
+    streaming: bool = False,
+) -> tuple[object, google_sheets_client.GoogleSheetsConfig, job_store.StoredExport]:
     config = google_sheets_client.load_config()
-    service = google_sheets_client.build_sheets_service(config)
-    worksheet_title = google_sheets_client.create_worksheet(
-        service,
-        config.spreadsheet_id,
-        build_google_worksheet_title(file_name),
-        rows=max(1000, len(rows) + 10),
-        cols=max(26, len(run_pipeline.PIPELINE_FIELDNAMES) + 2),
+    service = await google_sheets_client.run_blocking(google_sheets_client.build_sheets_service, config)
+    export = store.get_export(job_id)
+    if export is None:
+        # The grid is sized for the whole table up front, so chunks never make Sheets grow it.
+        worksheet_title = await google_sheets_client.create_worksheet_async(
+            service,
+            config.spreadsheet_id,
+            build_google_worksheet_title(file_name),
+            rows=max(1000, rows_total + 10),
+            cols=max(26, len(run_pipeline.PIPELINE_FIELDNAMES) + 2),
+        )
+        export = job_store.StoredExport(
+            worksheet_title=worksheet_title,
+            # Streaming writes small chunks as rows finish; the final export writes big ones.
+            chunk_rows=config.stream_chunk_rows if streaming else config.export_chunk_rows,
+            chunks_done=frozenset(),
+        )
+        store.start_export(job_id, export.worksheet_title, export.chunk_rows)
+    return service, config, export
+
+
+async def start_streaming_export(
+    file_name: str,
+    rows_total: int,
+    log: logging.Logger,
+    *,
+    store: job_store.JobStore,
+    job_id: str,
+) -> sheets_stream_export.StreamingSheetsExport | None:
+    try:
+        service, config, export = await prepare_results_export(
+            file_name,
+            rows_total,
+            store=store,
+            job_id=job_id,
+            streaming=True,
+        )
+    except Exception as exc:
+        # Not fatal: the export after processing creates the worksheet again.
+        log.warning("Failed to start streaming Google Sheets export: %s", exc)
+        return None
+    log.info("Streaming Google Sheets export to worksheet %s", export.worksheet_title)
+    return sheets_stream_export.StreamingSheetsExport(
+        service=service,
+        config=config,
+        worksheet_title=export.worksheet_title,
+        chunk_rows=export.chunk_rows,
+        rows_total=rows_total,
+        mark_chunk=lambda chunk_index: store.mark_export_chunk(job_id, chunk_index),
+        log=log,
+        chunks_done=set(export.chunks_done),
+    )
+
+
+async def export_results_to_google_sheets(
+    file_name: str,
+    rows: list[dict[str, str | None]],
+    log: logging.Logger,
+    *,
+    store: job_store.JobStore,
+    job_id: str,
+    status: status_updater.StatusUpdater,
+) -> str:
+    # With streaming export most chunks are already written; this pass writes the rest.
+    service, config, export = await prepare_results_export(
+        file_name,
+        len(rows),
+        store=store,
+        job_id=job_id,
     )
+    if export.chunks_done:
+        log.info("Resuming Google Sheets export: worksheet=%s chunks_done=%s", export.worksheet_title, len(export.chunks_done))
+
     headers = [run_pipeline.PIPELINE_COLUMN_LABELS.get(field, field) for field in run_pipeline.PIPELINE_FIELDNAMES]
-    values = [
-        [row.get(field) for field in run_pipeline.PIPELINE_FIELDNAMES]
-        for row in rows
+    table = [
+        headers,
+        *([row.get(field) for field in run_pipeline.PIPELINE_FIELDNAMES] for row in rows),
     ]
-    google_sheets_client.append_table(
+    chunk_count = (len(table) + export.chunk_rows - 1) // export.chunk_rows
+    chunks_done = set(export.chunks_done)
+
+    def on_chunk_written(chunk_index: int) -> None:
+        store.mark_export_chunk(job_id, chunk_index)
+        chunks_done.add(chunk_index)
+        status.set(f"Выгружаю результат в Google Sheets: часть {len(chunks_done)} из {chunk_count}")
+
+    await google_sheets_client.write_rows_in_chunks_async(
         service,
         config.spreadsheet_id,
-        worksheet_title,
-        headers,
-        values,
+        export.worksheet_title,
+        table,
+        chunk_rows=export.chunk_rows,
+        parallel=config.export_parallel_chunks,
+        skip_chunks=export.chunks_done,
+        on_chunk_written=on_chunk_written,
+        max_request_rows=config.export_chunk_rows,
     )
+    worksheet_title = export.worksheet_title
     log.info("Google Sheets export completed: spreadsheet=%s worksheet=%s", config.spreadsheet_id, worksheet_title)
     return worksheet_title
 
@@ -370,102 +517,204 @@ async def process_input_file(
     input_path: Path,
     output_csv: Path,
     output_xlsx: Path,
-    token: str,
     chat_id: int,
-    status_message_id: int,
+    status: status_updater.StatusUpdater,
     log: logging.Logger,
     headless: bool,
     debug_dir: Path,
     step_delay_seconds: int,
     row_delay_seconds: int,
     bot_message_echo: bool,
+    gate: BotConversationGate,
+    concurrency: int,
+    history: latency_history.LatencyHistory,
+    row_priority_policy: str,
+    capture_output: bool,
+    trace_path: Path | None = None,
+    scheduler: fair_scheduler.FairRowScheduler | None = None,
+    max_concurrency: int = 0,
+    resumed_rows: dict[int, dict[str, str | None]] | None = None,
+    save_row: Callable[[int, dict[str, str | None]], None] | None = None,
+    partial: partial_results.PartialResults | None = None,
+    stream: sheets_stream_export.StreamingSheetsExport | None = None,
+    queue: job_queue.JobQueue | None = None,
+    queued_job: job_queue.QueuedJob | None = None,
 ) -> list[dict[str, str | None]]:
     rows = input_rows
     if not rows:
         raise RuntimeError("Во входном файле нет строк для обработки")
+    # Rows finished before a restart are taken from the job store as they are.
+    done_rows = dict(resumed_rows or {})
 
-    results: list[dict[str, str | None]] = []
-    await safe_edit_message(
-        token,
-        chat_id,
-        status_message_id,
-        f"Файл получен. Найдено строк: {len(rows)}.\nНачинаю обработку.",
-        log,
-    )
+    row_workers = min(concurrency, max_concurrency) if max_concurrency > 0 else concurrency
 
-    for index, item in enumerate(rows, start=1):
+    def row_slot(item: run_pipeline.InputRow):
         entity_type = run_pipeline.detect_entity_type(item.source_name)
-        await safe_edit_message(
-            token,
-            chat_id,
-            status_message_id,
-            (
-                f"Обработка {index}/{len(rows)}\n"
-                f"Тип: {entity_type}\n"
-                f"ИНН: {item.source_inn or 'не распознан'}\n"
-                f"Название: {item.source_name or '-'}"
-            ),
-            log,
-        )
+        return scheduler.slot(str(chat_id), cost=latency_history.expected_row_seconds(history, entity_type))
 
-        row = await run_pipeline.resolve_row(
-            client,
-            bot_entity,
-            item,
-            log=log,
-            headless=headless,
-            debug_dir=debug_dir,
+    remaining_entity_types = {
+        index: run_pipeline.detect_entity_type(item.source_name)
+        for index, item in enumerate(rows, start=1)
+        if index not in done_rows
+    }
+    charged_so_far = sum(client_registry.count_row_charge(row) for row in done_rows.values())
+
+    def build_estimate_text() -> str:
+        workers = row_workers
+        if scheduler is not None:
+            # Row slots are split between the chats that have rows in work.
+            workers = min(workers, max(1, scheduler.capacity // scheduler.active_flow_count(including=str(chat_id))))
+        estimate = job_estimator.estimate_job(
+            history,
+            list(remaining_entity_types.values()),
+            rows_total=len(rows),
+            concurrency=workers,
+            row_delay_seconds=row_delay_seconds,
             step_delay_seconds=step_delay_seconds,
-            bot_message_echo=bot_message_echo,
-        )
-        run_pipeline.append_pipeline_result(output_csv, row)
-        results.append(row)
-
-        await safe_edit_message(
-            token,
-            chat_id,
-            status_message_id,
-            (
-                f"Строка {index}/{len(rows)} завершена и сохранена.\n"
-                f"Статус: {row['pipeline_status']}\n"
-                f"Телефон: {row['found_phone'] or 'не найден'}"
+            charged_so_far=charged_so_far,
+            other_jobs_gate_seconds=(
+                queue.other_jobs_gate_seconds(queued_job) if queue is not None and queued_job is not None else ()
             ),
-            log,
         )
+        if queued_job is not None:
+            queued_job.remaining_seconds = estimate.p50_seconds
+            queued_job.remaining_gate_seconds = estimate.gate_seconds
+        return job_estimator.format_estimate(estimate)
+
+    status.set(
+        f"Файл получен. Найдено строк: {len(rows)}.\n"
+        f"{build_estimate_text()}\n"
+        "Начинаю обработку."
+    )
 
-        if index < len(rows) and row_delay_seconds > 0:
-            await asyncio.sleep(row_delay_seconds)
+    output_csv.unlink(missing_ok=True)
+    sink = run_pipeline.OrderedResultSink(output_csv)
+    for index in sorted(done_rows):
+        sink.add(index, done_rows[index])
+        if stream is not None:
+            # Resumed rows go to the stream too; chunks written before the restart are skipped.
+            stream.add(index, done_rows[index])
+    resumed_count = len(done_rows)
+    completed_rows = len(done_rows)
+    in_progress = 0
+    last_event = ""
+    processing_started_at = time.monotonic()
+
+    def build_progress_text() -> str:
+        lines = [
+            f"Обработка {job_estimator.format_progress_bar(completed_rows, len(rows))}",
+            f"В работе: {in_progress}",
+        ]
+        throughput = job_estimator.format_throughput(
+            completed_rows - resumed_count,
+            time.monotonic() - processing_started_at,
+            len(rows) - completed_rows,
+        )
+        if throughput is not None:
+            lines.append(throughput)
+        lines.append(build_estimate_text())
+        if stream is not None:
+            lines.append(stream.describe())
+        if last_event:
+            lines.append(last_event)
+        return "\n".join(lines)
+
+    async def resolve(index: int, item: run_pipeline.InputRow) -> dict[str, str | None]:
+        nonlocal in_progress, last_event
+        in_progress += 1
+        entity_type = run_pipeline.detect_entity_type(item.source_name)
+        last_event = (
+            f"Взята строка {index}: {entity_type}, "
+            f"ИНН {item.source_inn or 'не распознан'}, {item.source_name or '-'}"
+        )
+        status.set(build_progress_text())
+        try:
+            with run_pipeline.row_output_block(capture_output):
+                return await run_pipeline.resolve_row(
+                    client,
+                    bot_entity,
+                    item,
+                    log=log,
+                    headless=headless,
+                    debug_dir=debug_dir,
+                    step_delay_seconds=step_delay_seconds,
+                    bot_message_echo=bot_message_echo,
+                    gate=gate,
+                    history=history,
+                )
+        finally:
+            in_progress -= 1
+
+    async def on_row_done(index: int, item: run_pipeline.InputRow, row: dict[str, str | None]) -> None:
+        nonlocal completed_rows, charged_so_far, last_event
+        completed_rows += 1
+        done_rows[index] = row
+        if save_row is not None:
+            save_row(index, row)
+        sink.add(index, row)
+        entity_type = remaining_entity_types.pop(index)
+        row_charge = client_registry.count_row_charge(row)
+        charged_so_far += row_charge
+        history.record(latency_history.charge_key(entity_type), row_charge)
+        last_event = (
+            f"Строка {index} сохранена: {row['pipeline_status']}, "
+            f"телефон {row['found_phone'] or 'не найден'}"
+        )
+        status.set(build_progress_text())
+        if stream is not None:
+            # In completion order too, so a chunk is written as soon as all its rows
+            # are done, whatever happens to the rows before it.
+            stream.add(index, row)
+            stream.poke()
+        if partial is not None and partial.enabled:
+            # In completion order: with shortest_first the slow early rows finish last,
+            # and waiting for the input-order prefix would hold every part back.
+            partial.add(index, row)
+            partial.poke()
+
+    order = [
+        index
+        for index in run_pipeline.plan_row_order(rows, history, row_priority_policy)
+        if index not in done_rows
+    ]
+    try:
+        await run_pipeline.run_rows_concurrently(
+            rows,
+            resolve,
+            # With a scheduler one extra worker keeps a row of this file waiting for a slot;
+            # otherwise a freed slot goes to whichever file asks first and weights stop mattering.
+            concurrency=row_workers + 1 if scheduler is not None else row_workers,
+            row_delay_seconds=row_delay_seconds,
+            on_row_done=on_row_done,
+            order=order,
+            history=history,
+            trace_writer=row_trace.TraceWriter(trace_path) if trace_path is not None else None,
+            row_slot=row_slot if scheduler is not None else None,
+        )
+    finally:
+        latency_history.save_history(history, log=log)
 
+    results = [done_rows[index] for index in sorted(done_rows)]
     run_pipeline.write_pipeline_results_xlsx(output_xlsx, results)
     return results
 
 
-async def handle_document_message(
-    client: TelegramClient,
-    bot_entity,
+async def admit_document(
     *,
     token: str,
     chat_id: int,
     message: dict,
-    jobs_dir: Path,
     sheets_config: google_sheets_client.GoogleSheetsConfig,
     registry_service,
-    google_sheets_enabled: bool,
-    billing_enabled: bool,
-    headless: bool,
-    debug_dir: Path,
-    step_delay_seconds: int,
-    row_delay_seconds: int,
-    bot_message_echo: bool,
     log: logging.Logger,
-) -> None:
+) -> job_queue.QueuedJob | None:
     document = message.get("document") or {}
     file_name = document.get("file_name") or "input.xlsx"
     message_id = message.get("message_id")
     unregistered_chat_mode = os.getenv("UNREGISTERED_CHAT_MODE", "reject").strip().lower() or "reject"
 
     try:
-        access = await asyncio.to_thread(
+        access = await google_sheets_client.run_blocking(
             client_registry.validate_client_access,
             registry_service,
             sheets_config,
@@ -479,14 +728,14 @@ async def handle_document_message(
             f"Не удалось проверить настройки клиента:\n{exc}",
             reply_to_message_id=message_id,
         )
-        return
+        return None
 
     client_config = access.get("client")
     if not access["ok"]:
         details = str(access["message"])
         if access["status"] == "unregistered" and unregistered_chat_mode != "reject":
             log.info("Ignoring unregistered chat %s due to UNREGISTERED_CHAT_MODE=%s", chat_id, unregistered_chat_mode)
-            return
+            return None
         await safe_registry_side_effect(
             client_registry.log_blocked_attempt,
             log,
@@ -519,7 +768,7 @@ async def handle_document_message(
             details,
             reply_to_message_id=message_id,
         )
-        return
+        return None
 
     assert client_config is not None
     await safe_registry_side_effect(
@@ -557,7 +806,32 @@ async def handle_document_message(
             message_text,
             reply_to_message_id=message_id,
         )
-        return
+        return None
+
+    file_size = document.get("file_size")
+    max_input_file_bytes = get_max_input_file_bytes()
+    if file_size is not None and file_size > max_input_file_bytes:
+        message_text = build_file_too_large_text(file_size, max_input_file_bytes)
+        await safe_registry_side_effect(
+            client_registry.log_blocked_attempt,
+            log,
+            registry_service,
+            sheets_config,
+            chat_id=chat_id,
+            message_id=message_id,
+            file_name=file_name,
+            status="file_too_large",
+            comment=message_text,
+            client=client_config,
+            operation="log_blocked_attempt.file_too_large",
+        )
+        await send_message(
+            token,
+            chat_id,
+            message_text,
+            reply_to_message_id=message_id,
+        )
+        return None
 
     if is_template_filename(file_name):
         message_text = (
@@ -583,9 +857,54 @@ async def handle_document_message(
             message_text,
             reply_to_message_id=message_id,
         )
-        return
+        return None
+
+    return job_queue.QueuedJob(
+        job_id=f"{int(time.time())}_{uuid4().hex[:8]}",
+        chat_id=chat_id,
+        message=message,
+        file_name=file_name,
+        client_config=client_config,
+    )
+
 
-    job_id = f"{int(time.time())}_{uuid4().hex[:8]}"
+async def run_document_job(
+    client: TelegramClient,
+    bot_entity,
+    job: job_queue.QueuedJob,
+    *,
+    token: str,
+    jobs_dir: Path,
+    sheets_config: google_sheets_client.GoogleSheetsConfig,
+    registry_service,
+    google_sheets_enabled: bool,
+    billing_enabled: bool,
+    headless: bool,
+    debug_dir: Path,
+    step_delay_seconds: int,
+    row_delay_seconds: int,
+    bot_message_echo: bool,
+    gate: BotConversationGate,
+    concurrency: int,
+    history: latency_history.LatencyHistory,
+    row_priority_policy: str,
+    capture_output: bool,
+    scheduler: fair_scheduler.FairRowScheduler,
+    store: job_store.JobStore,
+    ledger: balance_ledger.BalanceLedger,
+    queue: job_queue.JobQueue,
+    status_update_interval_seconds: float,
+    partial_every_rows: int,
+    partial_every_minutes: int,
+    log: logging.Logger,
+) -> None:
+    chat_id = job.chat_id
+    message_id = job.message.get("message_id")
+    document = job.message.get("document") or {}
+    file_name = job.file_name
+    client_config = job.client_config
+
+    job_id = job.job_id
     job_dir = jobs_dir / job_id
     job_dir.mkdir(parents=True, exist_ok=True)
 
@@ -594,16 +913,36 @@ async def handle_document_message(
     output_csv = job_dir / f"{result_stem}_result.csv"
     output_xlsx = job_dir / f"{result_stem}_result.xlsx"
 
-    status = await send_message(
-        token,
-        chat_id,
-        f"Файл {file_name} принят. Скачиваю и готовлю обработку...",
-        reply_to_message_id=message_id,
+    if job.stored_status == "billed":
+        # The bot stopped after billing, so only the delivery is left to do.
+        await redeliver_result(token, job, output_xlsx, store=store, log=log)
+        return
+
+    resumed = job.stored_status == "running"
+    if resumed:
+        starting_text = f"Бот был перезапущен. Продолжаю обработку файла {file_name}..."
+    else:
+        starting_text = f"Файл {file_name} принят. Скачиваю и готовлю обработку..."
+    if job.status_message_id is None:
+        sent_status = await send_message(token, chat_id, starting_text, reply_to_message_id=message_id)
+        status_message_id = sent_status["result"]["message_id"]
+    else:
+        status_message_id = job.status_message_id
+    store.update_job(job_id, status="running", status_message_id=status_message_id)
+    status = status_updater.StatusUpdater(
+        edit=lambda text: edit_message(token, chat_id, status_message_id, text),
+        log=log,
+        min_interval_seconds=status_update_interval_seconds,
     )
-    status_message_id = status["result"]["message_id"]
+    if job.status_message_id is not None:
+        status.set(starting_text)
 
+    stream: sheets_stream_export.StreamingSheetsExport | None = None
+    partial: partial_results.PartialResults | None = None
     try:
-        await safe_registry_side_effect(
+        await safe_job_side_effect(
+            store,
+            job_id,
             client_registry.append_audit_log,
             log,
             registry_service,
@@ -616,8 +955,35 @@ async def handle_document_message(
             details=f"Клиент: {client_config['client_name']}",
             operation="append_audit_log.processing_started",
         )
-        await download_file(token, document["file_id"], input_path)
+        if not resumed or not input_path.exists():
+            await download_file(
+                token,
+                document["file_id"],
+                input_path,
+                progress=lambda received, total: status.set(
+                    f"Скачиваю файл {file_name}: {format_megabytes(received)}"
+                    + (f" из {format_megabytes(total)}" if total else "")
+                ),
+            )
+            store.update_job(job_id, input_path=str(input_path))
         input_rows = run_pipeline.load_input_rows(input_path)
+        store.update_job(job_id, rows_total=len(input_rows))
+        resumed_rows = store.load_rows(job_id) if resumed else {}
+        partial = partial_results.PartialResults(
+            output_xlsx=output_xlsx,
+            rows_total=len(input_rows),
+            every_rows=partial_every_rows,
+            every_seconds=partial_every_minutes * 60,
+            rows_done=len(resumed_rows),
+            deliver=lambda path, caption: send_document(
+                token,
+                chat_id,
+                path,
+                caption=f"{file_name}\n{caption}",
+                reply_to_message_id=message_id,
+            ),
+            log=log,
+        )
         phone_rows = sum(
             1
             for item in input_rows
@@ -628,15 +994,23 @@ async def handle_document_message(
             phone_rows=phone_rows,
             inn_rows=inn_rows,
         )
-        if (
-            not bool(client_config["allow_negative_balance"])
-            and max_possible_charge > int(client_config["request_balance"])
-        ):
+        # The worst-case charge is held in the ledger until the job settles, so parallel
+        # files of one chat cannot start on the same balance.
+        reserved = ledger.reserve(
+            job_id,
+            str(chat_id),
+            max_possible_charge,
+            allow_negative=bool(client_config["allow_negative_balance"]),
+        )
+        if not reserved:
             raise RuntimeError(
                 "Недостаточно баланса запросов для безопасного запуска файла. "
                 f"Максимально возможное списание: {max_possible_charge} запросов, "
-                f"остаток: {client_config['request_balance']}."
+                f"доступный остаток: {ledger.get_available(str(chat_id))}."
             )
+        if google_sheets_enabled and sheets_config.export_mode == "stream":
+            stream = await start_streaming_export(file_name, len(input_rows), log, store=store, job_id=job_id)
+        partial.start()
         results = await process_input_file(
             client,
             bot_entity,
@@ -644,18 +1018,37 @@ async def handle_document_message(
             input_path=input_path,
             output_csv=output_csv,
             output_xlsx=output_xlsx,
-            token=token,
             chat_id=chat_id,
-            status_message_id=status_message_id,
+            status=status,
             log=log,
             headless=headless,
             debug_dir=debug_dir,
             step_delay_seconds=step_delay_seconds,
             row_delay_seconds=row_delay_seconds,
             bot_message_echo=bot_message_echo,
+            gate=gate,
+            concurrency=concurrency,
+            history=history,
+            row_priority_policy=row_priority_policy,
+            capture_output=capture_output,
+            trace_path=job_dir / row_trace.TRACE_FILENAME,
+            scheduler=scheduler,
+            max_concurrency=int(client_config["max_concurrency"]),
+            resumed_rows=resumed_rows,
+            save_row=lambda index, row: store.save_row(job_id, index, row),
+            partial=partial,
+            stream=stream,
+            queue=queue,
+            queued_job=job,
         )
     except Exception as exc:
         log.exception("File processing failed")
+        store.update_job(job_id, status="failed", error=str(exc))
+        ledger.release(job_id)
+        if stream is not None:
+            await stream.close()
+        if partial is not None:
+            await partial.close()
         await safe_registry_side_effect(
             client_registry.log_blocked_attempt,
             log,
@@ -682,20 +1075,26 @@ async def handle_document_message(
             details=str(exc),
             operation="append_audit_log.processing_failed",
         )
-        await safe_edit_message(
-            token,
-            chat_id,
-            status_message_id,
-            f"Ошибка обработки файла {file_name}:\n{exc}",
-            log,
-        )
+        status.set(f"Ошибка обработки файла {file_name}:\n{exc}")
+        await status.flush()
         return
 
     google_sheets_status = "Google Sheets: отключено"
     worksheet_title: str | None = None
+    if stream is not None:
+        await stream.close()
+    await partial.close()
     if google_sheets_enabled:
         try:
-            worksheet_title = await asyncio.to_thread(export_results_to_google_sheets, file_name, results, log)
+            with sheets_quota.priority(sheets_quota.PRIORITY_EXPORT):
+                worksheet_title = await export_results_to_google_sheets(
+                    file_name,
+                    results,
+                    log,
+                    store=store,
+                    job_id=job_id,
+                    status=status,
+                )
         except Exception as exc:
             log.exception("Google Sheets export failed")
             google_sheets_status = f"Google Sheets: ошибка экспорта ({exc})"
@@ -707,22 +1106,27 @@ async def handle_document_message(
     request_balance_after = int(client_config["request_balance"])
     if billing_enabled:
         try:
-            billing_result = await asyncio.to_thread(
-                client_registry.apply_charge,
-                registry_service,
-                sheets_config,
-                client_config,
-                charge,
-                file_name=file_name,
-                message_id=message_id,
-                result_worksheet_title=worksheet_title,
-                comment=google_sheets_status,
-                status="charged" if charge["has_charge"] else "charged_zero",
-            )
+            with sheets_quota.priority(sheets_quota.PRIORITY_BILLING):
+                billing_result = await google_sheets_client.run_blocking(
+                    client_registry.apply_charge,
+                    registry_service,
+                    sheets_config,
+                    client_config,
+                    charge,
+                    file_name=file_name,
+                    message_id=message_id,
+                    result_worksheet_title=worksheet_title,
+                    comment=google_sheets_status,
+                    status="charged" if charge["has_charge"] else "charged_zero",
+                    job_id=job_id,
+                )
         except Exception as exc:
             log.exception("Billing update failed")
             billing_error_message = str(exc)
-            await safe_registry_side_effect(
+            ledger.release(job_id)
+            await safe_job_side_effect(
+                store,
+                job_id,
                 client_registry.append_audit_log,
                 log,
                 registry_service,
@@ -739,7 +1143,10 @@ async def handle_document_message(
             client_config = billing_result["client"]
             request_balance_after = billing_result["request_balance_after"]
     else:
-        await safe_registry_side_effect(
+        ledger.release(job_id)
+        await safe_job_side_effect(
+            store,
+            job_id,
             client_registry.append_billing_log,
             log,
             registry_service,
@@ -764,6 +1171,8 @@ async def handle_document_message(
             operation="append_billing_log.billing_disabled",
         )
 
+    store.update_job(job_id, status="billed")
+
     billing_report, short_billing_report = build_billing_report(
         client_config,
         charge,
@@ -773,15 +1182,11 @@ async def handle_document_message(
     )
 
     detailed_report, short_report = build_completion_report(results)
-    await safe_edit_message(
-        token,
-        chat_id,
-        status_message_id,
-        f"{detailed_report}\n\n{billing_report}\n\n{google_sheets_status}",
-        log,
-    )
+    status.set(f"{detailed_report}\n\n{billing_report}\n\n{google_sheets_status}")
 
-    await safe_registry_side_effect(
+    await safe_job_side_effect(
+        store,
+        job_id,
         client_registry.append_audit_log,
         log,
         registry_service,
@@ -805,6 +1210,9 @@ async def handle_document_message(
         f"{short_billing_report}\n"
         f"{google_sheets_status}"
     )
+    partial_summary = partial.describe()
+    if partial_summary is not None:
+        caption = f"{caption}\n{partial_summary}"
     try:
         await send_document(
             token,
@@ -816,17 +1224,97 @@ async def handle_document_message(
         log.info("Result file sent to chat %s: %s", chat_id, output_xlsx)
     except Exception as exc:
         log.exception("Failed to send result document")
-        await safe_edit_message(
-            token,
-            chat_id,
-            status_message_id,
-            (
-                f"Обработка завершена, но не удалось отправить файл.\n"
-                f"Ошибка: {exc}\n"
-                f"Результат сохранён локально: {output_xlsx}"
-            ),
-            log,
+        status.set(
+            f"Обработка завершена, но не удалось отправить файл.\n"
+            f"Ошибка: {exc}\n"
+            f"Результат сохранён локально: {output_xlsx}"
+        )
+    await status.flush()
+    store.update_job(job_id, status="completed")
+
+
+async def redeliver_result(
+    token: str,
+    job: job_queue.QueuedJob,
+    output_xlsx: Path,
+    *,
+    store: job_store.JobStore,
+    log: logging.Logger,
+) -> None:
+    message_id = job.message.get("message_id")
+    if output_xlsx.exists():
+        try:
+            await send_document(
+                token,
+                job.chat_id,
+                output_xlsx,
+                caption=f"Готово: {job.file_name}\nРезультат отправлен повторно после перезапуска бота.",
+                reply_to_message_id=message_id,
+            )
+        except Exception as exc:
+            log.exception("Failed to resend result document for job %s", job.job_id)
+            store.update_job(job.job_id, status="failed", error=str(exc))
+            return
+    else:
+        log.warning("Result file for billed job %s is missing: %s", job.job_id, output_xlsx)
+    store.update_job(job.job_id, status="completed")
+
+
+async def enqueue_document(
+    queue: job_queue.JobQueue,
+    store: job_store.JobStore,
+    *,
+    token: str,
+    chat_id: int,
+    message: dict,
+    sheets_config: google_sheets_client.GoogleSheetsConfig,
+    registry_service,
+    log: logging.Logger,
+) -> None:
+    try:
+        job = await admit_document(
+            token=token,
+            chat_id=chat_id,
+            message=message,
+            sheets_config=sheets_config,
+            registry_service=registry_service,
+            log=log,
         )
+        if job is None:
+            store.finish_admission(chat_id, message["message_id"])
+            return
+
+        store.create_job(
+            job.job_id,
+            chat_id=chat_id,
+            message=message,
+            file_name=job.file_name,
+            client=job.client_config,
+        )
+        job.acknowledged = asyncio.Event()
+        position = queue.submit(job)
+        try:
+            if position == 0:
+                ack_text = f"Файл {job.file_name} принят. Начинаю обработку..."
+            else:
+                ack_text = (
+                    f"Файл {job.file_name} принят и поставлен в очередь.\n"
+                    f"Позиция в очереди: {position}. Обработка начнётся автоматически."
+                )
+                start_seconds = queue.estimate_start_seconds(position)
+                if start_seconds is not None:
+                    ack_text += f"\nОжидаемое начало: через ~{job_estimator.format_duration(start_seconds)}."
+            status = await send_message(token, chat_id, ack_text, reply_to_message_id=message.get("message_id"))
+            job.status_message_id = status["result"]["message_id"]
+            store.update_job(job.job_id, status_message_id=job.status_message_id)
+        except Exception as exc:
+            log.warning("Failed to send queue acknowledgement: %s", exc)
+        finally:
+            job.acknowledged.set()
+    except Exception:
+        log.exception("Failed to accept document from chat %s", chat_id)
+        # Not retried after a restart either: the same message would fail again.
+        store.finish_admission(chat_id, message["message_id"])
 
 
 async def bootstrap_offset(token: str, log: logging.Logger) -> int | None:
@@ -842,6 +1330,108 @@ async def bootstrap_offset(token: str, log: logging.Logger) -> int | None:
     return updates[-1]["update_id"] + 1
 
 
+def get_admin_chat_ids() -> set[int]:
+    raw = os.getenv("TG_BOT_ADMIN_CHAT_IDS", "").strip() or os.getenv("ID_TG_CHAT", "").strip()
+    return {int(item) for item in raw.replace(";", ",").split(",") if item.strip()}
+
+
+def is_reload_command(text: str | None) -> bool:
+    # Commands in groups arrive as /reload@bot_username.
+    parts = (text or "").split(maxsplit=1)
+    return bool(parts) and parts[0].split("@", 1)[0] == "/reload"
+
+
+async def reload_client_registry(
+    token: str,
+    chat_id: int,
+    message_id: int,
+    *,
+    sheets_config: google_sheets_client.GoogleSheetsConfig,
+    registry_service,
+    log: logging.Logger,
+) -> None:
+    try:
+        count = await google_sheets_client.run_blocking(client_registry.reload_clients, registry_service, sheets_config)
+    except Exception as exc:
+        log.exception("Failed to reload client registry")
+        text = f"Не удалось перечитать лист клиентов:\n{exc}"
+    else:
+        log.info("Client registry reloaded by chat %s: %s clients", chat_id, count)
+        text = f"Лист клиентов перечитан. Клиентов: {count}."
+    try:
+        await send_message(token, chat_id, text, reply_to_message_id=message_id)
+    except Exception as exc:
+        log.warning("Failed to answer /reload: %s", exc)
+
+
+async def sync_balances_once(
+    registry_service,
+    sheets_config: google_sheets_client.GoogleSheetsConfig,
+    log: logging.Logger,
+) -> None:
+    try:
+        with sheets_quota.priority(sheets_quota.PRIORITY_BILLING):
+            synced = await google_sheets_client.run_blocking(client_registry.sync_balances, registry_service, sheets_config)
+    except Exception as exc:
+        log.warning("Failed to sync balances to the clients sheet, will retry: %s", exc)
+    else:
+        if synced:
+            log.debug("Synced %s balances to the clients sheet", synced)
+
+
+async def run_balance_sync(
+    registry_service,
+    sheets_config: google_sheets_client.GoogleSheetsConfig,
+    *,
+    interval_seconds: float,
+    log: logging.Logger,
+) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        await sync_balances_once(registry_service, sheets_config, log)
+
+
+async def poll_updates(
+    token: str,
+    store: job_store.JobStore,
+    handle_update: Callable[[dict], None],
+    log: logging.Logger,
+) -> None:
+    # getUpdates is refused while a webhook is set, e.g. after running in webhook mode.
+    try:
+        await bot_api_request(token, "deleteWebhook")
+    except Exception as exc:
+        log.warning("Failed to delete bot webhook: %s", exc)
+    offset = store.get_update_offset()
+    if offset is None:
+        offset = await bootstrap_offset(token, log)
+    else:
+        log.info("Resuming bot updates from offset %s", offset)
+
+    while True:
+        params = {
+            "timeout": 60,
+            "allowed_updates": json.dumps(ALLOWED_UPDATES),
+        }
+        if offset is not None:
+            params["offset"] = offset
+
+        try:
+            response = await bot_api_request(token, "getUpdates", params)
+        except (OSError, asyncio.TimeoutError) as exc:
+            log.warning("Network error while polling bot updates: %s", exc)
+            await asyncio.sleep(3)
+            continue
+        except Exception as exc:
+            log.warning("Bot API polling error: %s", exc)
+            await asyncio.sleep(3)
+            continue
+
+        for update in response.get("result", []):
+            offset = update["update_id"] + 1
+            handle_update(update)
+
+
 async def main() -> None:
     log = setup_logging()
     token = get_required_env("TG_BOT_TOKEN")
@@ -850,9 +1440,55 @@ async def main() -> None:
     billing_enabled = get_bool_env("BILLING_ENABLED", True)
 
     api_id, api_hash, session_name, bot_username, headless, debug_dir, step_delay_seconds, row_delay_seconds, bot_message_echo = run_pipeline.load_runtime_config()
+    concurrency, min_send_interval_seconds = run_pipeline.load_concurrency_config()
+    row_priority_policy = run_pipeline.get_row_priority_policy()
+    job_workers = get_int_env("TG_BOT_JOB_WORKERS", 8)
+    update_mode = os.getenv("TG_BOT_UPDATE_MODE", "polling").strip().lower() or "polling"
+    if update_mode not in UPDATE_MODES:
+        raise RuntimeError(f"Unsupported TG_BOT_UPDATE_MODE: {update_mode}. Expected one of: {', '.join(UPDATE_MODES)}")
+    admin_chat_ids = get_admin_chat_ids()
+    status_update_interval_seconds = get_int_env("TG_BOT_STATUS_UPDATE_INTERVAL_SECONDS", 3)
+    partial_every_rows = get_int_env("TG_BOT_PARTIAL_EVERY_ROWS", 0)
+    partial_every_minutes = get_int_env("TG_BOT_PARTIAL_EVERY_MINUTES", 0)
+    history = latency_history.load_history(log=log)
+    gate = BotConversationGate(
+        min_send_interval_seconds=min_send_interval_seconds,
+        on_release=lambda seconds: history.record(latency_history.gate_key(), seconds),
+    )
+    queue = job_queue.JobQueue(workers=max(1, job_workers))
+    # Rows of all running files share PIPELINE_CONCURRENCY slots, split fairly between chats.
+    scheduler = fair_scheduler.FairRowScheduler(capacity=concurrency)
+    store = job_store.open_job_store()
+    ledger = balance_ledger.open_balance_ledger(store.path)
+    client_registry.set_balance_ledger(ledger)
     sheets_config = google_sheets_client.load_config()
     registry_service = google_sheets_client.build_sheets_service(sheets_config)
-    await asyncio.to_thread(client_registry.ensure_registry_sheets, registry_service, sheets_config)
+    await google_sheets_client.run_blocking(client_registry.ensure_registry_sheets, registry_service, sheets_config)
+    clients_count = await google_sheets_client.run_blocking(client_registry.reload_clients, registry_service, sheets_config)
+    log.info("Client registry loaded: %s clients", clients_count)
+
+    async def append_log_rows(worksheet_title: str, rows: list[list[str]]) -> None:
+        # Audit and billing log rows wait in the spool, so they yield quota to everything else.
+        with sheets_quota.priority(sheets_quota.PRIORITY_AUDIT):
+            await google_sheets_client.append_rows_async(registry_service, sheets_config.spreadsheet_id, worksheet_title, rows)
+
+    log_writer = registry_log_writer.RegistryLogWriter(
+        spool_path=Path(os.getenv("TG_BOT_LOG_SPOOL", "tg_bot_log_spool.jsonl").strip() or "tg_bot_log_spool.jsonl"),
+        append_rows=append_log_rows,
+        log=log,
+        flush_interval_seconds=get_int_env("TG_BOT_LOG_FLUSH_INTERVAL_SECONDS", 5),
+        max_rows_per_append=sheets_config.export_chunk_rows,
+    )
+    client_registry.set_log_writer(log_writer)
+    log_writer_task = asyncio.create_task(log_writer.run())
+    balance_sync_task = asyncio.create_task(
+        run_balance_sync(
+            registry_service,
+            sheets_config,
+            interval_seconds=get_int_env("TG_BOT_BALANCE_SYNC_INTERVAL_SECONDS", 30),
+            log=log,
+        )
+    )
     client = build_telegram_client(session_name, api_id, api_hash)
 
     await client.connect()
@@ -867,70 +1503,187 @@ async def main() -> None:
     log.info("Connected file-bot @%s", me["result"].get("username"))
     log.info("Connected query-bot %s", bot_username)
 
-    offset = await bootstrap_offset(token, log)
-    processed_message_ids: set[tuple[int, int]] = set()
+    dedupe_window_seconds = get_int_env("TG_BOT_DEDUPE_WINDOW_HOURS", 48) * 3600
+    processed_messages = update_dedupe.RecentMessageKeys(
+        window_seconds=dedupe_window_seconds,
+        max_entries=get_int_env("TG_BOT_DEDUPE_MAX_ENTRIES", 10000),
+    )
+    processed_messages.load(store.load_seen_messages(time.time() - dedupe_window_seconds), time.time())
+    metrics_server = await pipeline_metrics.start_metrics_server(log)
+
+    async def handle_job(job: job_queue.QueuedJob) -> None:
+        scheduler.open_flow(
+            str(job.chat_id),
+            weight=client_registry.get_client_weight(job.client_config),
+            max_concurrency=int(job.client_config["max_concurrency"]),
+        )
+        try:
+            await run_document_job(
+                client,
+                bot_entity,
+                job,
+                token=token,
+                jobs_dir=jobs_dir,
+                sheets_config=sheets_config,
+                registry_service=registry_service,
+                google_sheets_enabled=google_sheets_enabled,
+                billing_enabled=billing_enabled,
+                headless=headless,
+                debug_dir=debug_dir,
+                step_delay_seconds=step_delay_seconds,
+                row_delay_seconds=row_delay_seconds,
+                bot_message_echo=bot_message_echo,
+                gate=gate,
+                concurrency=concurrency,
+                history=history,
+                row_priority_policy=row_priority_policy,
+                # Rows of parallel jobs share the terminal too, so buffer them per row.
+                capture_output=concurrency > 1 or queue.workers > 1,
+                scheduler=scheduler,
+                store=store,
+                ledger=ledger,
+                queue=queue,
+                status_update_interval_seconds=status_update_interval_seconds,
+                partial_every_rows=partial_every_rows,
+                partial_every_minutes=partial_every_minutes,
+                log=log,
+            )
+        finally:
+            scheduler.close_flow(str(job.chat_id))
+
+    unfinished_jobs = store.list_unfinished()
+    released = ledger.release_all_except({stored.job_id for stored in unfinished_jobs})
+    if released:
+        log.info("Released %s balance reservations of jobs that will not resume", released)
+    for stored in unfinished_jobs:
+        queue.submit(
+            job_queue.QueuedJob(
+                job_id=stored.job_id,
+                chat_id=stored.chat_id,
+                message=stored.message,
+                file_name=stored.file_name,
+                client_config=stored.client,
+                status_message_id=stored.status_message_id,
+                stored_status=stored.status,
+            )
+        )
+        log.info("Re-enqueued unfinished job %s (%s) for chat %s", stored.job_id, stored.status, stored.chat_id)
+
+    workers = job_queue.start_job_workers(queue, handle_job, log)
+    admission_tasks: set[asyncio.Task] = set()
+    log.info("Job workers: %s", queue.workers)
+
+    def handle_update(update: dict) -> None:
+        # Synchronous on purpose: when it returns, the offset, the dedupe key and a
+        # pending admission are committed, so the webhook answers 200 only for
+        # updates that survive a crash; a failed commit answers 500 and Telegram
+        # delivers the update again.
+        message = extract_message(update) or {}
+        chat_id = (message.get("chat") or {}).get("id")
+        message_id = message.get("message_id")
+        message_key = (chat_id, message_id) if chat_id is not None and message_id is not None else None
+
+        now = time.time()
+        is_new = message_key is not None and not processed_messages.contains(message_key, now)
+        document = message.get("document") if is_new else None
+        store.record_update(
+            update["update_id"] + 1,
+            message_key if is_new else None,
+            seen_at=now,
+            keep_since=now - dedupe_window_seconds,
+            pending_message=message if document else None,
+        )
+        if is_new:
+            # Only after the commit, so an update answered with 500 is not a duplicate when it comes again.
+            processed_messages.add(message_key, now)
 
-    try:
-        while True:
-            params = {
-                "timeout": 60,
-                "allowed_updates": json.dumps(["message", "edited_message"]),
-            }
-            if offset is not None:
-                params["offset"] = offset
-
-            try:
-                response = await bot_api_request(token, "getUpdates", params)
-            except urllib.error.URLError as exc:
-                log.warning("Network error while polling bot updates: %s", exc)
-                await asyncio.sleep(3)
-                continue
-            except Exception as exc:
-                log.warning("Bot API polling error: %s", exc)
-                await asyncio.sleep(3)
-                continue
-
-            updates = response.get("result", [])
-            for update in updates:
-                offset = update["update_id"] + 1
-                message = extract_message(update)
-                if not message:
-                    continue
-
-                chat = message.get("chat") or {}
-                chat_id = chat.get("id")
-                message_id = message.get("message_id")
-                if chat_id is None or message_id is None:
-                    continue
-
-                message_key = (chat_id, message_id)
-                if message_key in processed_message_ids:
-                    continue
-                processed_message_ids.add(message_key)
-
-                document = message.get("document")
-                if not document:
-                    continue
-
-                await handle_document_message(
-                    client,
-                    bot_entity,
-                    token=token,
-                    chat_id=chat_id,
-                    message=message,
-                    jobs_dir=jobs_dir,
+        if not is_new:
+            return
+        if is_reload_command(message.get("text")) and chat_id in admin_chat_ids:
+            task = asyncio.create_task(
+                reload_client_registry(
+                    token,
+                    chat_id,
+                    message_id,
                     sheets_config=sheets_config,
                     registry_service=registry_service,
-                    google_sheets_enabled=google_sheets_enabled,
-                    billing_enabled=billing_enabled,
-                    headless=headless,
-                    debug_dir=debug_dir,
-                    step_delay_seconds=step_delay_seconds,
-                    row_delay_seconds=row_delay_seconds,
-                    bot_message_echo=bot_message_echo,
                     log=log,
                 )
+            )
+            admission_tasks.add(task)
+            task.add_done_callback(admission_tasks.discard)
+            return
+
+        if not document:
+            return
+        start_admission(message)
+
+    def start_admission(message: dict) -> None:
+        # Validation and processing run outside the update loop so that updates
+        # keep being read while long files are processed.
+        task = asyncio.create_task(
+            enqueue_document(
+                queue,
+                store,
+                token=token,
+                chat_id=message["chat"]["id"],
+                message=message,
+                sheets_config=sheets_config,
+                registry_service=registry_service,
+                log=log,
+            )
+        )
+        admission_tasks.add(task)
+        task.add_done_callback(admission_tasks.discard)
+
+    # Documents whose update was consumed but whose job was not created before the
+    # bot stopped; their updates will not come again.
+    pending_admissions = store.list_pending_admissions()
+    if pending_admissions:
+        log.info("Resuming %s pending document admissions", len(pending_admissions))
+    for pending_message in pending_admissions:
+        start_admission(pending_message)
+
+    # Output of parallel rows is buffered per row; the router passes everything
+    # else straight through to the real stdout.
+    original_stdout = sys.stdout
+    sys.stdout = run_pipeline.RowOutputRouter(original_stdout)
+    webhook: asyncio.AbstractServer | None = None
+    try:
+        if update_mode == "webhook":
+            webhook_config = webhook_server.load_webhook_config()
+            webhook = await webhook_server.start_webhook_server(webhook_config, handle_update, log)
+            await bot_api_request(
+                token,
+                "setWebhook",
+                {
+                    "url": webhook_config.url,
+                    "secret_token": webhook_config.secret_token,
+                    "allowed_updates": json.dumps(ALLOWED_UPDATES),
+                },
+            )
+            log.info("Receiving bot updates via webhook")
+            await webhook.serve_forever()
+        else:
+            await poll_updates(token, store, handle_update, log)
     finally:
+        for task in [*workers, *admission_tasks, log_writer_task, balance_sync_task]:
+            task.cancel()
+        await asyncio.gather(*workers, *admission_tasks, log_writer_task, balance_sync_task, return_exceptions=True)
+        await log_writer.flush()
+        await sync_balances_once(registry_service, sheets_config, log)
+        google_sheets_client.close_sheets_executor()
+        sys.stdout = original_stdout
+        if webhook is not None:
+            webhook.close()
+            await webhook.wait_closed()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        ledger.close()
+        store.close()
+        if BOT_API_HTTP is not None:
+            await BOT_API_HTTP.close()
         if client.is_connected():
             await client.disconnect()
 
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+MessageKey = tuple[int, int]
+
+
+@dataclass
+class RecentMessageKeys:
+    # (chat_id, message_id) pairs seen within the last window_seconds, oldest first,
+    # capped at max_entries so memory stays flat however long the bot runs.
+    window_seconds: float
+    max_entries: int
+    entries: OrderedDict[MessageKey, float] = field(default_factory=OrderedDict)
+
+    def expire(self, now: float) -> None:
+        cutoff = now - self.window_seconds
+        while self.entries:
+            oldest_key, seen_at = next(iter(self.entries.items()))
+            if seen_at >= cutoff and len(self.entries) <= self.max_entries:
+                return
+            del self.entries[oldest_key]
+
+    def contains(self, key: MessageKey, now: float) -> bool:
+        self.expire(now)
+        return key in self.entries
+
+    def add(self, key: MessageKey, now: float) -> None:
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        self.expire(now)
+
+    def load(self, items: list[tuple[MessageKey, float]], now: float) -> None:
+        for key, seen_at in sorted(items, key=lambda item: item[1]):
+            self.entries[key] = seen_at
+        self.expire(now)
@@ -0,0 +1,142 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import urllib.parse
+from dataclasses import dataclass
+from typing import Callable
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+MAX_UPDATE_BYTES = 1024 * 1024
+IDLE_CONNECTION_SECONDS = 75
+
+
+@dataclass(frozen=True)
+class WebhookConfig:
+    url: str
+    host: str
+    port: int
+    path: str
+    secret_token: str
+
+
+def load_webhook_config() -> WebhookConfig:
+    url = os.getenv("TG_BOT_WEBHOOK_URL", "").strip()
+    secret_token = os.getenv("TG_BOT_WEBHOOK_SECRET", "").strip()
+    if not url:
+        raise RuntimeError("Missing required .env value: TG_BOT_WEBHOOK_URL")
+    if not secret_token:
+        raise RuntimeError("Missing required .env value: TG_BOT_WEBHOOK_SECRET")
+
+    # A reverse proxy may forward the public URL to another local path.
+    path = os.getenv("TG_BOT_WEBHOOK_PATH", "").strip() or urllib.parse.urlsplit(url).path or "/"
+    return WebhookConfig(
+        url=url,
+        host=os.getenv("TG_BOT_WEBHOOK_HOST", "0.0.0.0").strip() or "0.0.0.0",
+        port=int(os.getenv("TG_BOT_WEBHOOK_PORT", "8443").strip() or "8443"),
+        path=path,
+        secret_token=secret_token,
+    )
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict[str, str], bytes] | None:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    headers: dict[str, str] = {}
+    while True:
+        header_line = await reader.readline()
+        if header_line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header_line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    parts = request_line.decode("latin-1").split()
+    method = parts[0] if parts else ""
+    path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+    length = int(headers.get("content-length", "0") or "0")
+    if length > MAX_UPDATE_BYTES:
+        raise ValueError(f"Request body too large: {length} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+async def write_response(writer: asyncio.StreamWriter, status: str, *, keep_alive: bool) -> None:
+    body = status.encode("latin-1") + b"\n"
+    writer.write(
+        (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+
+async def handle_webhook_connection(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    *,
+    config: WebhookConfig,
+    on_update: Callable[[dict], None],
+    log: logging.Logger,
+) -> None:
+    # Telegram keeps webhook connections open, so one connection serves many updates.
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), timeout=IDLE_CONNECTION_SECONDS)
+            except ValueError as exc:
+                log.warning("Rejected webhook request: %s", exc)
+                await write_response(writer, "413 Payload Too Large", keep_alive=False)
+                return
+            if request is None:
+                return
+
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+            if method != "POST" or path != config.path:
+                status = "404 Not Found"
+            elif not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, ""), config.secret_token):
+                log.warning("Rejected webhook request with a wrong secret token")
+                status = "403 Forbidden"
+            else:
+                try:
+                    update = json.loads(body)
+                except ValueError:
+                    status = "400 Bad Request"
+                else:
+                    try:
+                        # on_update persists the update before it returns; only then
+                        # may Telegram consider it delivered.
+                        on_update(update)
+                    except Exception:
+                        # A non-2xx answer makes Telegram deliver the update again later.
+                        log.exception("Failed to handle webhook update")
+                        status = "500 Internal Server Error"
+                    else:
+                        status = "200 OK"
+            await write_response(writer, status, keep_alive=keep_alive)
+            if not keep_alive:
+                return
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_webhook_server(
+    config: WebhookConfig,
+    on_update: Callable[[dict], None],
+    log: logging.Logger,
+) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await handle_webhook_connection(reader, writer, config=config, on_update=on_update, log=log)
+
+    server = await asyncio.start_server(handle, config.host, config.port)
+    log.info("Webhook endpoint: http://%s:%s%s (public URL %s)", config.host, config.port, config.path, config.url)
+    return server